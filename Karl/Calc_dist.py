@@ -1,5 +1,13 @@
 import numpy as np
 import glob
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Kristof'))
+from zones import zone_nearest_neighbours, pair_chi2
+from local_density import local_density
+from kernels import nearest_two_kernel
+from match_cache import match_cache, file_digest, cache_key
 
 from matplotlib import pylab;
 from matplotlib import pyplot as plt;
@@ -229,6 +237,31 @@ def do_all(y_array, x_array, distance_filter):
         store.append(find_index_of_nearest_xy(
             x_array[:,3],x_array[:,1],y_array[i,3],y_array[i,1], distance_filter)) #2nd and 4th cols are ones of interest
     return store
+
+def do_all_zones(y_array, x_array, distance_filter, radius, chi2_threshold=None):
+    # Same output as do_all, but the neighbours are searched with the declination-zone engine
+    # within radius (deg) instead of the brute force loop. Distances are scaled by cos(Dec).
+    # Sources without a neighbour get index -1 and are not accepted by the filter.
+    # radius and distance_filter can also be per source arrays (see local_density).
+    # With chi2_threshold the nearest neighbour is only accepted if the chi-square of the
+    # separation with the combined err_RA/err_Dec of the pair is below the threshold.
+    index, distance1, distance2 = zone_nearest_neighbours(
+        x_array[:,1], x_array[:,3], y_array[:,1], y_array[:,3], radius)
+    filter_bool = (index >= 0) & (distance2 > distance_filter*distance1)
+    if chi2_threshold is not None:
+        nbr = np.maximum(index, 0)
+        chi2 = pair_chi2(x_array[nbr,1], x_array[nbr,3], x_array[nbr,2], x_array[nbr,4],
+                         y_array[:,1], y_array[:,3], y_array[:,2], y_array[:,4])
+        filter_bool &= chi2 <= chi2_threshold
+    return list(zip(index, distance1, distance2, filter_bool))
+
+def do_all_kernel(y_array, x_array, distance_filter):
+    # Same output as do_all, the brute force search runs in the compiled (Numba) kernel,
+    # or in blocked NumPy broadcasting when Numba is not installed
+    index, distance1, distance2 = nearest_two_kernel(
+        x_array[:,3], x_array[:,1], y_array[:,3], y_array[:,1])
+    filter_bool = distance2 > distance_filter*distance1
+    return list(zip(index, distance1, distance2, filter_bool))
 """
 distance_filter = 3
 do_all(y_array, x_array, distance_filter)
@@ -296,6 +329,9 @@ if __name__ == "__main__":
     folder_dest= "../Karl/Data/"
     files_list = sorted(glob.glob("%s*.csv" %folder_input));
 
+    cache_folder = None #if set, the neighbour results are cached on disk by the hash of the two epochs and the parameters
+    cache = match_cache(cache_folder) if cache_folder is not None else None
+
     j =0
     for i in files_list:
         #print(i)
@@ -305,7 +341,28 @@ if __name__ == "__main__":
         epoch_1 = np.genfromtxt(files_list[j+1],  dtype=float, delimiter=',',  skip_header=1);
 
         distance_filter = 2 #is the proportion between 1st and 2nd neighbour to filter 1st neighbour as certain
-        results = do_all(epoch_1, epoch_0, distance_filter)
+        zone_radius = None #search radius (deg) of the declination-zone engine, None uses the brute force loop
+        chi2_threshold = None #reject nearest neighbours above this chi-square of the combined position errors (zone engine only)
+        adaptive_k = None #if set, the radius and the ratio follow the local density (k-th neighbour distance in epoch_0)
+        if adaptive_k is not None and zone_radius is not None:
+            density = local_density(epoch_0[:,1], epoch_0[:,3], k=adaptive_k, RA=epoch_1[:,1], Dec=epoch_1[:,3])
+            #a duplicate position has zero spacing, keep the radius above the typical position error
+            min_radius = 3 * np.hypot(np.median(epoch_1[:,2]), np.median(epoch_1[:,4]))
+            zone_radius = density.adaptive_radius(factor=0.5, min_radius=min_radius, max_radius=zone_radius)
+            distance_filter = density.adaptive_ratio(distance_filter, min_ratio=1.5)
+        cached = None
+        if cache is not None:
+            key = cache_key(file_digest(i), file_digest(files_list[j+1]), distance_filter=distance_filter,
+                            zone_radius=zone_radius, chi2_threshold=chi2_threshold)
+            cached = cache.get(key)
+        if cached is not None:
+            results = cached['results']
+        elif zone_radius is None:
+            results = do_all(epoch_1, epoch_0, distance_filter)
+        else:
+            results = do_all_zones(epoch_1, epoch_0, distance_filter, zone_radius, chi2_threshold)
+        if cache is not None and cached is None:
+            cache.put(key, results=np.array(results, dtype=float))
         epoch01temp = np.concatenate((epoch_1, results), axis=1) #combine matrices by additional columns
         #perc_filter = np.sum(epoch01temp[:,9]) / epoch01temp[:,9].shape
         # with distance_filter = 3 , filter 59%. filter = 2, filter 77%.
@@ -0,0 +1,158 @@
+"""
+------------------------------
+MIT License
+
+Copyright (c) 2018 Hachastron
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+------------------------------
+
+Streaming transient alerts
+
+When an epoch is solved, the flux of every newly assigned observation is
+compared with the flux gaussian (Flux_pdf) of its galaxy model before the
+update. The statistics are the cached ones of the cost stage, so the score is
+O(1) per observation. The observations deviating more than the threshold are
+emitted at once to a queue or appended to a .csv file. The matcher may run in a
+worker thread: a queue.Queue is thread-safe, an asyncio.Queue is fed through
+the call_soon_threadsafe of its event loop.
+
+The alerts are as good as the matches: without birth costs and gating every
+observation is forced onto a model, and the wrong pairs show up as flares.
+
+"""
+
+#=================================================
+#IMPORTS
+#=================================================
+import numpy as np;
+import asyncio;
+import inspect;
+import os;
+
+from compact_storage import epoch_column;
+
+#=================================================
+#LOGGING
+#=================================================
+import logging;
+
+log = logging.getLogger();
+log.setLevel(logging.INFO);
+
+#=================================================
+#CONSTANTS
+#=================================================
+alert_dtype = np.dtype([('epoch', np.int32), ('model', np.int32), ('ID', np.int32), ('RA', np.float64), ('Dec', np.float64),
+                        ('Flux', np.float64), ('Flux_err', np.float64), ('model_Flux_mu', np.float64), ('model_Flux_sigma', np.float64),
+                        ('deviation', np.float64)]);
+
+#=================================================
+#SUPPORT FUNCTIONS
+#=================================================
+def flux_deviation(Flux, Flux_err, Flux_mu, Flux_sigma):
+    """Deviation of the observed fluxes from the model flux gaussians, in their combined sigma
+
+    :param Flux, Flux_err: The observed fluxes and errors
+    :param Flux_mu, Flux_sigma: The flux gaussians of the models
+    """
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.fabs(Flux - Flux_mu) / np.sqrt(Flux_sigma * Flux_sigma + Flux_err * Flux_err);
+
+def transient_alerts(observed_epoch, epoch_ID, rows, model_ind, Flux_mu, Flux_sigma, alert_sigma):
+    """Return the alerts (alert_dtype records) of the assigned observations deviating more than alert_sigma
+
+    :param observed_epoch: given epoch in a numpy array, already readed from .csv, or a compact record array
+    :param epoch_ID: The ID of the epoch
+    :param rows: The rows of the assigned observations
+    :param model_ind: The galaxy model index of the rows
+    :param Flux_mu, Flux_sigma: The flux gaussians of the models of the rows, before the update
+    :param alert_sigma: The deviation threshold
+    """
+
+    deviation = flux_deviation(epoch_column(observed_epoch, 'Flux')[rows], epoch_column(observed_epoch, 'Flux_err')[rows], Flux_mu, Flux_sigma);
+    alert = deviation > alert_sigma;
+
+    records = np.zeros(np.sum(alert), dtype=alert_dtype);
+    records['epoch'] = epoch_ID;
+    records['model'] = np.asarray(model_ind)[alert];
+    for name in ['ID', 'RA', 'Dec', 'Flux', 'Flux_err']:
+        records[name] = epoch_column(observed_epoch, name)[rows[alert]];
+    records['model_Flux_mu'] = np.asarray(Flux_mu)[alert];
+    records['model_Flux_sigma'] = np.asarray(Flux_sigma)[alert];
+    records['deviation'] = deviation[alert];
+
+    return records;
+
+def emit_alerts(records, alerts, loop=None):
+    """Send the alerts to a queue (one record each) or append them to a .csv file
+
+    :param records: The alerts, see transient_alerts
+    :param alerts: A thread-safe queue (queue.Queue), an asyncio.Queue or the path of the .csv file
+    :param loop: The event loop of an asyncio.Queue, needed when the alerts are emitted from another thread
+    """
+
+    if records.size == 0:
+        return;
+
+    if isinstance(alerts, asyncio.Queue):
+        try:
+            running = asyncio.get_running_loop();
+        except RuntimeError:
+            running = None;
+
+        if loop is None and running is None:
+            raise ValueError('The event loop of the asyncio.Queue is needed outside of its thread');
+
+        #put() would return a coroutine, which is never awaited here
+        for record in records:
+            if loop is None or loop is running:
+                alerts.put_nowait(record);
+            else:
+                loop.call_soon_threadsafe(alerts.put_nowait, record);
+    elif hasattr(alerts, 'put'):
+        if inspect.iscoroutinefunction(alerts.put):
+            raise TypeError('The alert queue has a coroutine put, use a queue.Queue or an asyncio.Queue with its loop');
+
+        for record in records:
+            alerts.put(record);
+    else:
+        new_file = not os.path.exists(alerts);
+
+        with open(alerts, 'a') as f:
+            np.savetxt(f, records, fmt=['%i', '%i', '%i'] + ['%.10g'] * (len(alert_dtype.names) - 3), delimiter=',',
+                       header=','.join(alert_dtype.names) if new_file else '');
+
+    log.info('%i transient alerts in epoch %i' %(records.size, records['epoch'][0]));
+
+#=================================================
+#MAIN
+#=================================================
+if __name__ == '__main__':
+    """Test
+    """
+
+    epoch = np.genfromtxt('../Data/epoch00.csv',  dtype=float, delimiter=',',  skip_header=1);
+
+    flare = np.array(epoch, copy=True);
+    flare[7,5] *= 10.;
+
+    rows = np.arange(epoch.shape[0]);
+    print(transient_alerts(flare, 1, rows, rows, epoch[:,5], epoch[:,6], alert_sigma=5.));
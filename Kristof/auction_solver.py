@@ -0,0 +1,240 @@
+"""
+------------------------------
+MIT License
+
+Copyright (c) 2018 Hachastron
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+------------------------------
+
+Warm started auction solver
+
+Sparse forward auction (Bertsekas) with epsilon-scaling for the observation -
+model assignment. Each epoch changes the sky little, so the model prices of the
+previous epoch are kept in an auction_state and used as the starting prices of
+the next one, which leaves only a few bidding rounds at small epsilon.
+
+The problem is made square without a dense padding: every observation has a
+private dummy object (birth) and every model a private dummy bidder (death), and
+the dummy bidders may take the dummy objects of the candidate observations. All
+the unassigned bidders bid at once (Jacobi auction), so the rounds are NumPy
+vectorized.
+
+"""
+
+#=================================================
+#IMPORTS
+#=================================================
+import numpy as np;
+
+from zones import ragged_arange;
+
+#=================================================
+#LOGGING
+#=================================================
+import logging;
+
+log = logging.getLogger();
+log.setLevel(logging.INFO);
+
+#=================================================
+#CLASSES
+#=================================================
+class auction_state(object):
+    """Model prices of the auction solver kept from epoch to epoch
+    """
+
+    def __init__(self, N_models=0):
+        """Class attributes
+
+        :param N_models: Number of models in the sky model
+        """
+
+        self.prices = np.zeros(N_models);
+        self.N_solved = 0;#Number of solved epochs, the first one is a cold start
+
+    def resize(self, N_models):
+        """Add zero prices for the new models (births)
+
+        :param N_models: Number of models in the sky model
+        """
+
+        if N_models > self.prices.size:
+            self.prices = np.concatenate((self.prices, np.zeros(N_models - self.prices.size)));
+
+#=================================================
+#SUPPORT FUNCTIONS
+#=================================================
+def auction_rounds(start, obj, benefit, price, epsilon, assigned, owner, max_rounds=None):
+    """Run Jacobi bidding rounds until every bidder holds an object
+
+    The arrays are updated in place, returns the number of rounds. If max_rounds is reached
+    some bidders are left unassigned.
+
+    :param start: CSR row starts of the bidders (edges sorted by bidder)
+    :param obj: Object of the edges
+    :param benefit: Benefit of the edges
+    :param price: Object prices
+    :param epsilon: Minimum bid increment
+    :param assigned: Object of the bidders, -1 if unassigned
+    :param owner: Bidder of the objects, -1 if unassigned
+    :param max_rounds: Maximum number of rounds, None has no limit
+    """
+
+    N_rounds = 0;
+
+    while max_rounds is None or N_rounds < max_rounds:
+        bidders = np.flatnonzero(assigned < 0);
+        if bidders.size == 0:
+            break;
+
+        counts = start[bidders + 1] - start[bidders];
+        offsets = np.cumsum(counts) - counts;
+        edges = ragged_arange(start[bidders], start[bidders + 1]);
+        segment = np.repeat(np.arange(bidders.size), counts);
+
+        #Best and second best object value of each bidder
+        values = benefit[edges] - price[obj[edges]];
+        best = np.maximum.reduceat(values, offsets);
+
+        best_edge = np.flatnonzero(values == best[segment]);
+        best_edge = best_edge[np.unique(segment[best_edge], return_index=True)[1]];
+
+        values[best_edge] = -np.inf;
+        second = np.maximum.reduceat(values, offsets);
+
+        best_obj = obj[edges[best_edge]];
+        bid = price[best_obj] + best - second + epsilon;
+
+        #The highest bid wins each object, the previous owners are outbid
+        order = np.lexsort((-bid, best_obj));
+        first = np.concatenate(([True], best_obj[order[1:]] != best_obj[order[:-1]]));
+        win = order[first];
+
+        won_obj = best_obj[win];
+        outbid = owner[won_obj];
+        assigned[outbid[outbid >= 0]] = -1;
+
+        owner[won_obj] = bidders[win];
+        assigned[bidders[win]] = won_obj;
+        price[won_obj] = bid[win];
+
+        N_rounds += 1;
+
+    return N_rounds;
+
+def auction_assignment(obs_ind, model_ind, cost, N_obs, N_models, unmatched_value, state=None,
+                       epsilon=1e-6, epsilon_start=None, warm_epsilon_start=0.05, scaling=4., max_warm_rounds=200):
+    """Solve the sparse assignment problem with birth and death by the auction algorithm
+
+    A matched pair is worth unmatched_value - cost, an unmatched observation or model is worth 0,
+    so unmatched_value is the birth_cost + death_cost of solve_assignment. The result is within
+    N * epsilon of the optimum.
+
+    Returns the matched observation and model indices and the unmatched observation indices.
+
+    :param obs_ind: Observation index of the candidate pairs
+    :param model_ind: Model index of the candidate pairs
+    :param cost: Cost of the candidate pairs
+    :param N_obs: Number of observations
+    :param N_models: Number of models
+    :param unmatched_value: The value of leaving an observation and a model unmatched
+    :param state: auction_state with the prices of the previous epoch, updated in place
+    :param epsilon: The final epsilon
+    :param epsilon_start: The first epsilon of the scaling, default is a quarter of the benefit range
+    :param warm_epsilon_start: The first epsilon when the state has the prices of a previous epoch
+    :param scaling: epsilon is divided by this factor between the scaling phases
+    :param max_warm_rounds: If the first warm started phase takes more rounds, the prices are too far off
+        (the sky changed) and the problem is solved again from zero prices
+    """
+
+    obs_ind = np.asarray(obs_ind, dtype=np.int64);
+    model_ind = np.asarray(model_ind, dtype=np.int64);
+
+    if state is None:
+        state = auction_state(N_models);
+    state.resize(N_models);
+
+    #Observations and models without candidates are born and die without bidding
+    active_obs, obs_ind = np.unique(obs_ind, return_inverse=True);
+    active_models, model_ind = np.unique(model_ind, return_inverse=True);
+    n = active_obs.size;
+    m = active_models.size;
+
+    if n == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.arange(N_obs);
+
+    #Bidders: observations (0..n-1) and model dummies (n..n+m-1)
+    #Objects: models (0..m-1) and observation dummies (m..m+n-1)
+    person = np.concatenate((obs_ind, np.arange(n), n + np.arange(m), n + model_ind));
+    obj = np.concatenate((model_ind, m + np.arange(n), np.arange(m), m + obs_ind));
+    benefit = np.concatenate((unmatched_value - np.asarray(cost, dtype=float), np.zeros(n + m + obs_ind.size)));
+
+    order = np.argsort(person, kind='stable');
+    obj = obj[order];
+    benefit = benefit[order];
+    start = np.searchsorted(person[order], np.arange(n + m + 1));
+
+    #The prices are kept relative to the observation dummies, which start at zero. A price out of
+    #[0, unmatched_value] is never paid for a model, so the warm prices are clipped to this range.
+    price = np.zeros(n + m);
+    price[:m] = np.clip(state.prices[active_models], 0., unmatched_value);
+
+    if epsilon_start is None:
+        epsilon_start = max((np.amax(benefit) - np.amin(benefit)) / scaling, epsilon);
+
+    warm = state.N_solved > 0;
+    if warm:
+        eps = min(epsilon_start, max(warm_epsilon_start, epsilon));
+    else:
+        eps = epsilon_start;
+
+    #Epsilon-scaling: every phase restarts the assignment from the prices of the last one
+    N_rounds = 0;
+    while True:
+        assigned = np.full(n + m, -1, dtype=np.int64);
+        owner = np.full(n + m, -1, dtype=np.int64);
+
+        N_phase_rounds = auction_rounds(start, obj, benefit, price, eps, assigned, owner,
+                                        max_rounds=max_warm_rounds if warm else None);
+        N_rounds += N_phase_rounds;
+
+        if warm and np.any(assigned < 0):
+            log.info('Warm start abandoned after %i rounds, the auction starts from zero prices' %N_phase_rounds);
+            price[:] = 0.;
+            eps = epsilon_start;
+            warm = False;
+            continue;
+        warm = False;
+
+        if eps <= epsilon:
+            break;
+        eps = max(eps / scaling, epsilon);
+
+    log.info('Auction solved in %i rounds' %N_rounds);
+
+    state.prices[active_models] = price[:m] - np.median(price[m:]);
+    state.N_solved += 1;
+
+    matched = assigned[:n] < m;
+    observed_ind = active_obs[matched];
+    matched_model_ind = active_models[assigned[:n][matched]];
+    new_observed_ind = np.setdiff1d(np.arange(N_obs), observed_ind);
+
+    return observed_ind, matched_model_ind, new_observed_ind;
@@ -0,0 +1,246 @@
+"""
+------------------------------
+MIT License
+
+Copyright (c) 2018 Hachastron
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+------------------------------
+
+Batch matching of all epochs with friends-of-friends clustering
+
+Instead of matching the epochs one after the other, the detections of all the
+epochs are stacked and linked by one friends-of-friends query (every pair closer
+than the linking length is linked, the connected components are the groups).
+A group with at most one detection per epoch is a galaxy model. The groups with
+more detections in an epoch (close pairs or chained sources) are split by small
+local assignments against the detections of their fullest epoch.
+
+"""
+
+#=================================================
+#IMPORTS
+#=================================================
+import numpy as np;
+import glob;
+from scipy import sparse;
+from scipy.sparse.csgraph import connected_components;
+from scipy.spatial import cKDTree;
+
+from sky_model_query import *;
+
+#=================================================
+#LOGGING
+#=================================================
+import logging;
+
+log = logging.getLogger();
+log.setLevel(logging.INFO);
+
+#=================================================
+#SUPPORT FUNCTIONS
+#=================================================
+def stack_epochs(epoch_list, epoch_IDs=None):
+    """Stack the detections of the epochs into one array
+
+    Returns the (N x 7) detections and the epoch ID of each row.
+
+    :param epoch_list: List of epochs, numpy arrays already readed from .csv
+    :param epoch_IDs: The IDs of the epochs, default is their index in the list
+    """
+
+    if epoch_IDs is None:
+        epoch_IDs = np.arange(len(epoch_list));
+
+    stacked = np.concatenate([epoch[:,:7] for epoch in epoch_list], axis=0);
+    epoch = np.repeat(epoch_IDs, [e.shape[0] for e in epoch_list]);
+
+    return stacked, epoch;
+
+def friends_of_friends(RA, Dec, linking_length):
+    """Label the friends-of-friends groups: the connected components of the pairs closer than the linking length
+
+    Returns the group label of each position and the number of groups.
+
+    :param RA, Dec: The positions [deg]
+    :param linking_length: The linking length [deg]
+    """
+
+    tree = cKDTree(unit_vectors(RA, Dec));
+    pairs = tree.query_pairs(angle_to_chord(linking_length), output_type='ndarray');
+
+    graph = sparse.coo_matrix((np.ones(pairs.shape[0], dtype=bool), (pairs[:,0], pairs[:,1])), shape=(RA.size, RA.size));
+    N_groups, labels = connected_components(graph, directed=False);
+
+    log.info('%i detections linked by %i pairs into %i groups' %(RA.size, pairs.shape[0], N_groups));
+
+    return labels, N_groups;
+
+def split_group(RA, Dec, epoch, linking_length):
+    """Split a group with more than one detection per epoch into galaxy models
+
+    The detections of the fullest epoch seed the models, then the other epochs (fullest first)
+    are assigned to the running mean positions of the models one by one. A detection which is
+    not assigned within the linking length starts a new model.
+
+    Returns the model label (0..k-1) of each detection.
+
+    :param RA, Dec: The positions of the group detections [deg]
+    :param epoch: The epoch ID of the group detections
+    :param linking_length: Maximum separation of a detection from the mean position of its model [deg]
+    """
+
+    epoch_IDs, counts = np.unique(epoch, return_counts=True);
+    epoch_order = epoch_IDs[np.lexsort((epoch_IDs, -counts))];
+
+    seed = np.flatnonzero(epoch == epoch_order[0]);
+    N_models = seed.size;
+
+    labels = np.zeros(RA.size, dtype=np.int64);
+    labels[seed] = np.arange(N_models);
+
+    RA_sum = RA[seed].copy();
+    Dec_sum = Dec[seed].copy();
+    N_obs = np.ones(N_models);
+
+    for ep in epoch_order[1:]:
+        members = np.flatnonzero(epoch == ep);
+
+        sep = sky_separation(RA[members,np.newaxis], Dec[members,np.newaxis], (RA_sum / N_obs)[np.newaxis,:], (Dec_sum / N_obs)[np.newaxis,:]);
+        member_ind, model_ind = linear_sum_assignment(sep);
+
+        gated = sep[member_ind, model_ind] <= linking_length;
+        member_ind = member_ind[gated];
+        model_ind = model_ind[gated];
+
+        labels[members[member_ind]] = model_ind;
+        RA_sum[model_ind] += RA[members[member_ind]];
+        Dec_sum[model_ind] += Dec[members[member_ind]];
+        N_obs[model_ind] += 1;
+
+        #The unassigned detections start new models
+        new = np.setdiff1d(np.arange(members.size), member_ind);
+        labels[members[new]] = N_models + np.arange(new.size);
+        RA_sum = np.append(RA_sum, RA[members[new]]);
+        Dec_sum = np.append(Dec_sum, Dec[members[new]]);
+        N_obs = np.append(N_obs, np.ones(new.size));
+        N_models += new.size;
+
+    return labels;
+
+def batch_match_epochs(stacked, epoch, linking_length):
+    """Match all the epochs at once, returns the galaxy model index of each detection and the number of models
+
+    :param stacked: The stacked detections, see stack_epochs
+    :param epoch: The epoch ID of the detections
+    :param linking_length: The friends-of-friends linking length [deg]
+    """
+
+    RA = stacked[:,1];
+    Dec = stacked[:,3];
+
+    groups, N_groups = friends_of_friends(RA, Dec, linking_length);
+
+    #A group is conflicted if an epoch has more than one detection in it
+    group_epoch, group_epoch_counts = np.unique(np.column_stack((groups, epoch)), axis=0, return_counts=True);
+    conflicted = np.unique(group_epoch[group_epoch_counts > 1,0]);
+
+    #Clean groups are models as they are, the conflicted ones are split
+    labels = groups.astype(np.int64);
+
+    if conflicted.size > 0:
+        order = np.argsort(groups, kind='stable');
+        bounds = np.searchsorted(groups[order], np.arange(N_groups + 1));
+
+        N_models = N_groups;
+        for group in conflicted:
+            members = order[bounds[group]:bounds[group+1]];
+            sub_labels = split_group(RA[members], Dec[members], epoch[members], linking_length);
+
+            #Sub model 0 keeps the group label, the others get new labels
+            labels[members] = np.where(sub_labels == 0, group, N_models + sub_labels - 1);
+            N_models += np.amax(sub_labels);
+
+        log.info('%i conflicted groups split by local assignment' %conflicted.size);
+
+    #Number the models by their first detection
+    first = np.unique(labels, return_index=True)[1];
+    rank = np.empty(first.size, dtype=np.int64);
+    rank[np.argsort(first, kind='stable')] = np.arange(first.size);
+    labels = rank[np.searchsorted(np.unique(labels), labels)];
+
+    return labels, first.size;
+
+def batch_sky_model(stacked, epoch, labels):
+    """Build the sky model from the batch labels, the observations of each model are in epoch order
+
+    :param stacked: The stacked detections, see stack_epochs
+    :param epoch: The epoch ID of the detections
+    :param labels: The galaxy model index of the detections, see batch_match_epochs
+    """
+
+    order = np.lexsort((epoch, labels));
+    bounds = np.searchsorted(labels[order], np.arange(np.amax(labels) + 2));
+
+    sm = sky_model();
+
+    for model_ID in range(0, bounds.size - 1):
+        galaxy_model = model_galaxy();
+
+        for row in order[bounds[model_ID]:bounds[model_ID+1]]:
+            add_observation(galaxy_model, observed_galaxy_position(epoch=epoch[row], obs=stacked[row,:]));
+
+        add_galaxy_model(sm, galaxy_model);
+
+    return sm;
+
+def batch_tinder_for_galaxy_positions(folder=None, linking_length=0.25):
+    """Crossmatch the positions of all the epochs in the folder at once, the batch tinder_for_galaxy_positions
+
+    :param folder: The folder where the data is
+    :param linking_length: The friends-of-friends linking length [deg], it has to cover the scatter of the detections of a source (up to ~0.22 deg in ../Data/)
+    """
+
+    if folder == None:
+        folder = './Small_simulated_data/';
+
+    epoch_data_list = sorted(glob.glob("%s*.csv" %folder));
+
+    epoch_list = [np.genfromtxt(epoch,  dtype=float, delimiter=',', ndmin=2) for epoch in epoch_data_list];
+    stacked, epoch = stack_epochs(epoch_list);
+
+    labels, N_models = batch_match_epochs(stacked, epoch, linking_length);
+
+    log.info('%i detections of %i epochs matched into %i models' %(stacked.shape[0], len(epoch_list), N_models));
+
+    return batch_sky_model(stacked, epoch, labels);
+
+#=================================================
+#MAIN
+#=================================================
+if __name__ == '__main__':
+    """Test
+    """
+
+    sm = batch_tinder_for_galaxy_positions(folder='./Small_simulated_data/', linking_length=5.);
+
+    print(len(sm.galax_model_list));
+    print([len(galaxy_model.obs_list) for galaxy_model in sm.galax_model_list]);
+
+    #sm = batch_tinder_for_galaxy_positions(folder='../Data/', linking_length=0.25);
@@ -0,0 +1,257 @@
+"""
+------------------------------
+MIT License
+
+Copyright (c) 2018 Hachastron
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+------------------------------
+
+Compact storage of the epochs and the sky model
+
+The epochs are float64 matrices, the source ID and the epoch index included. The
+compact mode keeps them in NumPy record arrays: IDs and epochs as int32, the
+errors and the fluxes as float32, and the positions as float64, or as float32
+offsets from the centre of their tile. A row is 40 (36 with offsets) bytes
+instead of 64.
+
+"""
+
+#=================================================
+#IMPORTS
+#=================================================
+import numpy as np;
+
+#=================================================
+#LOGGING
+#=================================================
+import logging;
+
+log = logging.getLogger();
+log.setLevel(logging.INFO);
+
+#=================================================
+#CONSTANTS
+#=================================================
+compact_obs_dtype = np.dtype([('ID', np.int32), ('RA', np.float64), ('RA_err', np.float32),
+                              ('Dec', np.float64), ('Dec_err', np.float32),
+                              ('Flux', np.float32), ('Flux_err', np.float32), ('epoch', np.int32)]);
+
+compact_offset_obs_dtype = np.dtype([('ID', np.int32), ('tile', np.int32), ('dRA', np.float32), ('RA_err', np.float32),
+                                     ('dDec', np.float32), ('Dec_err', np.float32),
+                                     ('Flux', np.float32), ('Flux_err', np.float32), ('epoch', np.int32)]);
+
+compact_model_dtype = np.dtype([('model', np.int32)] + [(name, compact_obs_dtype[name]) for name in compact_obs_dtype.names]);
+
+epoch_column_names = ['ID', 'RA', 'RA_err', 'Dec', 'Dec_err', 'Flux', 'Flux_err'];
+
+#=================================================
+#SUPPORT FUNCTIONS
+#=================================================
+def tile_centres(tiling):
+    """Return the (RA, Dec) centre arrays of the tiles of an equal_area_tiling
+
+    :param tiling: The equal_area_tiling
+    """
+
+    RA_centre = 0.5 * (tiling.RA_edges[:-1] + tiling.RA_edges[1:]);
+    Dec_centre = 0.5 * (tiling.Dec_edges[:-1] + tiling.Dec_edges[1:]);
+
+    return np.tile(RA_centre, tiling.N_Dec), np.repeat(Dec_centre, tiling.N_RA);
+
+def compact_epoch(epoch, epoch_ID, tiling=None):
+    """Convert an epoch matrix to a compact record array
+
+    :param epoch: given epoch in a numpy array, already readed from .csv
+    :param epoch_ID: The ID (time) of the epoch
+    :param tiling: If an equal_area_tiling is given, the positions are stored as float32 offsets from the tile centres
+    """
+
+    if tiling is None:
+        records = np.zeros(epoch.shape[0], dtype=compact_obs_dtype);
+        records['RA'] = epoch[:,1];
+        records['Dec'] = epoch[:,3];
+    else:
+        records = np.zeros(epoch.shape[0], dtype=compact_offset_obs_dtype);
+        RA_centre, Dec_centre = tile_centres(tiling);
+        records['tile'] = tiling.tile_ID(epoch[:,1], epoch[:,3]);
+        records['dRA'] = epoch[:,1] - RA_centre[records['tile']];
+        records['dDec'] = epoch[:,3] - Dec_centre[records['tile']];
+
+    records['ID'] = epoch[:,0];
+    records['RA_err'] = epoch[:,2];
+    records['Dec_err'] = epoch[:,4];
+    records['Flux'] = epoch[:,5];
+    records['Flux_err'] = epoch[:,6];
+    records['epoch'] = epoch_ID;
+
+    return records;
+
+def as_float_epoch(epoch, tiling=None):
+    """Return the epoch as the usual (N x 7) float64 matrix, compact record arrays are expanded
+
+    Float matrices are returned as they are.
+
+    :param epoch: Epoch matrix or compact record array
+    :param tiling: The equal_area_tiling, needed for the offset records
+    """
+
+    if epoch.dtype.names is None:
+        return epoch;
+
+    float_epoch = np.zeros((epoch.shape[0],7));
+
+    if 'tile' in epoch.dtype.names:
+        if tiling is None:
+            raise ValueError('The tiling is needed to expand tile offset records');
+        RA_centre, Dec_centre = tile_centres(tiling);
+        float_epoch[:,1] = RA_centre[epoch['tile']] + epoch['dRA'];
+        float_epoch[:,3] = Dec_centre[epoch['tile']] + epoch['dDec'];
+        names = ['ID', None, 'RA_err', None, 'Dec_err', 'Flux', 'Flux_err'];
+    else:
+        names = epoch_column_names;
+
+    for col, name in enumerate(names):
+        if name is not None:
+            float_epoch[:,col] = epoch[name];
+
+    return float_epoch;
+
+def epoch_column(epoch, name):
+    """Return one column of an epoch by name without converting the epoch
+
+    The column of a compact record array is a view of the field in its own dtype (e.g. the
+    float32 fluxes), so the kernels read the records directly. The offset records have no
+    absolute positions, expand them with as_float_epoch.
+
+    :param epoch: Epoch matrix or compact record array
+    :param name: The column name, see epoch_column_names
+    """
+
+    if epoch.dtype.names is None:
+        return epoch[:,epoch_column_names.index(name)];
+
+    if name not in epoch.dtype.names:
+        raise ValueError('The records have no %s field, expand them with as_float_epoch' %name);
+
+    return epoch[name];
+
+def compact_sky_model(sm):
+    """Converts the sky model to one compact record array, the compact version of human_readable_sky_model
+
+    The rows are sorted by model index and by the order of the observations in the models, the
+    'model' field holds the index of the galaxy model.
+
+    :param sm: Sky model
+    """
+
+    N_rows = sum([len(galaxy_model.obs_list) for galaxy_model in sm.galax_model_list]);
+
+    records = np.zeros(N_rows, dtype=compact_model_dtype);
+
+    row = 0;
+    for model_ID, galaxy_model in enumerate(sm.galax_model_list):
+        for obs in galaxy_model.obs_list:
+            records[row] = (model_ID, obs.ID, obs.RA, obs.RA_err, obs.Dec, obs.Dec_err, obs.Flux, obs.Flux_err, obs.epoch);
+            row += 1;
+
+    return records;
+
+def compact_model_rows(compact_sm, model_index):
+    """Return the rows of one galaxy model from the compact sky model (a view, no copy)
+
+    :param compact_sm: Sky model from compact_sky_model
+    :param model_index: The index of the galaxy model
+    """
+
+    lo, hi = np.searchsorted(compact_sm['model'], [model_index, model_index + 1]);
+
+    return compact_sm[lo:hi];
+
+def compact_model_columns(compact_sm, model_index):
+    """Return the data columns of the galaxy model (given by index), the compact get_model_columns
+
+    :param compact_sm: Sky model from compact_sky_model
+    :param model_index: The index of the galaxy model
+    """
+
+    rows = compact_model_rows(compact_sm, model_index);
+
+    return tuple([rows[name] for name in epoch_column_names + ['epoch']]);
+
+def save_compact_sky_model(compact_sm, path):
+    """Save the compact sky model into one binary .npy file
+
+    :param compact_sm: Sky model from compact_sky_model
+    :param path: The output file
+    """
+
+    np.save(path, compact_sm);
+
+def history_records(observed_epoch, epoch_ID, rows, model_ind):
+    """Return the compact sky model records (compact_model_dtype) of the observations assigned to the models
+
+    :param observed_epoch: given epoch in a numpy array, already readed from .csv, or a compact record array
+    :param epoch_ID: The ID (time) of the epoch
+    :param rows: The rows of the assigned observations
+    :param model_ind: The galaxy model index of the rows
+    """
+
+    records = np.zeros(np.size(rows), dtype=compact_model_dtype);
+    records['model'] = model_ind;
+    for name in epoch_column_names:
+        records[name] = epoch_column(observed_epoch, name)[rows];
+    records['epoch'] = epoch_ID;
+
+    return records;
+
+def append_history(path, records, fresh=False):
+    """Append compact sky model records to a binary history file (sequential write, the full history of a windowed sky model)
+
+    :param path: The history file
+    :param records: Records of compact_model_dtype, see history_records
+    :param fresh: Truncate the file first, a new sky model starts a new history
+    """
+
+    with open(path, 'wb' if fresh else 'ab') as f:
+        np.asarray(records, dtype=compact_model_dtype).tofile(f);
+
+def read_history(path):
+    """Read a history file back as a compact sky model (sorted by model, in the order of the observations)
+
+    :param path: The history file
+    """
+
+    records = np.fromfile(path, dtype=compact_model_dtype);
+
+    return records[np.argsort(records['model'], kind='stable')];
+
+#=================================================
+#MAIN
+#=================================================
+if __name__ == '__main__':
+    """Test
+    """
+
+    epoch = np.genfromtxt('../Data/epoch00.csv',  dtype=float, delimiter=',',  skip_header=1);
+
+    records = compact_epoch(epoch, 0);
+
+    print('float64 epoch: %i bytes, compact epoch: %i bytes' %(epoch.nbytes, records.nbytes));
+    print('Max position error: %e deg' %np.amax(np.fabs(as_float_epoch(records)[:,[1,3]] - epoch[:,[1,3]])));
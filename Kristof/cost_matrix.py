@@ -32,9 +32,14 @@ Cost matrix for the Hungarian algorithm
 #=================================================
 import numpy as np;
 from scipy import stats;
+import os;
+import tempfile;
 
 from position_model import *;
 from sky_model import *;
+from zones import *;
+from compact_storage import *;
+from kernels import pair_cost_kernel, block_cost_kernel;
 
 #=================================================
 #LOGGING
@@ -44,6 +49,11 @@ import logging;
 log = logging.getLogger();
 log.setLevel(logging.INFO);
 
+#=================================================
+#CONSTANTS
+#=================================================
+gated_cost = 1e3;#Cost of the observation - model pairs outside the gating radius, the worst real cost is 2
+
 #=================================================
 #SUPPORT FUNCTIONS
 #=================================================
@@ -53,23 +63,27 @@ def add_galaxy_model(initial_sky_model,model_galaxy):
     :param initial_sky_model: The sky model
     :param model_galaxy: The model of a 'real galaxy' consist a bunch of observations
     """
+    if getattr(initial_sky_model, 'window', None) is not None or getattr(initial_sky_model, 'decay', None) is not None:
+        model_galaxy.set_window(initial_sky_model.window, initial_sky_model.decay);
+    
     initial_sky_model.galax_model_list.append(model_galaxy);
     
     return initial_sky_model;
 
-def create_initial_sky_model(epoch_ID, epoch):
+def create_initial_sky_model(epoch_ID, epoch, window=None, decay=None, history_file=None):
     """Create an initial sky model using a given epoch
 
     :param epoch_ID: The ID (time) of a given epoch
     :param epoch: given epoch in a numpy array, already readed from .csv
+    :param window: The galaxy models keep only their last window observations, see sky_model
+    :param decay: Exponential decay factor per epoch of the observation weights, see sky_model
+    :param history_file: The full history of the observations is written to this binary file (truncated first), see sky_model
     """
     
-    sm = sky_model();
+    sm = sky_model(window=window, decay=decay, history_file=history_file);
     
-    observed_galaxy_ID = epoch[:,0];
-    
-    for i in observed_galaxy_ID:
-        observed_galaxy = observed_galaxy_position(epoch=epoch_ID, obs=galaxy_obs(epoch, i));
+    for i in range(0,epoch.shape[0]):
+        observed_galaxy = observed_galaxy_position(epoch=epoch_ID, obs=epoch[i,:]);
         
         galaxy_model = model_galaxy();
         
@@ -77,6 +91,9 @@ def create_initial_sky_model(epoch_ID, epoch):
     
         add_galaxy_model(sm,galaxy_model);
     
+    if history_file is not None:
+        append_history(history_file, history_records(epoch, epoch_ID, np.arange(epoch.shape[0]), np.arange(epoch.shape[0])), fresh=True);
+    
     return sm;
 
 def distance(a,b):
@@ -89,23 +106,301 @@ def distance(a,b):
 
     return dist;
 
-def compute_cost_matrix(sm,observed_epoch,epoch_ID):
-    """Compute the cost matrix for the Hungarian algorithm
+def sky_model_positions(sm):
+    """Return the RA and Dec arrays of the galaxy models in the sky model
+
+    :param sm: Sky model
+    """
+
+    positions = np.array([galaxy_model.sky_position for galaxy_model in sm.galax_model_list]).reshape(-1,2);
+
+    return positions[:,0], positions[:,1];
+
+def sky_model_statistics(sm):
+    """Snapshot of the gaussians of all galaxy models, build it once per epoch
+    
+    Returns a (N_models x 6) array, the columns are RA_mu, RA_sigma, Dec_mu, Dec_sigma, Flux_mu, Flux_sigma
+    
+    :param sm: Sky model
+    """
+    
+    statistics = np.zeros((len(sm.galax_model_list),6));
+    
+    for j, galaxy_model in enumerate(sm.galax_model_list):
+        statistics[j,0:2] = galaxy_model.RA_pdf;
+        statistics[j,2:4] = galaxy_model.Dec_pdf;
+        statistics[j,4:6] = galaxy_model.Flux_pdf;
+    
+    return statistics;
+
+def pair_costs(statistics, observed_epoch, model_ind, obs_ind):
+    """The cost (averaged p-value, see p_value_of_observation) of the given observation - model pairs
+    
+    :param statistics: Model statistics from sky_model_statistics
+    :param observed_epoch: given epoch in a numpy array, already readed from .csv, or a compact record array
+    :param model_ind: Model index of the pairs
+    :param obs_ind: Observation (row) index of the pairs
+    """
+    
+    return pair_cost_kernel(epoch_column(observed_epoch, 'RA')[obs_ind], epoch_column(observed_epoch, 'Dec')[obs_ind],
+                            epoch_column(observed_epoch, 'Flux')[obs_ind], statistics, model_ind);
+
+def compute_gated_cost_pairs(sm, observed_epoch, epoch_ID, gating_radius=None, chi2_threshold=None, flux_sigma=None):
+    """Compute the cost of the model - observation pairs closer than the gating radius (sparse cost matrix)
+    
+    With a chi-square threshold the pairs are also gated by their error ellipses: the model
+    position sigma and the observed RA_err/Dec_err are combined, see pair_chi2. Without a
+    gating radius the search radius is the largest one the threshold allows.
+    
+    With flux_sigma the pairs whose fluxes differ by more than flux_sigma combined errors (model
+    Flux sigma and observed Flux_err) are dropped before their cost is computed, see pair_flux_sigma.
+    
+    Returns the observation index, the model index and the cost of the pairs.
     
     :param sm: Sky model
-    :param observed_epoch: given epoch in a numpy array, already readed from .csv
+    :param observed_epoch: given epoch in a numpy array, already readed from .csv, or a compact record array
     :param epoch_ID: The ID pf the observed epoch
+    :param gating_radius: The gating radius [deg], one value or one for each observation (see adaptive_gating_radius)
+    :param chi2_threshold: The chi-square threshold of the pairs, None does not gate by the errors
+    :param flux_sigma: The flux gate of the pairs in combined flux errors, None does not gate by the flux
     """
-    #Create cost matrix
-    assert observed_epoch.shape[0] == len(sm.galax_model_list), "Discrepancy model- and observed galaxy number"
+    model_RA, model_Dec = sky_model_positions(sm);
+    statistics = sky_model_statistics(sm);
+    
+    #The columns are read from the epoch as they are, compact records are not converted
+    obs_RA, obs_RA_err, obs_Dec, obs_Dec_err, obs_Flux, obs_Flux_err = [epoch_column(observed_epoch, name) for name in epoch_column_names[1:]];
+    
+    if gating_radius is None:
+        gating_radius = chi2_search_radius(statistics[:,1], statistics[:,3], obs_RA_err, obs_Dec_err, chi2_threshold);
+    
+    pair_stream = zone_candidate_pairs(model_RA, model_Dec, obs_RA, obs_Dec, gating_radius);
+    
+    if chi2_threshold is not None:
+        pair_stream = chi2_gated_pairs(pair_stream, statistics[:,0], statistics[:,2], statistics[:,1], statistics[:,3],
+                                       obs_RA, obs_Dec, obs_RA_err, obs_Dec_err, chi2_threshold);
+    
+    if flux_sigma is not None:
+        pair_stream = flux_gated_pairs(pair_stream, statistics[:,4], statistics[:,5], obs_Flux, obs_Flux_err, flux_sigma);
+    
+    obs_pairs = [];
+    model_pairs = [];
+    cost_pairs = [];
+    for model_ind, obs_ind, sep in pair_stream:
+        obs_pairs.append(obs_ind);
+        model_pairs.append(model_ind);
+        cost_pairs.append(pair_costs(statistics, observed_epoch, model_ind, obs_ind));
+        
+        log.info('Cost matrix zone computed');
+    
+    if len(cost_pairs) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0);
+    
+    return np.concatenate(obs_pairs), np.concatenate(model_pairs), np.concatenate(cost_pairs);
 
+def compute_gated_cost_matrix(sm, observed_epoch, epoch_ID, gating_radius=None, chi2_threshold=None, flux_sigma=None):
+    """Compute the cost matrix only for the model - observation pairs closer than the gating radius
+    
+    The candidate pairs are found by the declination-zone engine, the other elements are gated_cost
+    
+    :param sm: Sky model
+    :param observed_epoch: given epoch in a numpy array, already readed from .csv, or a compact record array
+    :param epoch_ID: The ID pf the observed epoch
+    :param gating_radius: The gating radius [deg], one value or one for each observation
+    :param chi2_threshold: The chi-square threshold of the pairs, see compute_gated_cost_pairs
+    :param flux_sigma: The flux gate of the pairs in combined flux errors, see compute_gated_cost_pairs
+    """
+    cost_matrix = np.full((observed_epoch.shape[0],len(sm.galax_model_list)), gated_cost);#Rows are observations, columns are models
+    
+    obs_ind, model_ind, cost = compute_gated_cost_pairs(sm, observed_epoch, epoch_ID, gating_radius, chi2_threshold, flux_sigma);
+    cost_matrix[obs_ind,model_ind] = cost;
+    
+    return cost_matrix;
+
+def dense_cost_matrix_memory(N_obs, N_models, block_size=None, dtype=np.float64):
+    """Return the memory budget [bytes] of the dense cost matrix and of one block of temporaries
+    
+    :param N_obs: Number of observations
+    :param N_models: Number of models
+    :param block_size: Block size of compute_blocked_cost_matrix
+    :param dtype: dtype of the cost matrix
+    """
+    
+    matrix_bytes = N_obs * N_models * np.dtype(dtype).itemsize;
+    
+    if block_size is None:
+        block_bytes = 0;
+    else:
+        block_bytes = 12 * min(block_size, N_obs) * min(block_size, N_models) * 8;#~12 float64 temporaries in vectorized_p_value
+    
+    return matrix_bytes, block_bytes;
+
+def compute_blocked_cost_matrix(sm, observed_epoch, epoch_ID, block_size=1024, memmap_file=None, max_memory=None, dtype=np.float64):
+    """Compute the full (ungated) cost matrix block by block with the vectorized (or Numba compiled) p-value
+    
+    The memory budget is logged before anything is allocated. The matrix can live in a
+    memory-mapped .npy file, which is used automatically when it would not fit in max_memory.
+    The automatic file is temporary, delete it with release_cost_matrix once the matrix is solved.
+    
+    :param sm: Sky model
+    :param observed_epoch: given epoch in a numpy array, already readed from .csv, or a compact record array
+    :param epoch_ID: The ID pf the observed epoch
+    :param block_size: The cost matrix is computed in (block_size x block_size) blocks
+    :param memmap_file: Write the matrix into this .npy file through a memory map
+    :param max_memory: Memory limit [bytes] of the in-memory matrix, above it a temporary memory map is used
+    :param dtype: dtype of the cost matrix
+    """
+    N_obs = observed_epoch.shape[0];
+    N_models = len(sm.galax_model_list);
+    
+    matrix_bytes, block_bytes = dense_cost_matrix_memory(N_obs, N_models, block_size=block_size, dtype=dtype);
+    log.info('Dense cost matrix: %i x %i, %.1f MB + %.1f MB per block' %(N_obs, N_models, matrix_bytes / 2.**20, block_bytes / 2.**20));
+    
+    if memmap_file is None and max_memory is not None and matrix_bytes > max_memory:
+        handle, temporary_file = tempfile.mkstemp(prefix='cost_matrix_', suffix='.npy');
+        os.close(handle);
+        log.warning('The cost matrix does not fit in %.1f MB, it is memory-mapped to %s' %(max_memory / 2.**20, temporary_file));
+        
+        cost_matrix = np.lib.format.open_memmap(temporary_file, mode='w+', dtype=dtype, shape=(N_obs, N_models));
+        cost_matrix.temporary_file = temporary_file;
+    elif memmap_file is None:
+        cost_matrix = np.empty((N_obs, N_models), dtype=dtype);
+    else:
+        cost_matrix = np.lib.format.open_memmap(memmap_file, mode='w+', dtype=dtype, shape=(N_obs, N_models));
+    
+    statistics = sky_model_statistics(sm);
+    
+    obs_RA, obs_Dec, obs_Flux = epoch_column(observed_epoch, 'RA'), epoch_column(observed_epoch, 'Dec'), epoch_column(observed_epoch, 'Flux');
+    
+    for r0 in range(0, N_obs, block_size):
+        r1 = min(r0 + block_size, N_obs);
+        for c0 in range(0, N_models, block_size):
+            c1 = min(c0 + block_size, N_models);
+            
+            cost_matrix[r0:r1,c0:c1] = block_cost_kernel(obs_RA[r0:r1], obs_Dec[r0:r1], obs_Flux[r0:r1], statistics[c0:c1,:]);
+        
+        log.info('Cost matrix block row computed');
+    
+    if isinstance(cost_matrix, np.memmap):
+        cost_matrix.flush();
+    
+    return cost_matrix;
+
+def release_cost_matrix(cost_matrix):
+    """Delete the temporary memory-mapped file of a cost matrix, see compute_blocked_cost_matrix
+    
+    The files given by memmap_file are kept. On POSIX the disk space is freed when the last
+    reference to the matrix is dropped.
+    
+    :param cost_matrix: The cost matrix
+    """
+    temporary_file = getattr(cost_matrix, 'temporary_file', None);
+    
+    if temporary_file is not None and os.path.exists(temporary_file):
+        try:
+            os.remove(temporary_file);
+        except OSError:
+            log.warning('The temporary cost matrix %s could not be deleted' %temporary_file);
+
+def flux_gate_cost_matrix(cost_matrix, sm, observed_epoch, flux_sigma, block_size=1024):
+    """Set the elements of the pairs with implausible fluxes to gated_cost in a full cost matrix, in place
+    
+    The dense version of flux_gated_pairs, computed in row blocks to bound the temporaries.
+    
+    :param cost_matrix: The full cost matrix, rows are observations, columns are models
+    :param sm: Sky model
+    :param observed_epoch: given epoch in a numpy array, already readed from .csv, or a compact record array
+    :param flux_sigma: The flux gate of the pairs in combined flux errors, see pair_flux_sigma
+    :param block_size: Number of rows per block
+    """
+    statistics = sky_model_statistics(sm);
+    obs_Flux, obs_Flux_err = epoch_column(observed_epoch, 'Flux'), epoch_column(observed_epoch, 'Flux_err');
+    
+    for r0 in range(0, cost_matrix.shape[0], block_size):
+        r1 = min(r0 + block_size, cost_matrix.shape[0]);
+        
+        gated = pair_flux_sigma(statistics[np.newaxis,:,4], statistics[np.newaxis,:,5],
+                                obs_Flux[r0:r1,np.newaxis], obs_Flux_err[r0:r1,np.newaxis]) > flux_sigma;
+        cost_matrix[r0:r1][gated] = gated_cost;
+    
+    return cost_matrix;
+
+def reduce_cost_matrix(cost_matrix, reduction, block_size=1024):
+    """Replace the full cost matrix by the reduced cost min(c - reduction, 0), in place
+    
+    Computed in row blocks, so a memory-mapped matrix is not loaded into memory, see solve_assignment.
+    
+    :param cost_matrix: The full cost matrix, rows are observations, columns are models
+    :param reduction: The subtracted cost, birth_cost + death_cost
+    :param block_size: Number of rows per block
+    """
+    for r0 in range(0, cost_matrix.shape[0], block_size):
+        block = cost_matrix[r0:r0 + block_size];
+        block -= reduction;
+        np.minimum(block, 0., out=block);
+    
+    if isinstance(cost_matrix, np.memmap):
+        cost_matrix.flush();
+    
+    return cost_matrix;
+
+def cost_matrix_pairs(cost_matrix, block_size=1024):
+    """Return the pairs of a full cost matrix inside the gate (cost below gated_cost), the sparse form of compute_gated_cost_pairs
+    
+    Computed in row blocks, so only the pairs are held in memory.
+    
+    :param cost_matrix: The full cost matrix, rows are observations, columns are models
+    :param block_size: Number of rows per block
+    """
+    obs_ind, model_ind, cost = [], [], [];
+    
+    for r0 in range(0, cost_matrix.shape[0], block_size):
+        block = np.asarray(cost_matrix[r0:r0 + block_size]);
+        block_obs_ind, block_model_ind = np.nonzero(block < gated_cost);
+        
+        obs_ind.append(block_obs_ind + r0);
+        model_ind.append(block_model_ind);
+        cost.append(block[block_obs_ind, block_model_ind]);
+    
+    if len(cost) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0);
+    
+    return np.concatenate(obs_ind), np.concatenate(model_ind), np.concatenate(cost);
+
+def compute_cost_matrix(sm,observed_epoch,epoch_ID,gating_radius=None,block_size=None,chi2_threshold=None,flux_sigma=None,
+                        max_memory=None,memmap_file=None):
+    """Compute the cost matrix for the Hungarian algorithm
+    
+    :param sm: Sky model
+    :param observed_epoch: given epoch in a numpy array, already readed from .csv, or a compact record array
+    :param epoch_ID: The ID pf the observed epoch
+    :param gating_radius: If given only the pairs closer than this radius [deg] are evaluated, see compute_gated_cost_matrix
+    :param block_size: If given the full matrix is computed in blocks, see compute_blocked_cost_matrix
+    :param chi2_threshold: If given only the pairs below this chi-square separation are evaluated, see compute_gated_cost_pairs
+    :param flux_sigma: The pairs with implausible fluxes are gated_cost, with the gating they are not evaluated, see compute_gated_cost_pairs
+    :param max_memory: Memory limit [bytes] of the full matrix, above it the matrix is memory-mapped, see compute_blocked_cost_matrix
+    :param memmap_file: Write the full matrix into this .npy file through a memory map
+    """
+    if gating_radius is not None or chi2_threshold is not None:
+        return compute_gated_cost_matrix(sm, observed_epoch, epoch_ID, gating_radius, chi2_threshold, flux_sigma);
+    
+    if block_size is not None or max_memory is not None or memmap_file is not None:
+        cost_matrix = compute_blocked_cost_matrix(sm, observed_epoch, epoch_ID, block_size=block_size or 1024, memmap_file=memmap_file,
+                                                  max_memory=max_memory);
+        
+        if flux_sigma is not None:
+            flux_gate_cost_matrix(cost_matrix, sm, observed_epoch, flux_sigma, block_size=block_size or 1024);
+        
+        return cost_matrix;
+    
+    #Create cost matrix, rectangular matrices are solved by solve_assignment
     cost_matrix = np.zeros((observed_epoch.shape[0],len(sm.galax_model_list)));#Rows are observations, columns are models
     
     j = 0;
-    observed_galaxy_ID = observed_epoch[:,0];
+    observed_RA = epoch_column(observed_epoch, 'RA');
+    observed_Dec = epoch_column(observed_epoch, 'Dec');
+    observed_Flux = epoch_column(observed_epoch, 'Flux');
     for galaxy_model in sm.galax_model_list:
-        i = 0;
-        for g_id in observed_galaxy_ID:
+        for i in range(0,observed_epoch.shape[0]):
             
             """Possible spped up ==> but it make the algorith worst
             if distance(galaxy_model.sky_position,
@@ -116,13 +411,14 @@ def compute_cost_matrix(sm,observed_epoch,epoch_ID):
                 cost_matrix[i,j] = p_value_of_observation(galaxy_model,observed_galaxy_position(epoch=epoch_ID, obs=galaxy_obs(observed_epoch, g_id)));
             """
            
-            cost_matrix[i,j] = p_value_of_observation(galaxy_model,observed_galaxy_position(epoch=epoch_ID, obs=galaxy_obs(observed_epoch, g_id)));
-           
-            i += 1;
+            cost_matrix[i,j] = p_value_of_values(galaxy_model, observed_RA[i], observed_Dec[i], observed_Flux[i]);
             
             log.info('Cost matrix row computed');
             
         j += 1;
+    
+    if flux_sigma is not None:
+        flux_gate_cost_matrix(cost_matrix, sm, observed_epoch, flux_sigma);
             
     return cost_matrix;
 
@@ -0,0 +1,425 @@
+"""
+------------------------------
+MIT License
+
+Copyright (c) 2018 Hachastron
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+------------------------------
+
+Local crossmatch service
+
+A long running process keeps the sky model and its spatial index in memory and
+serves JSON requests over HTTP on localhost or on a Unix socket:
+
+    GET  /status                                         -> number of models and epochs
+    POST /query  {"RA": [..], "Dec": [..], "radius": r, "mode": "cone" | "nearest"}
+    POST /epoch  {"path": "epoch.csv" | "rows": [[..], ..], "epoch_ID": optional}
+
+An epoch path must resolve inside the data folder of the service, the rows of an
+epoch can be sent in the request body instead.
+
+All requests go through one queue. A single worker thread merges the queued
+queries into one vectorized index query (micro-batching) and applies the epochs
+in the order they arrived, so the model is never updated during a query.
+
+"""
+
+#=================================================
+#IMPORTS
+#=================================================
+import numpy as np;
+import json;
+import os;
+import queue;
+import socket;
+import threading;
+import time;
+import urllib.request;
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer;
+
+from sky_model_query import *;
+
+#=================================================
+#LOGGING
+#=================================================
+import logging;
+
+log = logging.getLogger();
+log.setLevel(logging.INFO);
+
+#=================================================
+#CLASSES
+#=================================================
+class service_request(object):
+    """A request waiting in the service queue
+    """
+
+    def __init__(self, kind, payload):
+        """Class attributes
+
+        :param kind: 'query' or 'epoch'
+        :param payload: The decoded JSON body
+        """
+
+        self.kind = kind;
+        self.payload = payload;
+        self.done = threading.Event();
+        self.result = None;
+        self.error = None;
+
+    def finish(self, result=None, error=None):
+        """Set the result and wake up the waiting HTTP thread
+
+        :param result: The JSON serializable answer
+        :param error: The exception raised while serving the request
+        """
+
+        self.result = result;
+        self.error = error;
+        self.done.set();
+
+class crossmatch_service(object):
+    """Sky model kept hot in memory with a micro-batching request queue
+    """
+
+    def __init__(self, sm, epoch_ID=0, gating_radius=0.05, max_batch=256, max_delay=0.005, data_folder=None):
+        """Class attributes
+
+        :param sm: The sky model
+        :param epoch_ID: The ID of the last epoch in the sky model
+        :param gating_radius: Gating radius [deg] used when new epochs are matched
+        :param max_batch: Maximum number of queued queries merged into one index query
+        :param max_delay: Time [s] the worker waits for more queries before running a batch
+        :param data_folder: The epoch files are read only from this folder, None accepts only the rows in the request body
+        """
+
+        self.sm = sm;
+        self.epoch_ID = epoch_ID;
+        self.gating_radius = gating_radius;
+        self.max_batch = max_batch;
+        self.max_delay = max_delay;
+        self.data_folder = None if data_folder is None else os.path.realpath(data_folder);
+
+        self.index = sky_model_index(sm);
+        self.requests = queue.Queue();
+
+        self.worker = threading.Thread(target=self.batch_loop, daemon=True);
+        self.worker.start();
+
+    def submit(self, kind, payload, timeout=None):
+        """Put a request into the queue and wait for its result
+
+        :param kind: 'query' or 'epoch'
+        :param payload: The decoded JSON body
+        :param timeout: Maximum waiting time [s]
+        """
+
+        request = service_request(kind, payload);
+        self.requests.put(request);
+
+        if not request.done.wait(timeout):
+            raise TimeoutError('Request not served in time');
+        if request.error is not None:
+            raise request.error;
+
+        return request.result;
+
+    def status(self):
+        """Return the service status
+        """
+        return {'N_models': self.index.N_models, 'epoch_ID': self.epoch_ID, 'queued': self.requests.qsize()};
+
+    def batch_loop(self):
+        """Worker thread: serve the queue, merging consecutive queries into batches
+        """
+
+        pending = None;
+
+        while True:
+            request = pending if pending is not None else self.requests.get();
+            pending = None;
+
+            if request.kind == 'epoch':
+                self.serve(self.ingest_epoch, request);
+                continue;
+
+            #Collect queries until the batch is full, the delay expires or an epoch arrives
+            batch = [request];
+            deadline = time.time() + self.max_delay;
+            while len(batch) < self.max_batch:
+                try:
+                    request = self.requests.get(timeout=max(deadline - time.time(), 0));
+                except queue.Empty:
+                    break;
+                if request.kind != 'query':
+                    pending = request;
+                    break;
+                batch.append(request);
+
+            self.serve_query_batch(batch);
+
+    def serve(self, function, request):
+        """Run function on the request payload and finish the request
+
+        :param function: Function of the payload
+        :param request: The service_request
+        """
+
+        try:
+            request.finish(result=function(request.payload));
+        except Exception as e:
+            log.exception('Request failed');
+            request.finish(error=e);
+
+    def parse_query(self, payload):
+        """Return the mode, RA, Dec and radius arrays of a query payload, raise ValueError if it is malformed
+
+        :param payload: The decoded JSON body of the query
+        """
+
+        if not isinstance(payload, dict):
+            raise ValueError('The query is not a JSON object');
+
+        mode = payload.get('mode', 'cone');
+        if mode not in ['cone', 'nearest']:
+            raise ValueError('Unknown query mode: %s' %mode);
+
+        for key in ['RA', 'Dec']:
+            if key not in payload:
+                raise ValueError('Missing %s in the query' %key);
+
+        RA = np.atleast_1d(np.asarray(payload['RA'], dtype=float));
+        Dec = np.atleast_1d(np.asarray(payload['Dec'], dtype=float));
+        if RA.ndim != 1 or RA.shape != Dec.shape:
+            raise ValueError('RA and Dec of the query are not 1D arrays of the same size');
+
+        try:
+            radius = np.broadcast_to(np.asarray(payload.get('radius', np.inf), dtype=float), RA.shape);
+        except ValueError:
+            raise ValueError('The radius of the query does not match its positions');
+
+        return mode, RA, Dec, radius;
+
+    def serve_query_batch(self, batch):
+        """Answer a batch of queries with one index query per mode
+
+        Each request is parsed on its own, a malformed one fails alone and the others are batched.
+
+        :param batch: List of query service_request
+        """
+
+        parsed = {'cone': [], 'nearest': []};
+        for r in batch:
+            try:
+                mode, RA, Dec, radius = self.parse_query(r.payload);
+            except (ValueError, TypeError) as e:
+                r.finish(error=e);
+                continue;
+            parsed[mode].append((r, RA, Dec, radius));
+
+        for mode in ['cone', 'nearest']:
+            if len(parsed[mode]) == 0:
+                continue;
+
+            requests = [p[0] for p in parsed[mode]];
+
+            try:
+                offsets = np.cumsum([0] + [p[1].size for p in parsed[mode]]);
+
+                RA = np.concatenate([p[1] for p in parsed[mode]]);
+                Dec = np.concatenate([p[2] for p in parsed[mode]]);
+                radius = np.concatenate([p[3] for p in parsed[mode]]);
+
+                if mode == 'cone':
+                    query_index, model_index, separation = self.index.cone_search(RA, Dec, radius);
+                    bounds = np.searchsorted(query_index, offsets);
+
+                    for k, r in enumerate(requests):
+                        q = query_index[bounds[k]:bounds[k+1]] - offsets[k];
+                        m = model_index[bounds[k]:bounds[k+1]];
+                        s = separation[bounds[k]:bounds[k+1]];
+                        r.finish(result={'query_index': q.tolist(), 'model_index': m.tolist(), 'separation': s.tolist()});
+                else:
+                    model_index = np.full(RA.size, -1, dtype=np.int64);
+                    separation = np.full(RA.size, np.inf);
+
+                    #The tree takes a single upper bound, so the batch is split by radius
+                    for value in np.unique(radius):
+                        select = radius == value;
+                        m, s = self.index.nearest_model(RA[select], Dec[select], k=1, max_radius=value);
+                        model_index[select] = m[:,0];
+                        separation[select] = s[:,0];
+
+                    for k, r in enumerate(requests):
+                        s = separation[offsets[k]:offsets[k+1]];
+                        r.finish(result={'model_index': model_index[offsets[k]:offsets[k+1]].tolist(),
+                                         'separation': np.where(np.isfinite(s), s, -1.).tolist()});
+            except Exception as e:
+                log.exception('Query batch failed');
+                for r in requests:
+                    if not r.done.is_set():
+                        r.finish(error=e);
+
+        log.info('Query batch of %i requests served' %len(batch));
+
+    def epoch_path(self, path):
+        """Return the real path of an epoch file, raise ValueError if it is not inside the data folder
+
+        :param path: The epoch file, relative to the data folder or absolute
+        """
+
+        if self.data_folder is None:
+            raise ValueError('The service has no data folder, send the epoch rows instead');
+
+        real_path = os.path.realpath(os.path.join(self.data_folder, path));
+        if os.path.commonpath([real_path, self.data_folder]) != self.data_folder:
+            raise ValueError('The epoch file is outside the data folder');
+
+        return real_path;
+
+    def ingest_epoch(self, payload):
+        """Match a new epoch into the sky model and rebuild the index
+
+        :param payload: {"path": epoch file in the data folder, or "rows": the epoch rows, "epoch_ID": optional ID, default is the next epoch}
+        """
+
+        if 'rows' in payload:
+            epoch = np.asarray(payload['rows'], dtype=float).reshape(-1,7);
+        else:
+            epoch = np.genfromtxt(self.epoch_path(payload['path']),  dtype=float, delimiter=',');
+        epoch_ID = int(payload.get('epoch_ID', self.epoch_ID + 1));
+
+        self.sm = solve_matching_for_galaxy_positions(self.sm, epoch, epoch_ID, gating_radius=self.gating_radius);
+        self.epoch_ID = epoch_ID;
+        self.index = sky_model_index(self.sm);
+
+        log.info("Epoch %i solved" %epoch_ID);
+
+        return {'epoch_ID': epoch_ID, 'N_models': self.index.N_models};
+
+class service_request_handler(BaseHTTPRequestHandler):
+    """HTTP front end of the crossmatch_service (self.server.service)
+    """
+
+    def send_json(self, code, body):
+        """Send a JSON response
+        """
+        data = json.dumps(body).encode();
+        self.send_response(code);
+        self.send_header('Content-Type', 'application/json');
+        self.send_header('Content-Length', str(len(data)));
+        self.end_headers();
+        self.wfile.write(data);
+
+    def do_GET(self):
+        """Status request
+        """
+        if self.path == '/status':
+            self.send_json(200, self.server.service.status());
+        else:
+            self.send_json(404, {'error': 'Unknown path'});
+
+    def do_POST(self):
+        """Query and epoch requests, the answer is sent when the worker thread served the request
+        """
+        kind = self.path.strip('/');
+        if kind not in ['query', 'epoch']:
+            self.send_json(404, {'error': 'Unknown path'});
+            return;
+
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}');
+            self.send_json(200, self.server.service.submit(kind, payload));
+        except Exception as e:
+            self.send_json(400, {'error': repr(e)});
+
+    def log_message(self, format, *args):
+        """Send the access log to the logger instead of stderr
+        """
+        log.debug(format %args);
+
+class unix_http_server(ThreadingHTTPServer):
+    """ThreadingHTTPServer listening on a Unix socket
+    """
+
+    address_family = socket.AF_UNIX;
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address);
+        self.socket.bind(self.server_address);
+        self.server_name = 'localhost';
+        self.server_port = 0;
+
+    def get_request(self):
+        request, client_address = self.socket.accept();
+        return request, ('localhost', 0);
+
+#=================================================
+#SUPPORT FUNCTIONS
+#=================================================
+def create_server(service, host='127.0.0.1', port=8642, socket_path=None):
+    """Create the HTTP server of a service, call serve_forever() on the result
+
+    :param service: The crossmatch_service
+    :param host: Host for TCP, keep it local
+    :param port: TCP port, 0 picks a free one
+    :param socket_path: Listen on this Unix socket instead of TCP
+    """
+
+    if socket_path is not None:
+        server = unix_http_server(socket_path, service_request_handler);
+    else:
+        server = ThreadingHTTPServer((host, port), service_request_handler);
+
+    server.service = service;
+
+    return server;
+
+def query_service(url, RA, Dec, radius, mode='cone'):
+    """Send a query to a running TCP service and return the decoded answer
+
+    :param url: Base url, e.g. http://127.0.0.1:8642
+    :param RA, Dec: Query positions [deg]
+    :param radius: Search radius [deg]
+    :param mode: 'cone' or 'nearest'
+    """
+
+    body = json.dumps({'RA': np.atleast_1d(RA).tolist(), 'Dec': np.atleast_1d(Dec).tolist(),
+                       'radius': np.asarray(radius).tolist(), 'mode': mode}).encode();
+    request = urllib.request.Request('%s/query' %url, data=body, headers={'Content-Type': 'application/json'});
+
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read());
+
+#=================================================
+#MAIN
+#=================================================
+if __name__ == '__main__':
+    """Serve the small simulated dataset
+    """
+
+    sm = tinder_for_galaxy_positions();
+
+    service = crossmatch_service(sm, epoch_ID=49, gating_radius=5., data_folder='./Small_simulated_data/');
+    server = create_server(service);
+
+    print('Serving on http://127.0.0.1:%i' %server.server_port);
+    server.serve_forever();
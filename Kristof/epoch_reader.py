@@ -0,0 +1,275 @@
+"""
+------------------------------
+MIT License
+
+Copyright (c) 2018 Hachastron
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+------------------------------
+
+Streaming epoch reader
+
+The epoch catalogues are read in fixed size chunks instead of one np.genfromtxt
+call, and the chunked matching sorts the rows into the tiles of an
+equal_area_tiling on disk, so an epoch larger than the memory is matched one tile
+at a time.
+
+"""
+
+#=================================================
+#IMPORTS
+#=================================================
+import numpy as np;
+import collections;
+import itertools;
+import os;
+import shutil;
+import tempfile;
+
+from tiled_matching import *;
+
+#=================================================
+#LOGGING
+#=================================================
+import logging;
+
+log = logging.getLogger();
+log.setLevel(logging.INFO);
+
+#=================================================
+#SUPPORT FUNCTIONS
+#=================================================
+def count_header_lines(path, delimiter=','):
+    """Return the number of header lines: comments and lines which are not numbers
+
+    :param path: The epoch file
+    :param delimiter: The column delimiter
+    """
+
+    N_header = 0;
+
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip() == '' or line.lstrip().startswith('#'):
+                N_header += 1;
+                continue;
+            try:
+                [float(x) for x in line.split(delimiter)];
+            except ValueError:
+                N_header += 1;
+                continue;
+            break;
+
+    return N_header;
+
+def read_epoch_chunks(path, chunk_size=100000, delimiter=',', N_columns=7):
+    """Yield the rows of an epoch file as (<= chunk_size x N_columns) float arrays
+
+    :param path: The epoch file
+    :param chunk_size: Number of rows per chunk
+    :param delimiter: The column delimiter
+    :param N_columns: Number of columns kept
+    """
+
+    N_header = count_header_lines(path, delimiter=delimiter);
+
+    with open(path, 'r') as f:
+        for line in itertools.islice(f, N_header):
+            pass;
+
+        while True:
+            lines = list(itertools.islice(f, chunk_size));
+            if len(lines) == 0:
+                break;
+
+            chunk = np.loadtxt(lines, dtype=float, delimiter=delimiter, ndmin=2, comments='#');
+            if chunk.shape[0] > 0:
+                yield chunk[:,:N_columns];
+
+def spill_epoch_to_tiles(path, tiling, halo, spill_folder, chunk_size=100000):
+    """Stream an epoch file into one binary file per tile
+
+    Each tile file holds the rows of the tile and of its halo with two extra columns:
+    the global row index and the core flag (1 if the row belongs to the tile core).
+
+    :param path: The epoch file
+    :param tiling: The equal_area_tiling
+    :param halo: The halo margin [deg]
+    :param spill_folder: Folder of the tile files
+    :param chunk_size: Number of rows per chunk
+    """
+
+    tile_files = [os.path.join(spill_folder, 'tile%05i.bin' %tile) for tile in range(0,tiling.N_tiles)];
+    handles = [open(f, 'wb') for f in tile_files];
+
+    N_obs = 0;
+    try:
+        for chunk in read_epoch_chunks(path, chunk_size=chunk_size):
+            core_tile = tiling.tile_ID(chunk[:,1], chunk[:,3]);
+            row_index = N_obs + np.arange(chunk.shape[0]);
+
+            for tile in range(0,tiling.N_tiles):
+                select = tiling.in_halo(tile, chunk[:,1], chunk[:,3], halo);
+                if np.any(select):
+                    np.column_stack((chunk[select,:], row_index[select], core_tile[select] == tile)).astype(float).tofile(handles[tile]);
+
+            N_obs += chunk.shape[0];
+    finally:
+        for h in handles:
+            h.close();
+
+    return tile_files, N_obs;
+
+def read_tile_file(tile_file):
+    """Read a tile file written by spill_epoch_to_tiles
+
+    :param tile_file: The tile file
+    """
+
+    rows = np.fromfile(tile_file, dtype=float).reshape(-1,9);
+
+    return rows[:,:7], rows[:,7].astype(np.int64), rows[:,8] > 0;
+
+def solve_tiles_in_flight(tile_tasks, executor, max_in_flight):
+    """Return the claims of the tiles, see solve_tile, keeping at most max_in_flight tasks submitted at once
+
+    Executor.map would consume the whole generator up front, i.e. every tile in memory at once.
+
+    :param tile_tasks: Iterable of the tile tasks
+    :param executor: concurrent.futures executor
+    :param max_in_flight: Maximum number of submitted tasks
+    """
+
+    claims = [];
+    in_flight = collections.deque();
+
+    for task in tile_tasks:
+        if len(in_flight) >= max_in_flight:
+            claims.append(in_flight.popleft().result());
+        in_flight.append(executor.submit(solve_tile, task));
+
+    while len(in_flight) > 0:
+        claims.append(in_flight.popleft().result());
+
+    return claims;
+
+def chunked_solve_matching_for_galaxy_positions(sm, path, epoch_ID, tiling, gating_radius, halo=None, chunk_size=100000, spill_folder=None, executor=None,
+                                                max_in_flight=2):
+    """Match an epoch file against the sky model with bounded memory and update the sky model
+
+    The file is streamed into per tile files, each tile is solved as in the tiled matching,
+    and the tile files are read once more to add the observations to the models. The
+    observations without a model inside the gate start new galaxy models, appended in tile order
+    (not in the global row order of the tiled matching).
+
+    With an executor at most max_in_flight tiles (their rows and models) are in memory at once.
+
+    :param sm: Sky model
+    :param path: The epoch file
+    :param epoch_ID: The ID pf the observed epoch
+    :param tiling: The equal_area_tiling
+    :param gating_radius: The gating radius [deg]
+    :param halo: The halo margin of the tiles [deg], default is twice the gating radius
+    :param chunk_size: Number of rows read at once
+    :param spill_folder: Folder for the tile files, default is a temporary folder
+    :param executor: concurrent.futures executor, None solves the tiles in this process
+    :param max_in_flight: Number of tiles submitted to the executor at once
+    """
+
+    if halo is None:
+        halo = 2 * gating_radius;
+
+    own_folder = spill_folder is None;
+    if own_folder:
+        spill_folder = tempfile.mkdtemp(prefix='tiles_');
+
+    try:
+        tile_files, N_obs = spill_epoch_to_tiles(path, tiling, halo, spill_folder, chunk_size=chunk_size);
+
+        model_RA, model_Dec = sky_model_positions(sm);
+
+        def tile_tasks():
+            for tile in range(0,tiling.N_tiles):
+                obs_rows, obs_index, core_mask = read_tile_file(tile_files[tile]);
+                model_index = np.flatnonzero(tiling.in_halo(tile, model_RA, model_Dec, halo));
+
+                yield (model_index, [sm.galax_model_list[j] for j in model_index],
+                       obs_index, obs_rows, core_mask, epoch_ID, gating_radius);
+
+        if executor is None:
+            claims = list(map(solve_tile, tile_tasks()));
+        else:
+            claims = solve_tiles_in_flight(tile_tasks(), executor, max_in_flight);
+
+        assignment = stitch_tile_claims(claims, N_obs, len(sm.galax_model_list));
+
+        #Solve the leftovers together, they are collected from the core rows of the tiles
+        left_obs = np.flatnonzero(assignment < 0);
+        if left_obs.size > 0:
+            left_rows = np.zeros((left_obs.size,7));
+            for tile_file in tile_files:
+                obs_rows, obs_index, core_mask = read_tile_file(tile_file);
+                k = np.searchsorted(left_obs, obs_index);
+                select = core_mask & (k < left_obs.size) & (left_obs[np.minimum(k, left_obs.size - 1)] == obs_index);
+                left_rows[k[select],:] = obs_rows[select,:];
+
+            left_models = np.setdiff1d(np.arange(len(sm.galax_model_list)), assignment[assignment >= 0]);
+            observed_ind, matched_model_ind = solve_leftovers(sm, left_rows, left_models, epoch_ID, gating_radius);
+            assignment[left_obs[observed_ind]] = matched_model_ind;
+
+            log.info('%i observations solved after stitching' %left_obs.size);
+
+        #Update the models tile by tile, the unmatched observations start new galaxy models
+        for tile_file in tile_files:
+            obs_rows, obs_index, core_mask = read_tile_file(tile_file);
+
+            for i in np.flatnonzero(core_mask):
+                if assignment[obs_index[i]] >= 0:
+                    add_observation(sm.galax_model_list[assignment[obs_index[i]]], observed_galaxy_position(epoch=epoch_ID, obs=obs_rows[i,:]));
+                else:
+                    galaxy_model = model_galaxy();
+                    add_observation(galaxy_model, observed_galaxy_position(epoch=epoch_ID, obs=obs_rows[i,:]));
+                    add_galaxy_model(sm, galaxy_model);
+
+        if np.any(assignment < 0):
+            log.info('Epoch %i: %i new models' %(epoch_ID, np.sum(assignment < 0)));
+    finally:
+        if own_folder:
+            shutil.rmtree(spill_folder, ignore_errors=True);
+
+    return sm;
+
+#=================================================
+#MAIN
+#=================================================
+if __name__ == '__main__':
+    """Test
+    """
+
+    for chunk in read_epoch_chunks('../Data/epoch00.csv', chunk_size=1000):
+        print(chunk.shape);
+
+    initial_epoch = np.genfromtxt('../Data/epoch00.csv',  dtype=float, delimiter=',',  skip_header=1);
+    sm = create_initial_sky_model(0, initial_epoch);
+
+    tiling = create_tiling(initial_epoch[:,1], initial_epoch[:,3], N_RA=4, N_Dec=4);
+
+    sm = chunked_solve_matching_for_galaxy_positions(sm, '../Data/epoch01.csv', 1, tiling, gating_radius=0.2, chunk_size=1000);
+
+    print(len(sm.galax_model_list[0].obs_list));
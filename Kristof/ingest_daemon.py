@@ -0,0 +1,282 @@
+"""
+------------------------------
+MIT License
+
+Copyright (c) 2018 Hachastron
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+------------------------------
+
+Directory watching ingest daemon
+
+An asyncio loop polls the epoch folder. A file is taken when its size and
+modification time did not change for a settle time (partially written files are
+skipped), it is parsed and validated in a worker pool off the event loop, and the
+parsed epochs are fed to an incremental matcher strictly in epoch order.
+
+"""
+
+#=================================================
+#IMPORTS
+#=================================================
+import numpy as np;
+import asyncio;
+import glob;
+import os;
+import re;
+from concurrent.futures import ProcessPoolExecutor;
+
+from matching_algorithm import *;
+
+#=================================================
+#LOGGING
+#=================================================
+import logging;
+
+log = logging.getLogger();
+log.setLevel(logging.INFO);
+
+#=================================================
+#SUPPORT FUNCTIONS
+#=================================================
+def epoch_number(path):
+    """Return the epoch number from the file name, e.g. epoch07.csv -> 7, None if there is no number
+
+    :param path: The epoch file
+    """
+
+    match = re.search(r'(\d+)\D*$', os.path.basename(path));
+
+    if match is None:
+        return None;
+
+    return int(match.group(1));
+
+def parse_epoch_file(path):
+    """Read and validate an epoch catalogue, this runs in the worker pool
+
+    :param path: The epoch file
+    """
+
+    epoch = np.genfromtxt(path,  dtype=float, delimiter=',');
+
+    if epoch.ndim == 1:
+        epoch = epoch.reshape(1,-1);
+
+    if epoch.shape[0] == 0 or epoch.shape[1] < 7:
+        raise ValueError('%s: expected rows of 7 columns, got shape %s' %(path, epoch.shape));
+    if not np.all(np.isfinite(epoch[:,:7])):
+        raise ValueError('%s: missing or non-numeric values' %path);
+    if np.any(epoch[:,[2,4,6]] < 0):
+        raise ValueError('%s: negative errors' %path);
+
+    return epoch[:,:7];
+
+#=================================================
+#CLASSES
+#=================================================
+class sky_model_matcher(object):
+    """Incremental matcher: the first epoch creates the sky model, the others are matched into it
+    """
+
+    def __init__(self, sm=None, gating_radius=0.05, alert_sigma=None, alerts=None, alerts_loop=None):
+        """Class attributes
+
+        :param sm: Existing sky model, None creates it from the first epoch
+        :param gating_radius: Gating radius [deg] of the matching
+        :param alert_sigma: The flux deviation threshold of the transient alerts, see transient_alerts
+        :param alerts: The alerts are sent to this queue or appended to this .csv file, see emit_alerts
+        :param alerts_loop: The event loop of an asyncio.Queue of alerts, the ingest_daemon sets its own loop
+        """
+
+        self.sm = sm;
+        self.gating_radius = gating_radius;
+        self.alert_sigma = alert_sigma;
+        self.alerts = alerts;
+        self.alerts_loop = alerts_loop;
+
+    def __call__(self, epoch_ID, epoch):
+        """Add an epoch to the sky model
+
+        :param epoch_ID: The ID (time) of the epoch
+        :param epoch: The parsed epoch
+        """
+
+        if self.sm is None:
+            self.sm = create_initial_sky_model(epoch_ID, epoch);
+        else:
+            self.sm = solve_matching_for_galaxy_positions(self.sm, epoch, epoch_ID, gating_radius=self.gating_radius,
+                                                          alert_sigma=self.alert_sigma, alerts=self.alerts, alerts_loop=self.alerts_loop);
+
+        log.info("Epoch %i solved" %epoch_ID);
+
+class ingest_daemon(object):
+    """Watch a folder and feed the new epoch files to a matcher in epoch order
+    """
+
+    def __init__(self, folder, matcher, pattern='*.csv', first_epoch=0, poll_interval=1., settle_time=2., executor=None, gap_timeout=None):
+        """Class attributes
+
+        :param folder: The watched folder
+        :param matcher: Callable matcher(epoch_ID, epoch), e.g. sky_model_matcher
+        :param pattern: Glob pattern of the epoch files
+        :param first_epoch: The first epoch number to feed
+        :param poll_interval: Time between the folder scans [s]
+        :param settle_time: A file is read when its size and mtime did not change for this long [s]
+        :param executor: Executor for the parsing, default is a process pool
+        :param gap_timeout: A missing epoch is skipped when later epochs wait for it this long [s], None waits forever
+        """
+
+        self.folder = folder;
+        self.matcher = matcher;
+        self.pattern = pattern;
+        self.next_epoch = first_epoch;
+        self.poll_interval = poll_interval;
+        self.settle_time = settle_time;
+        self.executor = executor;
+        self.gap_timeout = gap_timeout;
+
+        self.gap_since = None;#time a later epoch was first seen while the next epoch was missing
+        self.file_state = {};#path -> (size, mtime, time the state was first seen)
+        self.parsing = {};#epoch number -> (path, (size, mtime), future)
+
+    def scan(self, loop):
+        """Check the folder and start parsing the files which settled
+
+        :param loop: The running event loop
+        """
+
+        now = loop.time();
+
+        for path in sorted(glob.glob(os.path.join(self.folder, self.pattern))):
+            ep = epoch_number(path);
+            if ep is None or ep < self.next_epoch:
+                continue;
+
+            try:
+                stat = os.stat(path);
+            except OSError:
+                continue;#removed in between
+
+            state = (stat.st_size, stat.st_mtime);
+            if path not in self.file_state or self.file_state[path][:2] != state:
+                self.file_state[path] = state + (now,);
+                continue;
+
+            if now - self.file_state[path][2] < self.settle_time:
+                continue;
+
+            #Parse a settled file once, and again only if it was rewritten
+            if ep in self.parsing and self.parsing[ep][:2] == (path, state):
+                continue;
+
+            future = loop.run_in_executor(self.executor, parse_epoch_file, path);
+            self.parsing[ep] = (path, state, future);
+
+    async def feed(self, loop):
+        """Feed the parsed epochs to the matcher while the next epoch is ready
+
+        :param loop: The running event loop
+        """
+
+        self.check_gap(loop);
+
+        while self.next_epoch in self.parsing:
+            path, state, future = self.parsing[self.next_epoch];
+
+            if not future.done():
+                return;
+
+            try:
+                epoch = future.result();
+            except Exception as e:
+                #Keep waiting, the file is parsed again when it changes
+                if not getattr(future, 'reported', False):
+                    log.error('Invalid epoch file %s: %s' %(path, e));
+                    future.reported = True;
+                return;
+
+            await loop.run_in_executor(None, self.matcher, self.next_epoch, epoch);
+
+            del self.parsing[self.next_epoch];
+            self.next_epoch += 1;
+            self.check_gap(loop);
+
+    def check_gap(self, loop):
+        """Warn when later epochs wait for a missing epoch, and skip it after gap_timeout
+
+        :param loop: The running event loop
+        """
+
+        later = [ep for ep in self.parsing if ep > self.next_epoch];
+        if self.next_epoch in self.parsing or len(later) == 0:
+            self.gap_since = None;
+            return;
+
+        now = loop.time();
+        if self.gap_since is None:
+            self.gap_since = now;
+            log.warning('Epoch %i is missing, epochs %s wait for it' %(self.next_epoch, sorted(later)));
+
+        if self.gap_timeout is not None and now - self.gap_since >= self.gap_timeout:
+            log.warning('Epoch %i skipped after %.1f s, continuing with epoch %i' %(self.next_epoch, now - self.gap_since, min(later)));
+            self.next_epoch = min(later);
+            self.gap_since = None;
+
+    async def run(self, stop=None):
+        """Watch the folder until stop is set
+
+        :param stop: asyncio.Event, None runs forever
+        """
+
+        loop = asyncio.get_running_loop();
+
+        #The matcher runs in a worker thread, an asyncio.Queue of alerts is fed through this loop
+        if isinstance(getattr(self.matcher, 'alerts', None), asyncio.Queue) and getattr(self.matcher, 'alerts_loop', None) is None:
+            self.matcher.alerts_loop = loop;
+
+        own_executor = self.executor is None;
+        if own_executor:
+            self.executor = ProcessPoolExecutor();
+
+        try:
+            while stop is None or not stop.is_set():
+                self.scan(loop);
+                await self.feed(loop);
+
+                try:
+                    await asyncio.wait_for(stop.wait() if stop is not None else asyncio.sleep(self.poll_interval), self.poll_interval);
+                except asyncio.TimeoutError:
+                    pass;
+        finally:
+            if own_executor:
+                self.executor.shutdown();
+                self.executor = None;
+
+#=================================================
+#MAIN
+#=================================================
+if __name__ == '__main__':
+    """Watch the data folder
+    """
+
+    matcher = sky_model_matcher(gating_radius=0.05);
+    daemon = ingest_daemon('../Data/', matcher, pattern='epoch*.csv');
+
+    asyncio.run(daemon.run());
@@ -0,0 +1,188 @@
+"""
+------------------------------
+MIT License
+
+Copyright (c) 2018 Hachastron
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+------------------------------
+
+Append-only observation journal of the sky model
+
+The assignments of every epoch are appended to a binary file as
+(epoch, model, row) records: the galaxy model index and the row of the
+observation in the epoch. The block of an epoch ends with a commit record
+(epoch, -1, number of records), a block without it (crash during the write) is
+ignored, and a later block of the same epoch (rerun) supersedes the earlier one.
+The sky model is rebuilt from the journal and the epochs, see replay_journal.
+
+"""
+
+#=================================================
+#IMPORTS
+#=================================================
+import numpy as np;
+import os;
+
+#=================================================
+#LOGGING
+#=================================================
+import logging;
+
+log = logging.getLogger();
+log.setLevel(logging.INFO);
+
+#=================================================
+#CONSTANTS
+#=================================================
+journal_dtype = np.dtype([('epoch', np.int32), ('model', np.int32), ('row', np.int32)]);
+
+commit_model = -1;#The model field of the commit records
+
+#=================================================
+#SUPPORT FUNCTIONS
+#=================================================
+def journal_block(epoch_ID, model_ind, rows):
+    """Return the journal records of one epoch, closed by the commit record
+
+    :param epoch_ID: The ID of the epoch
+    :param model_ind: The galaxy model index of the assigned observations
+    :param rows: The rows of the observations in the epoch
+    """
+
+    model_ind = np.asarray(model_ind);
+
+    records = np.zeros(model_ind.size + 1, dtype=journal_dtype);
+    records['epoch'] = epoch_ID;
+    records['model'][:-1] = model_ind;
+    records['row'][:-1] = rows;
+    records['model'][-1] = commit_model;
+    records['row'][-1] = model_ind.size;
+
+    return records;
+
+def append_journal(path, epoch_ID, model_ind, rows, sync=True):
+    """Append the assignments of an epoch to the journal in one sequential write
+
+    :param path: The journal file
+    :param epoch_ID: The ID of the epoch
+    :param model_ind: The galaxy model index of the assigned observations
+    :param rows: The rows of the observations in the epoch
+    :param sync: Flush the block to the disk before returning
+    """
+
+    #A partial record left by a crash would shift all the later records
+    if os.path.exists(path) and os.path.getsize(path) % journal_dtype.itemsize != 0:
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - os.path.getsize(path) % journal_dtype.itemsize);
+
+    with open(path, 'ab') as f:
+        journal_block(epoch_ID, model_ind, rows).tofile(f);
+
+        if sync:
+            f.flush();
+            os.fsync(f.fileno());
+
+def read_journal(path):
+    """Return the committed records of the journal (without the commit records), the last block of each epoch
+
+    :param path: The journal file
+    """
+
+    if os.path.exists(path):
+        records = np.fromfile(path, dtype=journal_dtype, count=os.path.getsize(path) // journal_dtype.itemsize);
+    else:
+        records = np.zeros(0, dtype=journal_dtype);
+
+    commits = np.flatnonzero(records['model'] == commit_model);
+
+    #A commit closes the block of its size right before it
+    starts = commits - records['row'][commits];
+    valid = (starts >= 0) & (records['epoch'][np.maximum(starts, 0)] == records['epoch'][commits]);
+    if not np.all(valid):
+        log.warning('%i corrupt journal blocks are ignored' %np.sum(~valid));
+    starts, commits = starts[valid], commits[valid];
+
+    #The last committed block of each epoch
+    last = np.unique(records['epoch'][commits][::-1], return_index=True)[1];
+    last = commits.size - 1 - last;
+
+    N_dropped = records.size - commits.size - np.sum(commits[last] - starts[last]);
+    if N_dropped > 0:
+        log.info('%i uncommitted or superseded journal records are dropped' %N_dropped);
+
+    keep = np.zeros(records.size, dtype=bool);
+    for start, stop in zip(starts[last], commits[last]):
+        keep[start:stop] = True;
+
+    return records[keep];
+
+def journal_epochs(path):
+    """Return the sorted IDs of the epochs committed to the journal
+
+    :param path: The journal file
+    """
+
+    return np.unique(read_journal(path)['epoch']);
+
+def compact_journal(path):
+    """Rewrite the journal with only the committed records, one block per epoch sorted by model
+
+    The new journal is written to a temporary file and renamed over the old one.
+
+    :param path: The journal file
+    """
+
+    records = read_journal(path);
+    records = records[np.lexsort((records['model'], records['epoch']))];
+
+    temp_path = path + '.compact';
+    with open(temp_path, 'wb') as f:
+        for epoch_ID in np.unique(records['epoch']):
+            block = records[records['epoch'] == epoch_ID];
+            journal_block(epoch_ID, block['model'], block['row']).tofile(f);
+        f.flush();
+        os.fsync(f.fileno());
+
+    os.replace(temp_path, path);
+
+    log.info('Journal compacted to %i records' %records.size);
+
+#=================================================
+#MAIN
+#=================================================
+if __name__ == '__main__':
+    """Test
+    """
+
+    path = 'journal_test.bin';
+    if os.path.exists(path):
+        os.remove(path);
+
+    append_journal(path, 0, np.arange(5), np.arange(5));
+    append_journal(path, 1, [0, 2, 5], [1, 0, 2]);
+    append_journal(path, 1, [0, 2, 5], [0, 1, 2]);#Rerun of the epoch
+    with open(path, 'ab') as f:
+        journal_block(2, [1, 3], [0, 1])[:-1].tofile(f);#Crash before the commit
+
+    print(read_journal(path));
+    compact_journal(path);
+    print(np.fromfile(path, dtype=journal_dtype).size, journal_epochs(path));
+
+    os.remove(path);
@@ -0,0 +1,235 @@
+"""
+------------------------------
+MIT License
+
+Copyright (c) 2018 Hachastron
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+------------------------------
+
+Compiled kernels
+
+Numba compiled (parallel prange) versions of the hot loops: the cost of candidate
+observation - model pairs, the dense cost blocks, and the brute force first and
+second nearest neighbour search of Karl's filter. Numba is optional, without it
+(or with use_numba = False) the NumPy versions are used, which give the same
+results up to floating point rounding. The observed columns of compact record
+arrays are passed in their own dtype (float32 fluxes), they are not upcast.
+
+"""
+
+#=================================================
+#IMPORTS
+#=================================================
+import numpy as np;
+import math;
+
+from position_model import vectorized_p_value;
+
+try:
+    import numba;
+except ImportError:
+    numba = None;
+
+#=================================================
+#LOGGING
+#=================================================
+import logging;
+
+log = logging.getLogger();
+log.setLevel(logging.INFO);
+
+#=================================================
+#CONSTANTS
+#=================================================
+use_numba = numba is not None;#Set to False to force the NumPy kernels
+
+sqrt2 = math.sqrt(2.);
+
+#=================================================
+#NUMPY KERNELS
+#=================================================
+def numpy_pair_costs(RA, Dec, Flux, statistics, model_ind):
+    """Cost (2 - averaged two sided p-value) of observation - model pairs
+
+    :param RA, Dec, Flux: The observed values of the pairs
+    :param statistics: (N_models x 6) model gaussians, see sky_model_statistics
+    :param model_ind: Model index of the pairs
+    """
+
+    return vectorized_p_value(RA, Dec, Flux,
+                              statistics[model_ind,0], statistics[model_ind,1],
+                              statistics[model_ind,2], statistics[model_ind,3],
+                              statistics[model_ind,4], statistics[model_ind,5]);
+
+def numpy_block_costs(obs_RA, obs_Dec, obs_Flux, statistics):
+    """Dense (N_obs x N_models) cost block, see numpy_pair_costs
+
+    :param obs_RA, obs_Dec, obs_Flux: The observed values of the block rows
+    :param statistics: (N_models x 6) model gaussians of the block columns
+    """
+
+    return vectorized_p_value(obs_RA[:,np.newaxis], obs_Dec[:,np.newaxis], obs_Flux[:,np.newaxis],
+                              statistics[np.newaxis,:,0], statistics[np.newaxis,:,1],
+                              statistics[np.newaxis,:,2], statistics[np.newaxis,:,3],
+                              statistics[np.newaxis,:,4], statistics[np.newaxis,:,5]);
+
+def numpy_nearest_two(x_a, y_a, x_b, y_b, block_size=512):
+    """First and second nearest neighbour in a of each point of b (plain euclidean, as Karl's filter)
+
+    Returns the index of the nearest neighbour, its distance and the second distance.
+
+    :param x_a, y_a: Coordinates of the searched points
+    :param x_b, y_b: Coordinates of the query points
+    :param block_size: Number of query points per broadcast block
+    """
+
+    N_b = x_b.size;
+
+    index = np.zeros(N_b, dtype=np.int64);
+    distance1 = np.full(N_b, np.inf);
+    distance2 = np.full(N_b, np.inf);
+
+    for b0 in range(0, N_b, block_size):
+        b1 = min(b0 + block_size, N_b);
+
+        distance = np.sqrt((x_a[np.newaxis,:] - x_b[b0:b1,np.newaxis])**2 + (y_a[np.newaxis,:] - y_b[b0:b1,np.newaxis])**2);
+
+        index[b0:b1] = np.argmin(distance, axis=1);
+        if x_a.size > 1:
+            two = np.partition(distance, 1, axis=1)[:,:2];
+            distance1[b0:b1] = two[:,0];
+            distance2[b0:b1] = two[:,1];
+        elif x_a.size == 1:
+            distance1[b0:b1] = distance[:,0];
+
+    return index, distance1, distance2;
+
+#=================================================
+#NUMBA KERNELS
+#=================================================
+if numba is not None:
+
+    @numba.njit(parallel=True, cache=True)
+    def numba_pair_costs(RA, Dec, Flux, statistics, model_ind):
+        """Compiled numpy_pair_costs, erfc(z / sqrt(2)) is the two sided p-value
+        """
+        cost = np.empty(model_ind.size);
+
+        for k in numba.prange(model_ind.size):
+            j = model_ind[k];
+
+            p_value = math.erfc(abs(RA[k] - statistics[j,0]) / (statistics[j,1] * sqrt2));
+            p_value += math.erfc(abs(Dec[k] - statistics[j,2]) / (statistics[j,3] * sqrt2));
+            p_value += math.erfc(abs(Flux[k] - statistics[j,4]) / (statistics[j,5] * sqrt2));
+
+            cost[k] = 2 - p_value / 3;
+
+        return cost;
+
+    @numba.njit(parallel=True, cache=True)
+    def numba_block_costs(obs_RA, obs_Dec, obs_Flux, statistics):
+        """Compiled numpy_block_costs, see numba_pair_costs
+        """
+        cost = np.empty((obs_RA.size, statistics.shape[0]));
+
+        for i in numba.prange(obs_RA.size):
+            for j in range(statistics.shape[0]):
+                p_value = math.erfc(abs(obs_RA[i] - statistics[j,0]) / (statistics[j,1] * sqrt2));
+                p_value += math.erfc(abs(obs_Dec[i] - statistics[j,2]) / (statistics[j,3] * sqrt2));
+                p_value += math.erfc(abs(obs_Flux[i] - statistics[j,4]) / (statistics[j,5] * sqrt2));
+
+                cost[i,j] = 2 - p_value / 3;
+
+        return cost;
+
+    @numba.njit(parallel=True, cache=True)
+    def numba_nearest_two(x_a, y_a, x_b, y_b):
+        """Compiled numpy_nearest_two
+        """
+        index = np.zeros(x_b.size, dtype=np.int64);
+        distance1 = np.full(x_b.size, np.inf);
+        distance2 = np.full(x_b.size, np.inf);
+
+        for b in numba.prange(x_b.size):
+            best = np.inf;
+            second = np.inf;
+            best_index = 0;
+
+            for a in range(x_a.size):
+                d = math.sqrt((x_a[a] - x_b[b])**2 + (y_a[a] - y_b[b])**2);
+                if d < best:
+                    second = best;
+                    best = d;
+                    best_index = a;
+                elif d < second:
+                    second = d;
+
+            index[b] = best_index;
+            distance1[b] = best;
+            distance2[b] = second;
+
+        return index, distance1, distance2;
+
+#=================================================
+#DISPATCH
+#=================================================
+def float_column(x):
+    """Contiguous column for the kernels, float32 columns (compact records) are kept as float32
+    """
+
+    if np.asarray(x).dtype == np.float32:
+        return np.ascontiguousarray(x);
+
+    return np.ascontiguousarray(x, dtype=np.float64);
+
+def pair_cost_kernel(RA, Dec, Flux, statistics, model_ind):
+    """Cost of observation - model pairs with the compiled kernel if available, see numpy_pair_costs
+    """
+
+    args = (float_column(RA), float_column(Dec), float_column(Flux), np.ascontiguousarray(statistics, dtype=np.float64),
+            np.ascontiguousarray(model_ind, dtype=np.int64));
+
+    if use_numba:
+        return numba_pair_costs(*args);
+
+    return numpy_pair_costs(*args);
+
+def block_cost_kernel(obs_RA, obs_Dec, obs_Flux, statistics):
+    """Dense cost block with the compiled kernel if available, see numpy_block_costs
+    """
+
+    args = (float_column(obs_RA), float_column(obs_Dec), float_column(obs_Flux), np.ascontiguousarray(statistics, dtype=np.float64));
+
+    if use_numba:
+        return numba_block_costs(*args);
+
+    return numpy_block_costs(*args);
+
+def nearest_two_kernel(x_a, y_a, x_b, y_b):
+    """Brute force first and second nearest neighbours with the compiled kernel if available, see numpy_nearest_two
+    """
+
+    args = (np.ascontiguousarray(x_a, dtype=np.float64), np.ascontiguousarray(y_a, dtype=np.float64),
+            np.ascontiguousarray(x_b, dtype=np.float64), np.ascontiguousarray(y_b, dtype=np.float64));
+
+    if use_numba:
+        return numba_nearest_two(*args);
+
+    return numpy_nearest_two(*args);
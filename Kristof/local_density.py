@@ -0,0 +1,198 @@
+"""
+------------------------------
+MIT License
+
+Copyright (c) 2018 Hachastron
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+------------------------------
+
+Local source density
+
+The distances to the first, second and k-th neighbour of every source in a
+reference catalogue are found with one tree query. They give the local source
+spacing, which sets the adaptive gating radius (small in crowded regions, large
+in sparse ones) and the first / second neighbour ratio threshold of Karl's
+filter.
+
+"""
+
+#=================================================
+#IMPORTS
+#=================================================
+import numpy as np;
+from scipy.spatial import cKDTree;
+
+from sky_model_query import *;
+
+#=================================================
+#LOGGING
+#=================================================
+import logging;
+
+log = logging.getLogger();
+log.setLevel(logging.INFO);
+
+#=================================================
+#CLASSES
+#=================================================
+class local_density(object):
+    """Neighbour distances of a set of positions in a reference catalogue
+    """
+
+    def __init__(self, RA_ref, Dec_ref, k=5, RA=None, Dec=None):
+        """Class attributes
+
+        :param RA_ref, Dec_ref: The reference catalogue [deg]
+        :param k: The density is measured by the distance of the k-th neighbour
+        :param RA, Dec: The positions where the density is measured [deg], default is the reference catalogue itself (without the source itself)
+        """
+
+        self_query = RA is None;
+        if self_query:
+            RA, Dec = RA_ref, Dec_ref;
+
+        self.k = k;
+        self.RA = np.asarray(RA, dtype=float);
+        self.Dec = np.asarray(Dec, dtype=float);
+
+        #The source itself is the first neighbour of a self query
+        N_query = min(k + int(self_query), np.asarray(RA_ref).size);
+        chord, index = cKDTree(unit_vectors(RA_ref, Dec_ref)).query(unit_vectors(RA, Dec), k=N_query);
+        distance = chord_to_angle(np.asarray(chord).reshape(self.RA.size, -1))[:,int(self_query):];
+
+        #Missing neighbours (too small catalogue) are infinitely far
+        distance = np.column_stack((distance, np.full((self.RA.size, max(k - distance.shape[1], 0)), np.inf)));
+
+        self.d1 = distance[:,0];#First neighbour distance [deg]
+        self.d2 = distance[:,1] if k > 1 else np.full(self.RA.size, np.inf);#Second neighbour distance [deg]
+        self.dk = distance[:,k-1];#k-th neighbour distance [deg]
+
+    @property
+    def spacing(self):
+        """return the local source spacing [deg]: the k-th neighbour distance over sqrt(k)
+        """
+        return self.dk / np.sqrt(self.k);
+
+    def adaptive_radius(self, factor=0.5, min_radius=0., max_radius=np.inf):
+        """return the gating radius of each position: a fraction of the local spacing
+
+        :param factor: The radius is this fraction of the spacing
+        :param min_radius: Lower limit of the radius [deg]
+        :param max_radius: Upper limit of the radius [deg]
+        """
+        return np.clip(factor * self.spacing, min_radius, max_radius);
+
+    def adaptive_ratio(self, ratio=2., min_ratio=1., max_ratio=np.inf):
+        """return the second / first neighbour distance ratio threshold of each position
+
+        The threshold is scaled by the median spacing over the local spacing, so it is
+        stricter in crowded regions and looser in sparse ones.
+
+        :param ratio: The threshold at the median spacing
+        :param min_ratio: Lower limit of the threshold
+        :param max_ratio: Upper limit of the threshold
+        """
+        spacing = self.spacing;
+        finite = np.isfinite(spacing) & (spacing > 0);
+
+        if not np.any(finite):
+            return np.full(spacing.size, float(ratio));
+
+        scale = np.ones(spacing.size);
+        scale[finite] = np.median(spacing[finite]) / spacing[finite];
+
+        return np.clip(ratio * scale, min_ratio, max_ratio);
+
+    def statistics(self):
+        """return a dictionary of the neighbour distance statistics [deg] for inspection
+        """
+        stats = {'N': self.RA.size, 'k': self.k};
+
+        for name, d in [('d1', self.d1), ('d2', self.d2), ('dk', self.dk), ('spacing', self.spacing)]:
+            d = d[np.isfinite(d)];
+            if d.size == 0:
+                continue;
+            stats[name + '_mean'] = np.mean(d);
+            stats[name + '_median'] = np.median(d);
+            stats[name + '_min'] = np.amin(d);
+            stats[name + '_max'] = np.amax(d);
+
+        return stats;
+
+#=================================================
+#SUPPORT FUNCTIONS
+#=================================================
+def epoch_density(epoch, k=5):
+    """Return the local_density of an epoch against itself
+
+    :param epoch: given epoch in a numpy array, already readed from .csv
+    :param k: The density is measured by the distance of the k-th neighbour
+    """
+
+    return local_density(epoch[:,1], epoch[:,3], k=k);
+
+def adaptive_gating_radius(sm, observed_epoch, k=5, factor=0.5, min_radius=1e-4, max_radius=1.):
+    """Return the gating radius of each observation from the local density of the sky model
+
+    The limits must be finite and positive: with at most k models the k-th neighbour is
+    infinitely far and the radius is max_radius, and the zone engine needs a radius > 0.
+
+    :param sm: Sky model
+    :param observed_epoch: given epoch in a numpy array, already readed from .csv
+    :param k: The density is measured by the distance of the k-th neighbour
+    :param factor: The radius is this fraction of the local spacing
+    :param min_radius: Lower limit of the radius [deg]
+    :param max_radius: Upper limit of the radius [deg]
+    """
+
+    if not (0 < min_radius <= max_radius < np.inf):
+        raise ValueError('The radius limits must satisfy 0 < min_radius <= max_radius < inf');
+
+    model_RA, model_Dec = sky_model_positions(sm);
+
+    if model_RA.size <= k:
+        log.info('Adaptive gating radius: %i models, the radius is max_radius' %model_RA.size);
+        return np.full(observed_epoch.shape[0], float(max_radius));
+    density = local_density(model_RA, model_Dec, k=k, RA=observed_epoch[:,1], Dec=observed_epoch[:,3]);
+
+    log.info('Adaptive gating radius, median spacing %f deg' %np.median(density.spacing));
+
+    return density.adaptive_radius(factor=factor, min_radius=min_radius, max_radius=max_radius);
+
+#=================================================
+#MAIN
+#=================================================
+if __name__ == '__main__':
+    """Test
+    """
+
+    epoch_0 = np.genfromtxt('../Data/epoch00.csv',  dtype=float, delimiter=',',  skip_header=1);
+
+    density = epoch_density(epoch_0, k=5);
+
+    for key, value in sorted(density.statistics().items()):
+        print(key, value);
+
+    #Match the next epoch with the adaptive radius
+    epoch_1 = np.genfromtxt('../Data/epoch01.csv',  dtype=float, delimiter=',',  skip_header=1);
+
+    sm = create_initial_sky_model(0, epoch_0);
+    radius = adaptive_gating_radius(sm, epoch_1, k=5, factor=0.5, max_radius=0.2);
+    sm = solve_matching_for_galaxy_positions(sm, epoch_1, 1, gating_radius=radius);
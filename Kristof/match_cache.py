@@ -0,0 +1,195 @@
+"""
+------------------------------
+MIT License
+
+Copyright (c) 2018 Hachastron
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+------------------------------
+
+Content-addressed disk cache of the match results
+
+The results (numpy arrays) are stored in .npz files named by a key, the SHA-1
+hash of the content of the input epochs and of the matcher parameters, so an
+unchanged rerun reads them back instead of matching again. The sequential
+pipeline chains the keys: the key of an epoch also hashes the key of the
+previous one, as the sky model depends on all the earlier epochs.
+
+The cache size is capped, the least recently used files (by their modification
+time, which is renewed at every hit) are evicted first.
+
+"""
+
+#=================================================
+#IMPORTS
+#=================================================
+import numpy as np;
+import hashlib;
+import os;
+import tempfile;
+
+#=================================================
+#LOGGING
+#=================================================
+import logging;
+
+log = logging.getLogger();
+log.setLevel(logging.INFO);
+
+#=================================================
+#CLASSES
+#=================================================
+class match_cache(object):
+    """Size capped LRU cache of numpy arrays in a folder
+    """
+
+    def __init__(self, folder, max_bytes=2**30):
+        """Class attributes
+
+        :param folder: The cache folder, created if it does not exist
+        :param max_bytes: The size limit of the cache [bytes]
+        """
+
+        if not os.path.exists(folder):
+            os.makedirs(folder);
+
+        self.folder = folder;
+        self.max_bytes = max_bytes;
+        self.hits = 0;
+        self.misses = 0;
+
+    def path(self, key):
+        """return the file of a key
+
+        :param key: The cache key, see cache_key
+        """
+        return os.path.join(self.folder, '%s.npz' %key);
+
+    def get(self, key):
+        """return the dictionary of the arrays stored under the key, None if it is not cached
+
+        :param key: The cache key, see cache_key
+        """
+        path = self.path(key);
+
+        try:
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in data.files};
+        except (IOError, OSError, ValueError):
+            self.misses += 1;
+            return None;
+
+        os.utime(path, None);#Most recently used
+        self.hits += 1;
+
+        return arrays;
+
+    def put(self, key, **arrays):
+        """Store the arrays under the key, then evict the least recently used files above the size limit
+
+        :param key: The cache key, see cache_key
+        :param arrays: The arrays to store by name
+        """
+
+        #Written to a temporary file and renamed, so a crash never leaves a partial entry
+        handle, temp_path = tempfile.mkstemp(suffix='.npz', dir=self.folder);
+        with os.fdopen(handle, 'wb') as f:
+            np.savez(f, **arrays);
+        os.replace(temp_path, self.path(key));
+
+        self.evict();
+
+    def evict(self):
+        """Delete the least recently used files until the cache fits into max_bytes
+        """
+        entries = [];
+        for name in os.listdir(self.folder):
+            if name.endswith('.npz'):
+                stat = os.stat(os.path.join(self.folder, name));
+                entries.append((stat.st_mtime, stat.st_size, name));
+
+        total = sum(entry[1] for entry in entries);
+
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break;
+            os.remove(os.path.join(self.folder, name));
+            total -= size;
+
+            log.info('Match cache entry %s evicted' %name);
+
+#=================================================
+#SUPPORT FUNCTIONS
+#=================================================
+def file_digest(path, chunk_size=2**20):
+    """Return the SHA-1 hex digest of the content of a file
+
+    :param path: The file
+    :param chunk_size: The file is read in chunks of this size [bytes]
+    """
+
+    digest = hashlib.sha1();
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk);
+
+    return digest.hexdigest();
+
+def cache_key(*parts, **params):
+    """Return the cache key: the SHA-1 hex digest of the parts (file digests, previous keys) and the parameters
+
+    numpy arrays (e.g. a gating radius of each observation) are hashed by their content.
+
+    :param parts: Strings, the order matters
+    :param params: Parameters of the matcher by name
+    """
+
+    digest = hashlib.sha1();
+
+    for part in parts:
+        digest.update(str(part).encode());
+
+    for name in sorted(params):
+        value = params[name];
+        digest.update(name.encode());
+
+        if isinstance(value, np.ndarray):
+            digest.update(str(value.dtype).encode() + str(value.shape).encode());
+            digest.update(np.ascontiguousarray(value).tobytes());
+        else:
+            digest.update(repr(value).encode());
+
+    return digest.hexdigest();
+
+#=================================================
+#MAIN
+#=================================================
+if __name__ == '__main__':
+    """Test
+    """
+
+    cache = match_cache(os.path.join(tempfile.gettempdir(), 'match_cache_test'), max_bytes=2**20);
+
+    key = cache_key(file_digest('../Data/epoch00.csv'), file_digest('../Data/epoch01.csv'), distance_filter=2);
+
+    if cache.get(key) is None:
+        cache.put(key, index=np.arange(4308), distance=np.zeros(4308));
+
+    print(sorted(cache.get(key).keys()), cache.hits, cache.misses);
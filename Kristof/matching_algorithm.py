@@ -34,9 +34,15 @@ import numpy as np;
 from scipy import stats;
 from scipy.optimize import linear_sum_assignment; #Hungarian algorithm
 import glob;
+import os;
 
 from position_model import *;
 from cost_matrix import *;
+from auction_solver import *;
+from registration import *;
+from match_cache import *;
+from journal import *;
+from alerts import *;
 
 #=================================================
 #LOGGING
@@ -49,31 +55,245 @@ log.setLevel(logging.INFO);
 #=================================================
 #SUPPORT FUNCTIONS
 #=================================================
-def solve_matching_for_galaxy_positions(sm, observed_epoch,epoch_ID):
-    """Solve the cost matrix and update sky model
+def solve_assignment(cost_matrix, birth_cost=None, death_cost=None, overwrite=False, block_size=1024):
+    """Solve the (possibly rectangular) assignment problem with birth and death costs
+    
+    An unmatched observation costs birth_cost (it starts a new model), an unmatched model
+    costs death_cost (it is missing from this epoch). This is the same as matching with the
+    reduced cost c - birth_cost - death_cost and leaving a pair unmatched at zero cost, so
+    the reduced matrix is clipped at zero, solved as it is (no square padding) and the pairs
+    with non-negative reduced cost are dropped. The costs are in [1,2], so e.g.
+    birth_cost + death_cost = 1.9 splits the pairs which are worse than 1.9.
+    
+    Without birth and death costs every row or column is matched, except the pairs at gated_cost
+    (outside the gate): those observations start new models too.
+    
+    The reduced matrix is computed in row blocks, see reduce_cost_matrix. With overwrite it
+    replaces the cost matrix (e.g. a memory-mapped one) instead of a copy in memory. Note that
+    linear_sum_assignment still copies a matrix with more rows than columns into memory.
+    
+    Returns the matched observation and model indices and the unmatched observation indices.
+    
+    :param cost_matrix: The cost matrix, rows are observations, columns are models
+    :param birth_cost: Cost of an observation which starts a new model
+    :param death_cost: Cost of a model without observation in this epoch
+    :param overwrite: Reduce the cost matrix in place
+    :param block_size: Number of rows per block of the reduction
+    """
+    
+    if birth_cost is None and death_cost is None:
+        observed_ind, matched_model_ind = linear_sum_assignment(cost_matrix);
+        
+        matched = cost_matrix[observed_ind, matched_model_ind] < gated_cost;
+        observed_ind = observed_ind[matched];
+        matched_model_ind = matched_model_ind[matched];
+    else:
+        reduced_cost_matrix = cost_matrix if overwrite else np.array(cost_matrix, dtype=float);
+        reduce_cost_matrix(reduced_cost_matrix, (birth_cost or 0.) + (death_cost or 0.), block_size=block_size);
+        
+        observed_ind, matched_model_ind = linear_sum_assignment(reduced_cost_matrix);
+        
+        matched = reduced_cost_matrix[observed_ind, matched_model_ind] < 0;
+        observed_ind = observed_ind[matched];
+        matched_model_ind = matched_model_ind[matched];
+    
+    new_observed_ind = np.setdiff1d(np.arange(cost_matrix.shape[0]), observed_ind);
+    
+    return observed_ind, matched_model_ind, new_observed_ind;
+
+def register_epoch(sm, observed_epoch, epoch_ID, radius, order=0, method='pairs'):
+    """Estimate the astrometric offset of the epoch against the sky model, return the corrected epoch
+    
+    The offset is recorded in sm.astrometric_offsets, see estimate_offset.
     
     :param sm: Sky model
     :param observed_epoch: given epoch in a numpy array, already readed from .csv
     :param epoch_ID: The ID pf the observed epoch
+    :param radius: The pair search radius [deg], larger than the expected offset
+    :param order: The order of the polynomial offset, 0 is a global shift
+    :param method: 'pairs' or 'xcorr'
     """
-    cm = compute_cost_matrix(sm,observed_epoch,epoch_ID);
+    model_RA, model_Dec = sky_model_positions(sm);
     
-    ID_list = observed_epoch[:,0];
+    offset = estimate_offset(model_RA, model_Dec, observed_epoch, radius, order=order, method=method);
+    sm.astrometric_offsets[epoch_ID] = offset;
     
-    #Solve the maching problem with the hungarian algorithm
-    observed_ind, matched_model_ind = linear_sum_assignment(cm)
+    log.info('Epoch %i: astrometric offset %.2e, %.2e deg from %i pairs, residual %.2e deg' %(epoch_ID, offset.shift[0], offset.shift[1],
+                                                                                             offset.N_pairs, offset.residual));
     
-    for obs_position_indice in observed_ind:
-        add_observation(sm.galax_model_list[matched_model_ind[obs_position_indice]],
-                        observed_galaxy_position(epoch=epoch_ID, obs=galaxy_obs(observed_epoch, ID_list[obs_position_indice])));
+    return offset.apply(observed_epoch);
+
+def solve_matching_for_galaxy_positions(sm, observed_epoch,epoch_ID,gating_radius=None,block_size=None,birth_cost=None,death_cost=None,
+                                         solver='hungarian',state=None,chi2_threshold=None,register_radius=None,register_order=0,
+                                         flux_sigma=None,cache=None,cache_key=None,journal=None,alert_sigma=None,alerts=None,
+                                         max_memory=None,memmap_file=None,alerts_loop=None):
+    """Solve the cost matrix and update sky model
+    
+    The epoch and the sky model can have different sizes, the unmatched observations start new
+    galaxy models, see solve_assignment.
+    
+    The 'auction' solver works on the sparse gated pairs and starts from the prices in state (an
+    auction_state kept from epoch to epoch), see auction_assignment. Without birth and death costs
+    a pair is worth gated_cost, as the gated elements of the Hungarian cost matrix.
+    
+    :param sm: Sky model
+    :param observed_epoch: given epoch in a numpy array, already readed from .csv, or a compact record array
+    :param epoch_ID: The ID pf the observed epoch
+    :param gating_radius: Gating radius [deg] for the declination-zone engine, None computes the full cost matrix
+    :param block_size: Block size of the full cost matrix computation, None uses the element by element loop
+    :param birth_cost: Cost of an observation which starts a new model, see solve_assignment
+    :param death_cost: Cost of a model without observation in this epoch, see solve_assignment
+    :param solver: 'hungarian' or 'auction'
+    :param state: auction_state of the auction solver, updated in place
+    :param chi2_threshold: Gate the pairs by the chi-square of their combined position errors, see compute_gated_cost_pairs
+    :param register_radius: Pair search radius [deg] of the astrometric registration, None does not register the epoch
+    :param register_order: The order of the polynomial offset of the registration, see register_epoch
+    :param flux_sigma: Drop the pairs with implausible fluxes, see compute_gated_cost_pairs and flux_gate_cost_matrix
+    :param cache: match_cache of the assignments, with a cache_key the assignment is read from it or stored in it
+    :param cache_key: The key of this epoch and sky model, see cache_key
+    :param journal: The assignments are appended to this journal file, see append_journal
+    :param alert_sigma: The assigned observations whose flux deviates more than this from their model are alerts, see transient_alerts
+    :param alerts: The alerts are sent to this queue or appended to this .csv file, see emit_alerts
+    :param max_memory: Memory limit [bytes] of the full cost matrix, above it the matrix is memory-mapped, see compute_blocked_cost_matrix
+    :param memmap_file: Write the full cost matrix into this .npy file through a memory map
+    :param alerts_loop: The event loop of an asyncio.Queue of alerts, see emit_alerts
+    """
+    #Compact record arrays are matched as they are, the registration returns a corrected float epoch
+    if register_radius is not None:
+        observed_epoch = register_epoch(sm, as_float_epoch(observed_epoch), epoch_ID, register_radius, order=register_order);
+    
+    N_models = len(sm.galax_model_list);
+    
+    cached = None;
+    if cache is not None and cache_key is not None:
+        cached = cache.get(cache_key);
+    
+    if cached is not None:
+        observed_ind, matched_model_ind, new_observed_ind = cached['observed_ind'], cached['matched_model_ind'], cached['new_observed_ind'];
+    elif solver == 'auction':
+        if gating_radius is not None or chi2_threshold is not None:
+            obs_ind, model_ind, cost = compute_gated_cost_pairs(sm, observed_epoch, epoch_ID, gating_radius, chi2_threshold, flux_sigma);
+        else:
+            cm = compute_cost_matrix(sm,observed_epoch,epoch_ID,block_size=block_size,flux_sigma=flux_sigma,max_memory=max_memory,
+                                     memmap_file=memmap_file);
+            try:
+                obs_ind, model_ind, cost = cost_matrix_pairs(cm, block_size=block_size or 1024);
+            finally:
+                release_cost_matrix(cm);
+        
+        if birth_cost is None and death_cost is None:
+            unmatched_value = gated_cost;
+        else:
+            unmatched_value = (birth_cost or 0.) + (death_cost or 0.);
+        
+        observed_ind, matched_model_ind, new_observed_ind = auction_assignment(obs_ind, model_ind, cost, observed_epoch.shape[0], N_models,
+                                                                               unmatched_value, state=state);
+    elif solver == 'hungarian':
+        cm = compute_cost_matrix(sm,observed_epoch,epoch_ID,gating_radius=gating_radius,block_size=block_size,chi2_threshold=chi2_threshold,
+                                 flux_sigma=flux_sigma, max_memory=max_memory, memmap_file=memmap_file);
+        
+        #Solve the maching problem with the hungarian algorithm
+        try:
+            observed_ind, matched_model_ind, new_observed_ind = solve_assignment(cm, birth_cost=birth_cost, death_cost=death_cost, overwrite=True,
+                                                                                 block_size=block_size or 1024);
+        finally:
+            release_cost_matrix(cm);
+    else:
+        raise ValueError('Unknown solver: %s' %solver);
+    
+    if cached is None and cache is not None and cache_key is not None:
+        cache.put(cache_key, observed_ind=observed_ind, matched_model_ind=matched_model_ind, new_observed_ind=new_observed_ind);
+    
+    #The flux statistics of the models are the cached ones of the cost stage, before the update
+    if alert_sigma is not None and alerts is not None:
+        Flux_pdf = np.array([sm.galax_model_list[model_indice].Flux_pdf for model_indice in matched_model_ind]).reshape(-1,2);
+        emit_alerts(transient_alerts(observed_epoch, epoch_ID, observed_ind, matched_model_ind, Flux_pdf[:,0], Flux_pdf[:,1], alert_sigma), alerts,
+                    loop=alerts_loop);
+    
+    for obs_position_indice, model_indice in zip(observed_ind, matched_model_ind):
+        add_observation(sm.galax_model_list[model_indice],
+                        observed_galaxy_position(epoch=epoch_ID, obs=observed_epoch[obs_position_indice]));
+    
+    #Births: the unmatched observations start new galaxy models
+    for obs_position_indice in new_observed_ind:
+        galaxy_model = model_galaxy();
+        add_observation(galaxy_model, observed_galaxy_position(epoch=epoch_ID, obs=observed_epoch[obs_position_indice]));
+        add_galaxy_model(sm, galaxy_model);
+    
+    if journal is not None:
+        append_journal(journal, epoch_ID, np.concatenate((matched_model_ind, N_models + np.arange(new_observed_ind.size))),
+                       np.concatenate((observed_ind, new_observed_ind)));
+    
+    #The full history is spilled to disk, the models may keep only a window of it
+    if getattr(sm, 'history_file', None) is not None:
+        append_history(sm.history_file, history_records(observed_epoch, epoch_ID, np.concatenate((observed_ind, new_observed_ind)),
+                                                        np.concatenate((matched_model_ind, N_models + np.arange(new_observed_ind.size)))));
+    
+    if new_observed_ind.size > 0 or matched_model_ind.size < N_models:
+        log.info('Epoch %i: %i new models, %i models without observation' %(epoch_ID, new_observed_ind.size, N_models - matched_model_ind.size));
+    
+    return sm;
+
+def replay_journal(journal, epochs, window=None, decay=None):
+    """Rebuild the sky model from the journal and the epochs, without matching
+    
+    The observations are the journaled rows of the epochs as they are given, a registration
+    (see register_epoch) is not applied again.
+    
+    :param journal: The journal file, see append_journal
+    :param epochs: Dictionary (or list) of the epochs by epoch ID, numpy arrays already readed from .csv
+    :param window: The galaxy models keep only their last window observations, see sky_model
+    :param decay: Exponential decay factor per epoch of the observation weights, see sky_model
+    """
+    records = read_journal(journal);
+    
+    order = np.lexsort((records['epoch'], records['model']));
+    records = records[order];
+    bounds = np.searchsorted(records['model'], np.arange(np.amax(records['model'], initial=-1) + 2));
+    
+    sm = sky_model(window=window, decay=decay);
+    
+    for model_ID in range(0, bounds.size - 1):
+        galaxy_model = model_galaxy();
+        
+        for epoch_ID, row in zip(records['epoch'][bounds[model_ID]:bounds[model_ID+1]], records['row'][bounds[model_ID]:bounds[model_ID+1]]):
+            add_observation(galaxy_model, observed_galaxy_position(epoch=epoch_ID, obs=epochs[epoch_ID][row,:]));
+        
+        add_galaxy_model(sm, galaxy_model);
+    
+    log.info('Sky model of %i models replayed from the journal' %len(sm.galax_model_list));
     
     return sm;
 
-def tinder_for_galaxy_positions(folder=None, initial_dataset=None):
+def tinder_for_galaxy_positions(folder=None, initial_dataset=None, gating_radius=None, block_size=None, birth_cost=None, death_cost=None,
+                                solver='hungarian', chi2_threshold=None, register_radius=None, register_order=0,
+                                flux_sigma=None, cache_folder=None, cache_max_bytes=2**30, window=None, decay=None, history_file=None,
+                                journal=None, alert_sigma=None, alerts=None, max_memory=None, memmap_file=None, alerts_loop=None):
     """Crosmatch the poitions for all the epochs while iterate trough all the observations
 
     :param folder: The folder where the data is
     :param initial_dataset: The dataset path (&name) which define the initial sky model
+    :param gating_radius: Gating radius [deg] for the declination-zone engine, None computes the full cost matrix
+    :param block_size: Block size of the full cost matrix computation, None uses the element by element loop
+    :param birth_cost: Cost of an observation which starts a new model, see solve_assignment
+    :param death_cost: Cost of a model without observation in this epoch, see solve_assignment
+    :param solver: 'hungarian' or 'auction', the auction prices are kept from epoch to epoch
+    :param chi2_threshold: Gate the pairs by the chi-square of their combined position errors, see compute_gated_cost_pairs
+    :param register_radius: Pair search radius [deg] of the astrometric registration, None does not register the epochs
+    :param register_order: The order of the polynomial offset of the registration, see register_epoch
+    :param flux_sigma: Drop the pairs with implausible fluxes, see compute_gated_cost_pairs and flux_gate_cost_matrix
+    :param cache_folder: The assignments are cached in this folder, an unchanged rerun reads them back, see match_cache
+    :param cache_max_bytes: The size limit of the cache [bytes]
+    :param window: The galaxy models keep only their last window observations, see model_galaxy
+    :param decay: Exponential decay factor per epoch of the observation weights of the galaxy models, see decay_window
+    :param history_file: The full history of the observations is appended to this binary file, see append_history
+    :param journal: The assignments are appended to this journal file, the epochs already in it are replayed
+        instead of matched again (crash recovery), see replay_journal
+    :param alert_sigma: The flux deviation threshold of the transient alerts, see transient_alerts
+    :param alerts: The alerts are sent to this queue or appended to this .csv file as each epoch is solved
+    :param max_memory: Memory limit [bytes] of the full cost matrix, above it the matrix is memory-mapped, see compute_blocked_cost_matrix
+    :param memmap_file: Write the full cost matrix of each epoch into this .npy file through a memory map
+    :param alerts_loop: The event loop of an asyncio.Queue of alerts, see emit_alerts
     """
 
     #Create Initial sky model ===> Must be epoch0000 !!!!
@@ -83,7 +303,6 @@ def tinder_for_galaxy_positions(folder=None, initial_dataset=None):
     initial_epoch = np.genfromtxt(initial_dataset,  dtype=float, delimiter=',',  skip_header=0);
     initial_epoch_ID =0;
 
-    sm = create_initial_sky_model(initial_epoch_ID, initial_epoch);
     #Setup datafile list
     
     if folder == None:
@@ -91,6 +310,35 @@ def tinder_for_galaxy_positions(folder=None, initial_dataset=None):
     
     epoch_data_list = sorted(glob.glob("%s*.csv" %folder));
     
+    replayed = np.zeros(0, dtype=int);
+    if journal is not None and os.path.exists(journal):
+        replayed = journal_epochs(journal);
+    
+    if initial_epoch_ID in replayed:
+        epochs = {initial_epoch_ID: initial_epoch};
+        for ep in replayed[replayed != initial_epoch_ID]:
+            epochs[ep] = np.genfromtxt(epoch_data_list[ep],  dtype=float, delimiter=',');
+        
+        sm = replay_journal(journal, epochs, window=window, decay=decay);
+        sm.history_file = history_file;
+    else:
+        sm = create_initial_sky_model(initial_epoch_ID, initial_epoch, window=window, decay=decay, history_file=history_file);
+        replayed = np.zeros(0, dtype=int);
+        
+        if journal is not None:
+            append_journal(journal, initial_epoch_ID, np.arange(initial_epoch.shape[0]), np.arange(initial_epoch.shape[0]));
+    
+    state = auction_state(len(sm.galax_model_list));
+    
+    #The key of each epoch is chained to the previous one, as the sky model depends on all earlier epochs
+    cache = None;
+    key = None;
+    if cache_folder is not None:
+        cache = match_cache(cache_folder, max_bytes=cache_max_bytes);
+        key = cache_key(file_digest(initial_dataset), gating_radius=gating_radius, block_size=block_size, birth_cost=birth_cost,
+                        death_cost=death_cost, solver=solver, chi2_threshold=chi2_threshold, register_radius=register_radius,
+                        register_order=register_order, flux_sigma=flux_sigma, window=window, decay=decay);
+    
     #Iterate trough observations
     ep = 0;#Epoch ID
     for epoch in epoch_data_list:
@@ -98,14 +346,29 @@ def tinder_for_galaxy_positions(folder=None, initial_dataset=None):
             pass;
             ep += 1;
         else:
+            if cache is not None:
+                key = cache_key(key, file_digest(epoch));
+            
+            if ep in replayed:
+                ep += 1;
+                continue;
+            
             epoch = np.genfromtxt(epoch,  dtype=float, delimiter=',');
         
-            sm = solve_matching_for_galaxy_positions(sm, epoch, ep);
+            sm = solve_matching_for_galaxy_positions(sm, epoch, ep, gating_radius=gating_radius, block_size=block_size,
+                                                     birth_cost=birth_cost, death_cost=death_cost, solver=solver, state=state,
+                                                     chi2_threshold=chi2_threshold, register_radius=register_radius,
+                                                     register_order=register_order, flux_sigma=flux_sigma, cache=cache, cache_key=key,
+                                                     journal=journal, alert_sigma=alert_sigma, alerts=alerts,
+                                                     max_memory=max_memory, memmap_file=memmap_file, alerts_loop=alerts_loop);
         
             log.info("Epoch %i solved" %ep);
             print('Epoch %i solved' %ep);#Logger not working somehow
             
             ep += 1;
+    
+    if cache is not None:
+        log.info('Match cache: %i hits, %i misses' %(cache.hits, cache.misses));
         
     return sm;
 
@@ -144,6 +407,8 @@ if __name__ == '__main__':
     
     #sm = tinder_for_galaxy_positions(folder='../Data/', initial_dataset='../Data/epoch00.csv');
     
+    #sm = tinder_for_galaxy_positions(folder='../Data/', initial_dataset='../Data/epoch00.csv', gating_radius=0.05);
+    
     #sm = tinder_for_galaxy_positions(folder='./Subdatacube/', initial_dataset='./Subdatacube/test_epoch00.csv');
     
     exit();
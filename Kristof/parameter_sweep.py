@@ -0,0 +1,268 @@
+"""
+------------------------------
+MIT License
+
+Copyright (c) 2018 Hachastron
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+------------------------------
+
+Parameter sweep of Karl's nearest neighbour filter
+
+The k nearest neighbours of every source of epoch j+1 in epoch j are found
+once for all the consecutive epoch pairs and kept in a neighbour_cache (also on
+disk). The filter thresholds (first / second neighbour ratio, absolute radius
+and chi-square of the combined position errors) are then evaluated on the
+cached distances as vectorized masks and scored against the answers (one row
+per galaxy, the source ID in each epoch), so a grid search needs no new
+neighbour query.
+
+"""
+
+#=================================================
+#IMPORTS
+#=================================================
+import numpy as np;
+import glob;
+import itertools;
+import os;
+from scipy.spatial import cKDTree;
+
+from sky_model_query import *;
+
+#=================================================
+#LOGGING
+#=================================================
+import logging;
+
+log = logging.getLogger();
+log.setLevel(logging.INFO);
+
+#=================================================
+#CLASSES
+#=================================================
+class neighbour_cache(object):
+    """The k nearest neighbours of each source of epoch j+1 in epoch j, for all consecutive epoch pairs
+
+    The pairs are concatenated: pair[i] is the index of the epoch pair (j, j+1) of query row i.
+    """
+
+    def __init__(self, epoch_list, k=2):
+        """Class attributes
+
+        :param epoch_list: List of epochs, numpy arrays already readed from .csv
+        :param k: Number of neighbours kept, at least 2 for the ratio filter
+        """
+
+        self.k = k;
+
+        pair, row, index, distance, chi2 = [], [], [], [], [];
+
+        for j in range(0, len(epoch_list) - 1):
+            ref = epoch_list[j];
+            query = epoch_list[j+1];
+
+            N_query = min(k, ref.shape[0]);
+            chord, nbr = cKDTree(unit_vectors(ref[:,1], ref[:,3])).query(unit_vectors(query[:,1], query[:,3]), k=N_query);
+            nbr = np.asarray(nbr).reshape(query.shape[0], -1);
+            d = chord_to_angle(np.asarray(chord).reshape(query.shape[0], -1));
+
+            #Missing neighbours (too small epoch) are infinitely far
+            missing = k - d.shape[1];
+            nbr = np.column_stack((nbr, np.full((query.shape[0], missing), -1)));
+            d = np.column_stack((d, np.full((query.shape[0], missing), np.inf)));
+
+            pair.append(np.full(query.shape[0], j));
+            row.append(np.arange(query.shape[0]));
+            index.append(nbr);
+            distance.append(d);
+            chi2.append(pair_chi2(ref[nbr[:,0],1], ref[nbr[:,0],3], ref[nbr[:,0],2], ref[nbr[:,0],4],
+                                  query[:,1], query[:,3], query[:,2], query[:,4]));
+
+        self.pair = np.concatenate(pair);#Epoch pair index of the query rows
+        self.row = np.concatenate(row);#Row of the query source in epoch j+1
+        self.index = np.concatenate(index).astype(np.int64);#(N x k) neighbour rows in epoch j
+        self.distance = np.concatenate(distance);#(N x k) neighbour distances [deg]
+        self.chi2 = np.concatenate(chi2);#Chi-square of the first neighbour, see pair_chi2
+
+        log.info('Neighbour cache of %i epoch pairs, %i sources' %(len(epoch_list) - 1, self.row.size));
+
+    @property
+    def ratio(self):
+        """return the second / first neighbour distance ratio of the query sources
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.distance[:,0] > 0, self.distance[:,1] / self.distance[:,0], np.inf);
+
+    def save(self, cache_file):
+        """Save the cache into a .npz file
+
+        :param cache_file: The .npz file
+        """
+        np.savez(cache_file, k=self.k, pair=self.pair, row=self.row, index=self.index, distance=self.distance, chi2=self.chi2);
+
+    @classmethod
+    def load(cls, cache_file):
+        """return the cache saved into a .npz file
+
+        :param cache_file: The .npz file
+        """
+        data = np.load(cache_file);
+
+        cache = cls.__new__(cls);
+        cache.k = int(data['k']);
+        for name in ['pair', 'row', 'index', 'distance', 'chi2']:
+            setattr(cache, name, data[name]);
+
+        return cache;
+
+#=================================================
+#SUPPORT FUNCTIONS
+#=================================================
+def load_answers(answers_file):
+    """Read the answers: one row per galaxy, the source ID in each epoch (negative or empty if not detected)
+
+    The '# epoch00, epoch01, ...' header line of the answers.csv files is skipped.
+
+    :param answers_file: The .csv file of the answers, e.g. ../answers.csv
+    """
+
+    answers = np.genfromtxt(answers_file, dtype=float, delimiter=',', comments='#', ndmin=2);
+
+    return np.where(np.isfinite(answers), answers, -1).astype(np.int64);
+
+def true_neighbours(answers, epoch_list):
+    """Return the true row in epoch j of each query row of epoch j+1 (-1 if it has no counterpart), in neighbour_cache order
+
+    :param answers: The answers, see load_answers
+    :param epoch_list: List of epochs, numpy arrays already readed from .csv
+    """
+
+    truth = [];
+
+    for j in range(0, len(epoch_list) - 1):
+        ref = epoch_list[j];
+        query = epoch_list[j+1];
+
+        #Source ID -> row of the epochs
+        ref_row = dict(zip(ref[:,0].astype(np.int64), range(ref.shape[0])));
+        query_row = dict(zip(query[:,0].astype(np.int64), range(query.shape[0])));
+
+        pair_truth = np.full(query.shape[0], -1, dtype=np.int64);
+
+        if j + 1 < answers.shape[1]:
+            for ref_ID, query_ID in answers[:,j:j+2]:
+                if ref_ID in ref_row and query_ID in query_row:
+                    pair_truth[query_row[query_ID]] = ref_row[ref_ID];
+
+        truth.append(pair_truth);
+
+    return np.concatenate(truth);
+
+def evaluate_filter(cache, truth, ratio=2., radius=np.inf, chi2_threshold=None, unique=True):
+    """Score one set of filter thresholds on the cached neighbours
+
+    A query source is accepted if its first neighbour is closer than radius, below the
+    chi-square threshold, and the second neighbour is ratio times further. With unique the
+    accepted sources sharing a first neighbour are all rejected, as in Karl's filter.
+
+    Returns a dictionary of the thresholds and the scores.
+
+    :param cache: neighbour_cache
+    :param truth: The true neighbour rows, see true_neighbours
+    :param ratio: The second / first neighbour distance ratio threshold
+    :param radius: The largest first neighbour distance [deg]
+    :param chi2_threshold: The chi-square threshold of the first neighbour, None does not filter
+    :param unique: Reject the accepted sources with duplicated neighbours
+    """
+
+    accepted = (cache.distance[:,1] > ratio * cache.distance[:,0]) & (cache.distance[:,0] <= radius);
+
+    if chi2_threshold is not None:
+        accepted &= cache.chi2 <= chi2_threshold;
+
+    if unique:
+        #Neighbour key unique over the epoch pairs
+        key = cache.pair[accepted] * (np.amax(cache.index) + 1) + cache.index[accepted,0];
+        unique_key, inverse, counts = np.unique(key, return_inverse=True, return_counts=True);
+        accepted[np.flatnonzero(accepted)[counts[inverse] > 1]] = False;
+
+    correct = accepted & (cache.index[:,0] == truth);
+    N_true = np.sum(truth >= 0);
+    N_accepted = np.sum(accepted);
+    N_correct = np.sum(correct);
+
+    return {'ratio': ratio, 'radius': radius, 'chi2_threshold': chi2_threshold,
+            'accepted': float(N_accepted / max(accepted.size, 1)),
+            'precision': float(N_correct / max(N_accepted, 1)),
+            'recall': float(N_correct / max(N_true, 1))};
+
+def sweep_filter(cache, truth, ratios=(2.,), radii=(np.inf,), chi2_thresholds=(None,), unique=True):
+    """Score the grid of the filter thresholds, returns the list of the evaluate_filter dictionaries
+
+    :param cache: neighbour_cache
+    :param truth: The true neighbour rows, see true_neighbours
+    :param ratios: The ratio thresholds
+    :param radii: The radius thresholds [deg]
+    :param chi2_thresholds: The chi-square thresholds
+    :param unique: Reject the accepted sources with duplicated neighbours
+    """
+
+    scores = [evaluate_filter(cache, truth, ratio, radius, chi2_threshold, unique=unique)
+              for ratio, radius, chi2_threshold in itertools.product(ratios, radii, chi2_thresholds)];
+
+    log.info('%i filter settings evaluated' %len(scores));
+
+    return scores;
+
+def sweep_folder(folder, answers_file, k=2, cache_file=None, **grid):
+    """Build (or load) the neighbour cache of the epochs in the folder and sweep the filter thresholds
+
+    :param folder: The folder where the data is
+    :param answers_file: The .csv file of the answers, see load_answers
+    :param k: Number of neighbours kept
+    :param cache_file: The neighbour cache is saved into / loaded from this .npz file
+    :param grid: ratios, radii, chi2_thresholds and unique, see sweep_filter
+    """
+
+    epoch_list = [np.genfromtxt(epoch, dtype=float, delimiter=',', skip_header=1) for epoch in sorted(glob.glob("%s*.csv" %folder))];
+
+    if cache_file is not None and os.path.exists(cache_file):
+        cache = neighbour_cache.load(cache_file);
+    else:
+        cache = neighbour_cache(epoch_list, k=k);
+        if cache_file is not None:
+            cache.save(cache_file);
+
+    truth = true_neighbours(load_answers(answers_file), epoch_list);
+
+    return sweep_filter(cache, truth, **grid);
+
+#=================================================
+#MAIN
+#=================================================
+if __name__ == '__main__':
+    """Test
+    """
+
+    scores = sweep_folder('../Data/', '../answers.csv', cache_file=None,
+                          ratios=(1., 1.5, 2., 2.5, 3., 4.), radii=(0.05, 0.1, 0.2, np.inf), chi2_thresholds=(None, 9., 25.));
+
+    for score in sorted(scores, key=lambda s: -s['recall'])[:10]:
+        print(score);
@@ -31,6 +31,7 @@ Position model class for Hachastron
 #=================================================
 import numpy as np;
 from scipy import stats;
+import collections;
 
 #=================================================
 #LOGGING
@@ -55,17 +56,33 @@ def galaxy_obs(epoch, ID):
     
     return epoch[ID_index,:][0,0];
 
+def decay_window(decay, min_weight=1e-3):
+    """Return the number of observations whose decay weight is above min_weight, the default window of a decay
+
+    :param decay: Exponential decay factor (0 < decay < 1) per epoch of the observation weights
+    :param min_weight: The older observations weigh less than this and are dropped
+    """
+
+    if not 0 < decay < 1:
+        raise ValueError('A decay of %s needs an explicit window' %decay);
+
+    return int(np.ceil(np.log(min_weight) / np.log(decay)));
+
 #=================================================
 #CLASSES
 #=================================================
 class observed_galaxy_position(object):
     """Describe a galaxy at a given epoch: position and flux
+    
+    The class has __slots__, so the millions of observations in a sky model carry no __dict__
     """
     
+    __slots__ = ('epoch', 'ID', 'RA', 'RA_err', 'Dec', 'Dec_err', 'Flux', 'Flux_err');
+    
     def __init__(self, epoch=np.inf, obs=None):    
         """Class attributes
         
-        :parem obs: The row of the galaxy in the observation
+        :parem obs: The row of the galaxy in the observation, a row of an epoch matrix or of a compact record array
         
         :param epoch: The epoch the galaxy was observed
         :param ID: The ID of the galaxy in which epoch the it was observed
@@ -80,58 +97,128 @@ class observed_galaxy_position(object):
         if epoch == np.inf:
             log.info("No epoch is given");
             raise ValueError;
-        try:
-            if obs == None:
-                obs = np.array([]);
-        except:
-            pass;
+        if obs is None:
+            obs = np.array([]);
             
         self.epoch = int(epoch);
-        self.ID = int(obs[0]);
-        self.RA = obs[1];
-        self.RA_err = obs[2];
-        self.Dec = obs[3];
-        self.Dec_err = obs[4];
-        self.Flux = obs[5];
-        self.Flux_err = obs[6];
+        
+        if getattr(getattr(obs, 'dtype', None), 'names', None) is not None:
+            #Compact record row
+            self.ID = int(obs['ID']);
+            self.RA = float(obs['RA']);
+            self.RA_err = float(obs['RA_err']);
+            self.Dec = float(obs['Dec']);
+            self.Dec_err = float(obs['Dec_err']);
+            self.Flux = float(obs['Flux']);
+            self.Flux_err = float(obs['Flux_err']);
+        else:
+            self.ID = int(obs[0]);
+            self.RA = obs[1];
+            self.RA_err = obs[2];
+            self.Dec = obs[3];
+            self.Dec_err = obs[4];
+            self.Flux = obs[5];
+            self.Flux_err = obs[6];
 
 class model_galaxy(object):
     """Describe a galaxy model: position and flux
+    
+    The statistics of the observations (position, RA/Dec/Flux gaussians) are computed in one pass
+    and cached until add_observation adds a new observation to the model.
+    
+    With a window the obs_list is a ring buffer (deque) of the last window observations, so the
+    memory and the cost of the statistics do not grow with the number of epochs. With a decay
+    the observations are weighted by decay**(age in epochs).
     """
     
-    def __init__(self, obs_list=None):    
+    def __init__(self, obs_list=None, window=None, decay=None):    
         """Class attributes
         
         :parem obs_list: List of the observed galaxy positions identified as the model galaxy
+        :param window: Number of the last observations kept, None keeps all
+        :param decay: Exponential decay factor (0 < decay <= 1) per epoch of the observation weights, None does not weight
 
         """
         if obs_list == None:
             obs_list = [];
             
         self.obs_list = obs_list;
+        self.decay = None;
+        self.statistics_cache = None;
+        
+        if window is not None or decay is not None:
+            self.set_window(window, decay);
+
+    def set_window(self, window=None, decay=None):
+        """Keep only the last window observations in a ring buffer and weight them by the decay
+        
+        :param window: Number of the last observations kept, None keeps all (with a decay the default is decay_window)
+        :param decay: Exponential decay factor per epoch of the observation weights, None does not weight
+        """
+        #The decayed statistics still walk the whole list, so a decay keeps the memory bounded too
+        if window is None and decay is not None:
+            window = decay_window(decay);
+        
+        if window is not None:
+            self.obs_list = collections.deque(self.obs_list, maxlen=window);
+        
+        self.decay = decay;
+        self.invalidate_statistics();
+
+    def invalidate_statistics(self):
+        """Drop the cached statistics, called by add_observation
+        """
+        self.statistics_cache = None;
+
+    @property
+    def statistics(self):
+        """return the cached dictionary of the model statistics, computed in one pass over obs_list
+        """
+        if self.statistics_cache is None:
+            values = np.array([(x.RA, x.RA_err, x.Dec, x.Dec_err, x.Flux, x.Flux_err) for x in self.obs_list], dtype=float).reshape(-1,6);
+            
+            weights = None;
+            if self.decay is not None:
+                epochs = np.array([x.epoch for x in self.obs_list], dtype=float);
+                weights = self.decay ** (np.amax(epochs) - epochs);
+            
+            self.statistics_cache = {'sky_position': (np.average(values[:,0], weights=weights), np.average(values[:,2], weights=weights))};
+            
+            for name, col in [('RA_pdf', 0), ('Dec_pdf', 2), ('Flux_pdf', 4)]:
+                if weights is None:
+                    mu = np.average(values[:,col], weights=values[:,col+1]);
+                    sigma = np.std(values[:,col]);
+                else:
+                    mu = np.average(values[:,col], weights=values[:,col+1] * weights);
+                    sigma = np.sqrt(np.average((values[:,col] - np.average(values[:,col], weights=weights))**2, weights=weights));
+                if not sigma > 0:
+                    sigma = np.average(np.fabs(values[:,col+1]));
+                
+                self.statistics_cache[name] = (mu, sigma);
+        
+        return self.statistics_cache;
 
     @property
     def sky_position(self):
         """return the (ra,dec) sky position tuple
         """
-        return (np.average([x.RA for x in self.obs_list[:]]), np.average([x.Dec for x in self.obs_list[:]]));
+        return self.statistics['sky_position'];
 
     @property
     def sky_position_sigma(self):
         """return the (ra,dec) sky position tuple
         """
-        if len(self.obs_list[:]) > 1:
+        if len(self.obs_list) > 1:
             return (self.obs_list[0].RA_err,self.obs_list[0].Dec_err);
         else:
-            return (np.std([x.RA_err for x in self.obs_list[:]]), np.std([x.Dec_err for x in self.obs_list[:]]));
+            return (np.std([x.RA_err for x in self.obs_list]), np.std([x.Dec_err for x in self.obs_list]));
 
     @property
     def sky_radial_sigma(self):
         """return the (ra,dec) sky position tuple
         """
         
-        ra_sigma = self.sky_position_sigma[0];
-        dec_sigma = self.sky_position_sigma[1];
+        ra_sigma, dec_sigma = self.sky_position_sigma;
         
         r_sigma = np.sqrt(ra_sigma *ra_sigma + dec_sigma * dec_sigma);
 
@@ -141,55 +228,19 @@ class model_galaxy(object):
     def RA_pdf(self):
         """return the mu and sigma of the gaussian distribution of the observed galaxies RA
         """
-        RA_list = [];
-        RA_err_list = [];
-        for galaxy_pos in self.obs_list:
-            RA_list.append(galaxy_pos.RA);
-            RA_err_list.append(galaxy_pos.RA_err);
-        
-        vectorized_RA_list = np.array(RA_list);
-        vectorized_RA_err_list = np.array(RA_err_list);
-        
-        if np.std(vectorized_RA_list) > 0:
-            return np.average(vectorized_RA_list, weights=vectorized_RA_err_list), np.std(vectorized_RA_list);
-        else:
-            return np.average(vectorized_RA_list, weights=vectorized_RA_err_list), np.average(np.fabs(vectorized_RA_err_list));
+        return self.statistics['RA_pdf'];
 
     @property
     def Dec_pdf(self):
-        """return the mu and sigma of the gaussian distribution of the observed galaxies RA
+        """return the mu and sigma of the gaussian distribution of the observed galaxies Dec
         """
-        Dec_list = [];
-        Dec_err_list = [];
-        for galaxy_pos in self.obs_list:
-            Dec_list.append(galaxy_pos.Dec);
-            Dec_err_list.append(galaxy_pos.Dec_err);
-        
-        vectorized_Dec_list = np.array(Dec_list);
-        vectorized_Dec_err_list = np.array(Dec_err_list);
-        
-        if np.std(vectorized_Dec_list) > 0:
-            return np.average(vectorized_Dec_list, weights=vectorized_Dec_err_list), np.std(vectorized_Dec_list);
-        else:
-            return np.average(vectorized_Dec_list, weights=vectorized_Dec_err_list), np.average(np.fabs(vectorized_Dec_err_list));
+        return self.statistics['Dec_pdf'];
 
     @property
     def Flux_pdf(self):
-        """return the mu and sigma of the gaussian distribution of the observed galaxies RA
+        """return the mu and sigma of the gaussian distribution of the observed galaxies Flux
         """
-        Flux_list = [];
-        Flux_err_list = [];
-        for galaxy_pos in self.obs_list:
-            Flux_list.append(galaxy_pos.Flux);
-            Flux_err_list.append(galaxy_pos.Flux_err);
-        
-        vectorized_Flux_list = np.array(Flux_list);
-        vectorized_Flux_err_list = np.array(Flux_err_list);
-        
-        if np.std(vectorized_Flux_list) > 0:
-            return np.average(vectorized_Flux_list, weights=vectorized_Flux_err_list), np.std(vectorized_Flux_list);
-        else:
-            return np.average(vectorized_Flux_list, weights=vectorized_Flux_err_list), np.average(np.fabs(vectorized_Flux_err_list));
+        return self.statistics['Flux_pdf'];
 
 #=================================================
 #SUPPORT and EVALUATE FUNCTIONS
@@ -201,6 +252,7 @@ def add_observation(model_galaxy,obs):
     :param obs: The observed galaxy (observed_galaxy_poition class)
     """
     model_galaxy.obs_list.append(obs);
+    model_galaxy.invalidate_statistics();
     
     return model_galaxy;
 
@@ -238,29 +290,58 @@ def p_value_of_observation(model_galaxy, obs):
     :param obs: The observed galaxy (observed_galaxy_position class)    
     """
     
+    return p_value_of_values(model_galaxy, obs.RA, obs.Dec, obs.Flux);
+
+def p_value_of_values(model_galaxy, RA, Dec, Flux):
+    """The averaged p-value of p_value_of_observation from the observed values
+    
+    The cost matrix loops call this directly with the epoch matrix elements, so no
+    temporary observed_galaxy_position is created for the pairs.
+    
+    :param model_galaxy: The model of a 'real galaxy' consist a bunch of observations
+    :param RA, Dec, Flux: The observed values
+    """
+    
     model_RA_mu, model_RA_sigma = model_galaxy.RA_pdf;
     model_Dec_mu, model_Dec_sigma = model_galaxy.Dec_pdf;
     model_Flux_mu, model_Flux_sigma = model_galaxy.Flux_pdf;
 
     #The cdf can be higher than 0.5!
-    if obs.RA >= model_RA_mu:
-        p_value_RA = (1 - stats.norm.cdf(obs.RA, model_RA_mu, model_RA_sigma)) * 2;#Two sided distribution p value for RA
+    if RA >= model_RA_mu:
+        p_value_RA = (1 - stats.norm.cdf(RA, model_RA_mu, model_RA_sigma)) * 2;#Two sided distribution p value for RA
     else:
-        p_value_RA = stats.norm.cdf(obs.RA, model_RA_mu, model_RA_sigma) * 2;#Two sided distribution p value for RA
+        p_value_RA = stats.norm.cdf(RA, model_RA_mu, model_RA_sigma) * 2;#Two sided distribution p value for RA
     
-    if obs.Dec >= model_Dec_mu:
-        p_value_Dec = (1 - stats.norm.cdf(obs.Dec, model_Dec_mu, model_Dec_sigma)) * 2;#Two sided distribution p value for Dec
+    if Dec >= model_Dec_mu:
+        p_value_Dec = (1 - stats.norm.cdf(Dec, model_Dec_mu, model_Dec_sigma)) * 2;#Two sided distribution p value for Dec
     else:
-        p_value_Dec = stats.norm.cdf(obs.Dec, model_Dec_mu, model_Dec_sigma) * 2;#Two sided distribution p value for Dec
+        p_value_Dec = stats.norm.cdf(Dec, model_Dec_mu, model_Dec_sigma) * 2;#Two sided distribution p value for Dec
 
-    if obs.Flux >= model_Flux_mu:
-        p_value_Flux = (1 - stats.norm.cdf(obs.Flux, model_Flux_mu, model_Flux_sigma)) * 2;#Two sided distribution p value for RA
+    if Flux >= model_Flux_mu:
+        p_value_Flux = (1 - stats.norm.cdf(Flux, model_Flux_mu, model_Flux_sigma)) * 2;#Two sided distribution p value for RA
     else:
-        p_value_Flux = stats.norm.cdf(obs.Flux, model_Flux_mu, model_Flux_sigma) * 2;#Two sided distribution p value for RA
+        p_value_Flux = stats.norm.cdf(Flux, model_Flux_mu, model_Flux_sigma) * 2;#Two sided distribution p value for RA
     
     final_p_value = 2 - ((p_value_RA + p_value_Dec + p_value_Flux) / 3);#if I ould use 1 - p_value I will get fucked in the Hungarian algorithm if p_value is 1
 
     return final_p_value;
+
+def vectorized_p_value(RA, Dec, Flux, RA_mu, RA_sigma, Dec_mu, Dec_sigma, Flux_mu, Flux_sigma):
+    """The same averaged p-value as p_value_of_observation, but for arrays of observation - model pairs
+    
+    The model parameters are the mu and sigma values returned by RA_pdf, Dec_pdf and Flux_pdf.
+    
+    :param RA, Dec, Flux: The observed values
+    :param RA_mu, RA_sigma: The RA gaussian of the models
+    :param Dec_mu, Dec_sigma: The Dec gaussian of the models
+    :param Flux_mu, Flux_sigma: The Flux gaussian of the models
+    """
+    
+    p_value_RA = 2 * stats.norm.sf(np.fabs(RA - RA_mu) / RA_sigma);#Two sided distribution p value for RA
+    p_value_Dec = 2 * stats.norm.sf(np.fabs(Dec - Dec_mu) / Dec_sigma);#Two sided distribution p value for Dec
+    p_value_Flux = 2 * stats.norm.sf(np.fabs(Flux - Flux_mu) / Flux_sigma);#Two sided distribution p value for Flux
+    
+    return 2 - ((p_value_RA + p_value_Dec + p_value_Flux) / 3);
     
 #=================================================
 #MAIN
@@ -0,0 +1,297 @@
+"""
+------------------------------
+MIT License
+
+Copyright (c) 2018 Hachastron
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+------------------------------
+
+Astrometric registration of the epochs
+
+The systematic RA/Dec offset of a new epoch against the reference positions (the
+sky model) is estimated before the matching, either from unambiguous pairs of the
+bright sources or from the FFT cross-correlation of the binned source densities
+(for shifts larger than the source spacing), optionally followed by a low order
+polynomial fit. The offset is applied to the epoch positions, so the gating can
+use tight radii.
+
+"""
+
+#=================================================
+#IMPORTS
+#=================================================
+import numpy as np;
+
+from zones import zone_nearest_neighbours;
+
+#=================================================
+#LOGGING
+#=================================================
+import logging;
+
+log = logging.getLogger();
+log.setLevel(logging.INFO);
+
+#=================================================
+#CLASSES
+#=================================================
+class astrometric_offset(object):
+    """Polynomial offset field, the correction added to the observed RA and Dec
+    """
+
+    def __init__(self, RA_centre, Dec_centre, coef_RA=None, coef_Dec=None, order=0):
+        """Class attributes
+
+        :param RA_centre, Dec_centre: The centre of the polynomial [deg]
+        :param coef_RA: Coefficients of the RA correction, see design_matrix
+        :param coef_Dec: Coefficients of the Dec correction, see design_matrix
+        :param order: The order of the polynomial
+        """
+
+        N_coef = (order + 1) * (order + 2) // 2;
+
+        self.RA_centre = RA_centre;
+        self.Dec_centre = Dec_centre;
+        self.order = order;
+        self.coef_RA = np.zeros(N_coef) if coef_RA is None else np.asarray(coef_RA, dtype=float);
+        self.coef_Dec = np.zeros(N_coef) if coef_Dec is None else np.asarray(coef_Dec, dtype=float);
+        self.N_pairs = 0;#Number of pairs used in the fit
+        self.residual = np.nan;#Median residual of the pairs after the correction [deg]
+
+    @property
+    def shift(self):
+        """return the (RA, Dec) correction at the centre [deg]
+        """
+        return self.coef_RA[0], self.coef_Dec[0];
+
+    def correction(self, RA, Dec):
+        """return the RA and Dec corrections at the given positions [deg]
+
+        :param RA, Dec: The observed positions [deg]
+        """
+        A = design_matrix(RA, Dec, self.RA_centre, self.Dec_centre, self.order);
+
+        return A.dot(self.coef_RA), A.dot(self.coef_Dec);
+
+    def apply(self, epoch):
+        """return a copy of the epoch with the corrected positions
+
+        :param epoch: given epoch in a numpy array, already readed from .csv
+        """
+        d_RA, d_Dec = self.correction(epoch[:,1], epoch[:,3]);
+
+        corrected = np.array(epoch, dtype=float, copy=True);
+        corrected[:,1] = np.mod(corrected[:,1] + d_RA, 360.);
+        corrected[:,3] = corrected[:,3] + d_Dec;
+
+        return corrected;
+
+#=================================================
+#SUPPORT FUNCTIONS
+#=================================================
+def wrap_RA(d_RA):
+    """Wrap RA differences into [-180, 180) [deg]
+
+    :param d_RA: RA differences [deg]
+    """
+
+    return np.mod(d_RA + 180., 360.) - 180.;
+
+def design_matrix(RA, Dec, RA_centre, Dec_centre, order):
+    """Polynomial terms x^i y^j (i + j <= order) of the offsets from the centre [deg]
+
+    :param RA, Dec: The positions [deg]
+    :param RA_centre, Dec_centre: The centre of the polynomial [deg]
+    :param order: The order of the polynomial
+    """
+
+    x = wrap_RA(np.asarray(RA, dtype=float) - RA_centre);
+    y = np.asarray(Dec, dtype=float) - Dec_centre;
+
+    return np.column_stack([x**(n - j) * y**j for n in range(0, order + 1) for j in range(0, n + 1)]);
+
+def bright_pairs(RA_ref, Dec_ref, epoch, radius, N_bright=500, ratio=3.):
+    """Return unambiguous pairs of the brightest sources of the epoch and the reference positions
+
+    A pair is kept if the second nearest reference position is at least ratio times
+    further than the nearest one. Returns the epoch rows and the reference indices.
+
+    :param RA_ref, Dec_ref: The reference (sky model) positions [deg]
+    :param epoch: given epoch in a numpy array, already readed from .csv
+    :param radius: The search radius [deg], larger than the expected offset
+    :param N_bright: Number of the brightest epoch sources used
+    :param ratio: The second / first neighbour distance ratio of the unambiguous pairs
+    """
+
+    rows = np.argsort(-epoch[:,5], kind='stable')[:N_bright];
+
+    index, distance1, distance2 = zone_nearest_neighbours(RA_ref, Dec_ref, epoch[rows,1], epoch[rows,3], radius);
+
+    keep = (index >= 0) & (distance2 > ratio * distance1);
+
+    return rows[keep], index[keep];
+
+def fit_offset(RA_obs, Dec_obs, RA_ref, Dec_ref, order=0, N_iter=3, clip=3.):
+    """Fit the polynomial correction (reference - observed) of the matched pairs with sigma-clipping
+
+    Order 0 is the median shift, the higher orders are least squares fits.
+
+    :param RA_obs, Dec_obs: The observed positions of the pairs [deg]
+    :param RA_ref, Dec_ref: The reference positions of the pairs [deg]
+    :param order: The order of the polynomial
+    :param N_iter: Number of the clipping iterations
+    :param clip: Pairs with a residual larger than clip times the (MAD) scatter are dropped
+    """
+
+    RA_centre = np.median(RA_obs) if RA_obs.size > 0 else 0.;
+    Dec_centre = np.median(Dec_obs) if Dec_obs.size > 0 else 0.;
+
+    offset = astrometric_offset(RA_centre, Dec_centre, order=order);
+
+    N_coef = offset.coef_RA.size;
+    if RA_obs.size < max(N_coef, 1):
+        log.warning('Not enough pairs (%i) for the astrometric offset' %RA_obs.size);
+        return offset;
+
+    d_RA = wrap_RA(RA_ref - RA_obs);
+    d_Dec = Dec_ref - Dec_obs;
+    A = design_matrix(RA_obs, Dec_obs, RA_centre, Dec_centre, order);
+
+    use = np.ones(RA_obs.size, dtype=bool);
+    for i in range(0, N_iter + 1):
+        if order == 0:
+            offset.coef_RA = np.array([np.median(d_RA[use])]);
+            offset.coef_Dec = np.array([np.median(d_Dec[use])]);
+        else:
+            offset.coef_RA = np.linalg.lstsq(A[use], d_RA[use], rcond=None)[0];
+            offset.coef_Dec = np.linalg.lstsq(A[use], d_Dec[use], rcond=None)[0];
+
+        residual = np.hypot(d_RA - A.dot(offset.coef_RA), d_Dec - A.dot(offset.coef_Dec));
+        scatter = 1.4826 * np.median(residual[use]);
+
+        new_use = residual <= clip * max(scatter, 1e-12);
+        if i == N_iter or np.array_equal(new_use, use) or np.sum(new_use) < N_coef:
+            break;
+        use = new_use;
+
+    offset.N_pairs = int(np.sum(use));
+    offset.residual = np.median(residual[use]);
+
+    return offset;
+
+def cross_correlation_shift(RA_ref, Dec_ref, RA_obs, Dec_obs, max_shift, bin_size):
+    """Estimate a global shift (reference - observed) [deg] from the FFT cross-correlation of the binned source densities
+
+    The positions are projected around the common centre (RA scaled by cos(Dec)), the
+    shift is found to the bin size.
+
+    :param RA_ref, Dec_ref: The reference positions [deg]
+    :param RA_obs, Dec_obs: The observed positions [deg]
+    :param max_shift: The largest shift searched [deg]
+    :param bin_size: The bin size of the density maps [deg]
+    """
+
+    RA_centre = np.median(RA_obs);
+    Dec_centre = np.median(Dec_obs);
+    cos_Dec = np.cos(np.radians(Dec_centre));
+
+    x_ref = wrap_RA(RA_ref - RA_centre) * cos_Dec;
+    y_ref = Dec_ref - Dec_centre;
+    x_obs = wrap_RA(RA_obs - RA_centre) * cos_Dec;
+    y_obs = Dec_obs - Dec_centre;
+
+    #The maps are padded by the largest shift, so the FFT does not wrap the sources around
+    x_edges = np.arange(min(np.amin(x_ref), np.amin(x_obs)) - max_shift, max(np.amax(x_ref), np.amax(x_obs)) + max_shift + bin_size, bin_size);
+    y_edges = np.arange(min(np.amin(y_ref), np.amin(y_obs)) - max_shift, max(np.amax(y_ref), np.amax(y_obs)) + max_shift + bin_size, bin_size);
+
+    H_ref = np.histogram2d(x_ref, y_ref, bins=(x_edges, y_edges))[0];
+    H_obs = np.histogram2d(x_obs, y_obs, bins=(x_edges, y_edges))[0];
+
+    shape = (2 * H_ref.shape[0], 2 * H_ref.shape[1]);
+    correlation = np.fft.irfft2(np.fft.rfft2(H_ref, shape) * np.conj(np.fft.rfft2(H_obs, shape)), shape);
+
+    #Lags beyond the largest shift are not searched
+    lag_x = np.fft.fftfreq(shape[0], 1. / shape[0]) * bin_size;
+    lag_y = np.fft.fftfreq(shape[1], 1. / shape[1]) * bin_size;
+    outside = (np.fabs(lag_x)[:,np.newaxis] > max_shift) | (np.fabs(lag_y)[np.newaxis,:] > max_shift);
+    correlation[outside] = -np.inf;
+
+    i, j = np.unravel_index(np.argmax(correlation), correlation.shape);
+
+    return lag_x[i] / cos_Dec, lag_y[j];
+
+def estimate_offset(RA_ref, Dec_ref, epoch, radius, order=0, method='pairs', max_shift=None, bin_size=None, N_bright=500):
+    """Estimate the astrometric_offset of an epoch against the reference positions
+
+    The 'xcorr' method first finds a coarse shift by cross-correlation and then fits the
+    residual offset from the bright pairs of the shifted epoch.
+
+    :param RA_ref, Dec_ref: The reference (sky model) positions [deg]
+    :param epoch: given epoch in a numpy array, already readed from .csv
+    :param radius: The pair search radius [deg], larger than the (remaining) offset
+    :param order: The order of the polynomial
+    :param method: 'pairs' or 'xcorr'
+    :param max_shift: The largest shift of the cross-correlation [deg], default is 10 times the radius
+    :param bin_size: The bin size of the cross-correlation [deg], default is the radius
+    :param N_bright: Number of the brightest epoch sources used for the pairs
+    """
+
+    coarse_RA, coarse_Dec = 0., 0.;
+
+    if method == 'xcorr':
+        if max_shift is None:
+            max_shift = 10 * radius;
+        if bin_size is None:
+            bin_size = radius;
+        coarse_RA, coarse_Dec = cross_correlation_shift(RA_ref, Dec_ref, epoch[:,1], epoch[:,3], max_shift, bin_size);
+    elif method != 'pairs':
+        raise ValueError('Unknown registration method: %s' %method);
+
+    shifted = np.array(epoch, dtype=float, copy=True);
+    shifted[:,1] = np.mod(shifted[:,1] + coarse_RA, 360.);
+    shifted[:,3] = shifted[:,3] + coarse_Dec;
+
+    rows, ref = bright_pairs(RA_ref, Dec_ref, shifted, radius, N_bright=N_bright);
+    offset = fit_offset(shifted[rows,1], shifted[rows,3], RA_ref[ref], Dec_ref[ref], order=order);
+
+    #The polynomial is fitted on the shifted positions, the coarse shift is a constant term
+    offset.RA_centre = wrap_RA(offset.RA_centre - coarse_RA);
+    offset.Dec_centre = offset.Dec_centre - coarse_Dec;
+    offset.coef_RA[0] += coarse_RA;
+    offset.coef_Dec[0] += coarse_Dec;
+
+    return offset;
+
+#=================================================
+#MAIN
+#=================================================
+if __name__ == '__main__':
+    """Test
+    """
+
+    epoch_0 = np.genfromtxt('../Data/epoch00.csv',  dtype=float, delimiter=',',  skip_header=1);
+
+    shifted = np.array(epoch_0, copy=True);
+    shifted[:,1] += 0.3;
+    shifted[:,3] -= 0.2;
+
+    offset = estimate_offset(epoch_0[:,1], epoch_0[:,3], shifted, radius=0.05, method='xcorr');
+
+    print('Recovered correction: %f, %f deg from %i pairs' %(offset.shift[0], offset.shift[1], offset.N_pairs));
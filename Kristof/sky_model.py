@@ -51,16 +51,24 @@ class sky_model(object):
     """Describe The whole sky model: position and flux of all detected galaxies
     """
     
-    def __init__(self, galax_model_list=None):    
+    def __init__(self, galax_model_list=None, window=None, decay=None, history_file=None):    
         """Class attributes
         
         :param galax_model_list: List of galaxy models
+        :param window: The galaxy models keep only their last window observations, see model_galaxy
+        :param decay: Exponential decay factor per epoch of the observation weights of the galaxy models, without a
+            window the window is decay_window(decay)
+        :param history_file: The assigned observations of every epoch are appended to this binary file, see append_history
 
         """
         if galax_model_list == None:
             galax_model_list = [];
             
         self.galax_model_list = galax_model_list;
+        self.astrometric_offsets = {};#astrometric_offset of the registered epochs by epoch ID
+        self.window = decay_window(decay) if window is None and decay is not None else window;
+        self.decay = decay;
+        self.history_file = history_file;
 
 #=================================================
 #SUPPORT FUNCTIONS
@@ -81,7 +89,7 @@ def human_readable_sky_model(sm):
     model_ID = 0;#The index in the sky model list    
     for galaxy_model in sm.galax_model_list:
         
-        human_readable_galaxy_model = np.zeros((len(sm.galax_model_list[0].obs_list),8));
+        human_readable_galaxy_model = np.zeros((len(galaxy_model.obs_list),8));
         
         obs_ID = 0;
         for obs in sm.galax_model_list[model_ID].obs_list:
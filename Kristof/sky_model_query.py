@@ -0,0 +1,205 @@
+"""
+------------------------------
+MIT License
+
+Copyright (c) 2018 Hachastron
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+------------------------------
+
+Positional queries over the sky model
+
+The galaxy model positions are indexed by a k-d tree of unit vectors, so the
+cone search, the nearest model lookup and the catalogue matching are vectorized
+over the query batch and use real angular distances.
+
+"""
+
+#=================================================
+#IMPORTS
+#=================================================
+import numpy as np;
+from scipy.spatial import cKDTree;
+
+from matching_algorithm import *;
+
+#=================================================
+#LOGGING
+#=================================================
+import logging;
+
+log = logging.getLogger();
+log.setLevel(logging.INFO);
+
+#=================================================
+#SUPPORT FUNCTIONS
+#=================================================
+def unit_vectors(RA, Dec):
+    """Return the (N x 3) unit vectors of the given positions
+
+    :param RA: RA [deg]
+    :param Dec: Dec [deg]
+    """
+
+    RA = np.radians(np.atleast_1d(np.asarray(RA, dtype=float)));
+    Dec = np.radians(np.atleast_1d(np.asarray(Dec, dtype=float)));
+
+    return np.column_stack((np.cos(Dec) * np.cos(RA), np.cos(Dec) * np.sin(RA), np.sin(Dec)));
+
+def chord_to_angle(chord):
+    """Convert the chord length between unit vectors to angular separation [deg]
+
+    :param chord: Chord length
+    """
+
+    return np.degrees(2 * np.arcsin(np.minimum(np.asarray(chord) / 2, 1.)));
+
+def angle_to_chord(angle):
+    """Convert angular separation [deg] to chord length between unit vectors
+
+    :param angle: Angular separation [deg]
+    """
+
+    return 2 * np.sin(np.radians(np.minimum(np.asarray(angle, dtype=float), 180.)) / 2);
+
+def model_light_curve(sm, model_index):
+    """Return the observations of one galaxy model in the human readable format
+
+    Only the requested model is converted, see human_readable_sky_model for the columns.
+
+    :param sm: Sky model
+    :param model_index: The index of the galaxy model
+    """
+
+    obs_list = sm.galax_model_list[model_index].obs_list;
+
+    light_curve = np.zeros((len(obs_list),8));
+    for obs_ID, obs in enumerate(obs_list):
+        light_curve[obs_ID,:] = obs.ID, obs.RA, obs.RA_err, obs.Dec, obs.Dec_err, obs.Flux, obs.Flux_err, obs.epoch;
+
+    return light_curve;
+
+#=================================================
+#CLASSES
+#=================================================
+class sky_model_index(object):
+    """Spatial index over the galaxy model positions of a sky model
+    """
+
+    def __init__(self, sm):
+        """Class attributes
+
+        :param sm: Sky model, the positions are read once, rebuild the index after the model is updated
+        """
+
+        self.sm = sm;
+        self.RA, self.Dec = sky_model_positions(sm);
+        self.tree = cKDTree(unit_vectors(self.RA, self.Dec));
+
+    @property
+    def N_models(self):
+        """return the number of indexed galaxy models
+        """
+        return self.RA.size;
+
+    def cone_search(self, RA, Dec, radius):
+        """Return the models within radius of the query positions
+
+        The result is flat: (query_index, model_index, separation [deg]) arrays, sorted by query
+        then by separation.
+
+        :param RA: RA of the query positions [deg]
+        :param Dec: Dec of the query positions [deg]
+        :param radius: Search radius [deg], scalar or one per query
+        """
+
+        query_vectors = unit_vectors(RA, Dec);
+        chord = np.broadcast_to(angle_to_chord(radius), (query_vectors.shape[0],));
+
+        neighbours = self.tree.query_ball_point(query_vectors, chord);
+
+        counts = np.array([len(n) for n in neighbours], dtype=np.int64);
+        query_index = np.repeat(np.arange(query_vectors.shape[0]), counts);
+        model_index = np.array([m for n in neighbours for m in n], dtype=np.int64);
+
+        separation = chord_to_angle(np.linalg.norm(self.tree.data[model_index] - query_vectors[query_index], axis=1));
+
+        order = np.lexsort((separation, query_index));
+
+        return query_index[order], model_index[order], separation[order];
+
+    def nearest_model(self, RA, Dec, k=1, max_radius=np.inf):
+        """Return the k nearest models of the query positions
+
+        The result is (model_index, separation [deg]) arrays of shape (N_query x k), missing
+        neighbours have index -1 and separation np.inf.
+
+        :param RA: RA of the query positions [deg]
+        :param Dec: Dec of the query positions [deg]
+        :param k: Number of neighbours
+        :param max_radius: Only neighbours closer than this [deg] are returned
+        """
+
+        chord, model_index = self.tree.query(unit_vectors(RA, Dec), k=k, distance_upper_bound=angle_to_chord(max_radius));
+
+        chord = np.asarray(chord).reshape(-1,k);
+        model_index = np.asarray(model_index).reshape(-1,k);
+
+        found = model_index < self.N_models;
+
+        return np.where(found, model_index, -1), np.where(found, chord_to_angle(np.where(found, chord, 0.)), np.inf);
+
+    def match_catalogue(self, catalogue, radius):
+        """Match each row of an external catalogue to its nearest model within radius
+
+        :param catalogue: Catalogue in the epoch format (RA in column 1, Dec in column 3)
+        :param radius: Match radius [deg]
+        """
+
+        model_index, separation = self.nearest_model(catalogue[:,1], catalogue[:,3], k=1, max_radius=radius);
+
+        return model_index[:,0], separation[:,0];
+
+    def light_curves(self, model_index):
+        """Return the light curve matrices of the given models, see model_light_curve
+
+        :param model_index: Model indices, -1 entries give empty matrices
+        """
+
+        return [model_light_curve(self.sm, m) if m >= 0 else np.zeros((0,8)) for m in np.atleast_1d(model_index)];
+
+#=================================================
+#MAIN
+#=================================================
+if __name__ == '__main__':
+    """Test
+    """
+
+    sm = tinder_for_galaxy_positions();
+
+    index = sky_model_index(sm);
+
+    query_index, model_index, separation = index.cone_search([20, 21], [20, 21], 2.);
+    print(query_index, model_index, separation);
+
+    catalogue = np.genfromtxt('./Small_simulated_data/test_epoch10.csv',  dtype=float, delimiter=',');
+    model_index, separation = index.match_catalogue(catalogue, 2.);
+    print(model_index, separation);
+
+    print(index.light_curves(model_index[:1])[0][:5]);
@@ -0,0 +1,337 @@
+"""
+------------------------------
+MIT License
+
+Copyright (c) 2018 Hachastron
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+------------------------------
+
+SQLite backed incremental sky model
+
+The detections and the galaxy models live in an SQLite database. Each model keeps
+running sums of its observations, so the RA/Dec/Flux gaussians of the models can be
+computed without reading the history, and an R*Tree table holds the search box of
+each model. Matching a new epoch reads only the candidate models from the database.
+
+"""
+
+#=================================================
+#IMPORTS
+#=================================================
+import numpy as np;
+import sqlite3;
+
+from matching_algorithm import *;
+
+#=================================================
+#LOGGING
+#=================================================
+import logging;
+
+log = logging.getLogger();
+log.setLevel(logging.INFO);
+
+#=================================================
+#CONSTANTS
+#=================================================
+stat_columns = ['n_obs',
+                'RA_mean', 'RA_M2', 'RA_sum_w', 'RA_sum_wx',
+                'Dec_mean', 'Dec_M2', 'Dec_sum_w', 'Dec_sum_wx',
+                'Flux_mean', 'Flux_M2', 'Flux_sum_w', 'Flux_sum_wx'];
+
+#=================================================
+#SUPPORT FUNCTIONS
+#=================================================
+def pdf_from_running_sums(n_obs, mean, M2, sum_w, sum_wx):
+    """Return the mu and sigma arrays of the model gaussians, the same as model_galaxy.RA_pdf
+
+    mu is the average weighted by the errors, sigma is the std of the values, or the mean error
+    if the std is zero (single observation).
+
+    :param n_obs: Number of observations of the models
+    :param mean, M2: Running mean and sum of squared deviations (Welford)
+    :param sum_w, sum_wx: Running sum of the errors and of the error weighted values
+    """
+
+    mu = sum_wx / sum_w;
+    std = np.sqrt(np.maximum(M2, 0.) / n_obs);
+    sigma = np.where(std > 0, std, sum_w / n_obs);
+
+    return mu, sigma;
+
+def update_running_sums(n_obs, mean, M2, sum_w, sum_wx, value, err):
+    """Add one value to the running sums (Welford update)
+
+    :param n_obs, mean, M2, sum_w, sum_wx: The running sums
+    :param value: The new observed values
+    :param err: The errors of the new values
+    """
+
+    n_new = n_obs + 1;
+    delta = value - mean;
+    mean_new = mean + delta / n_new;
+    M2_new = M2 + delta * (value - mean_new);
+
+    return n_new, mean_new, M2_new, sum_w + np.fabs(err), sum_wx + np.fabs(err) * value;
+
+#=================================================
+#CLASSES
+#=================================================
+class sqlite_sky_model(object):
+    """Sky model stored in an SQLite database
+    """
+
+    def __init__(self, path=':memory:', search_radius=0.05):
+        """Class attributes
+
+        :param path: The database file, an existing database is opened and its search radius is used
+        :param search_radius: The half size of the model search boxes [deg]
+        """
+
+        self.connection = sqlite3.connect(path);
+
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL);
+            CREATE TABLE IF NOT EXISTS detections (epoch INTEGER, ID INTEGER,
+                RA REAL, RA_err REAL, Dec REAL, Dec_err REAL, Flux REAL, Flux_err REAL, model INTEGER);
+            CREATE INDEX IF NOT EXISTS detections_model ON detections (model, epoch);
+            CREATE TABLE IF NOT EXISTS models (model INTEGER PRIMARY KEY, last_epoch INTEGER, %s);
+            CREATE VIRTUAL TABLE IF NOT EXISTS model_index USING rtree (model, min_RA, max_RA, min_Dec, max_Dec);
+            """ %', '.join(['%s REAL' %c for c in stat_columns]));
+
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'search_radius'").fetchone();
+        if row is None:
+            self.connection.execute("INSERT INTO meta VALUES ('search_radius', ?)", (search_radius,));
+            self.connection.commit();
+        else:
+            search_radius = row[0];
+
+        self.search_radius = search_radius;
+
+    @property
+    def N_models(self):
+        """return the number of galaxy models
+        """
+        return self.connection.execute("SELECT COUNT(*) FROM models").fetchone()[0];
+
+    def search_boxes(self, RA, Dec):
+        """Return the (min_RA, max_RA, min_Dec, max_Dec) search boxes around the model positions
+
+        :param RA: RA of the models [deg]
+        :param Dec: Dec of the models [deg]
+        """
+
+        RA_halfwidth = self.search_radius / np.cos(np.radians(np.minimum(np.fabs(Dec) + self.search_radius, 89.9)));
+
+        return RA - RA_halfwidth, RA + RA_halfwidth, Dec - self.search_radius, Dec + self.search_radius;
+
+    def candidate_pairs(self, epoch):
+        """Return the (observation_row, model) candidate pairs of an epoch using the R*Tree
+
+        :param epoch: given epoch in a numpy array, already readed from .csv
+        """
+
+        cur = self.connection.cursor();
+        cur.execute("DROP TABLE IF EXISTS temp.new_obs");
+        cur.execute("CREATE TEMP TABLE new_obs (row INTEGER PRIMARY KEY, RA REAL, Dec REAL)");
+        cur.executemany("INSERT INTO new_obs VALUES (?,?,?)",
+                        zip(range(0,epoch.shape[0]), epoch[:,1].tolist(), epoch[:,3].tolist()));
+
+        pairs = cur.execute("""SELECT o.row, m.model FROM new_obs AS o, model_index AS m
+                               WHERE m.min_RA <= o.RA AND m.max_RA >= o.RA
+                               AND m.min_Dec <= o.Dec AND m.max_Dec >= o.Dec""").fetchall();
+
+        pairs = np.array(pairs, dtype=np.int64).reshape(-1,2);
+
+        return pairs[:,0], pairs[:,1];
+
+    def model_statistics(self, model_ids):
+        """Return the running sums of the given models as a (N_models x len(stat_columns)) array
+
+        :param model_ids: The model IDs
+        """
+
+        cur = self.connection.cursor();
+        cur.execute("DROP TABLE IF EXISTS temp.wanted_models");
+        cur.execute("CREATE TEMP TABLE wanted_models (model INTEGER PRIMARY KEY)");
+        cur.executemany("INSERT INTO wanted_models VALUES (?)", [(int(m),) for m in model_ids]);
+
+        rows = cur.execute("""SELECT models.model, %s FROM models JOIN wanted_models USING (model)
+                              ORDER BY models.model""" %', '.join(stat_columns)).fetchall();
+
+        rows = np.array(rows, dtype=float).reshape(-1, len(stat_columns) + 1);
+
+        return rows[:,0].astype(np.int64), rows[:,1:];
+
+    def match_epoch(self, epoch_ID, epoch, max_cost=None):
+        """Match an epoch against the stored models and ingest it
+
+        Observations without an acceptable model start new models.
+
+        :param epoch_ID: The ID (time) of the epoch
+        :param epoch: given epoch in a numpy array, already readed from .csv
+        :param max_cost: Pairs with higher cost are not matched, default accepts every candidate in the search box
+        """
+
+        if max_cost is None:
+            max_cost = gated_cost;
+
+        N_obs = epoch.shape[0];
+        assignment = np.full(N_obs, -1, dtype=np.int64);
+
+        obs_row, model_id = self.candidate_pairs(epoch);
+
+        if obs_row.size > 0:
+            candidate_ids, statistics = self.model_statistics(np.unique(model_id));
+            model_col = np.searchsorted(candidate_ids, model_id);
+
+            n_obs = statistics[model_col,0];
+            RA_mu, RA_sigma = pdf_from_running_sums(n_obs, *statistics[model_col,1:5].T);
+            Dec_mu, Dec_sigma = pdf_from_running_sums(n_obs, *statistics[model_col,5:9].T);
+            Flux_mu, Flux_sigma = pdf_from_running_sums(n_obs, *statistics[model_col,9:13].T);
+
+            cost = vectorized_p_value(epoch[obs_row,1], epoch[obs_row,3], epoch[obs_row,5],
+                                      RA_mu, RA_sigma, Dec_mu, Dec_sigma, Flux_mu, Flux_sigma);
+
+            #Only the observations with candidates enter the assignment
+            obs_with_candidates, obs_col = np.unique(obs_row, return_inverse=True);
+
+            cm = np.full((obs_with_candidates.size, candidate_ids.size), gated_cost);
+            cm[obs_col, model_col] = cost;
+
+            observed_ind, matched_model_ind = linear_sum_assignment(cm);
+            accepted = cm[observed_ind, matched_model_ind] < np.minimum(max_cost, gated_cost);
+
+            assignment[obs_with_candidates[observed_ind[accepted]]] = candidate_ids[matched_model_ind[accepted]];
+
+        self.ingest(epoch_ID, epoch, assignment);
+
+        return assignment;
+
+    def ingest(self, epoch_ID, epoch, assignment):
+        """Store the detections of an epoch and update the models in one transaction
+
+        :param epoch_ID: The ID (time) of the epoch
+        :param epoch: given epoch in a numpy array, already readed from .csv
+        :param assignment: The model ID of each observation, -1 starts a new model
+        """
+
+        assignment = np.array(assignment, dtype=np.int64);
+
+        with self.connection:
+            cur = self.connection.cursor();
+
+            #Births
+            new = np.flatnonzero(assignment < 0);
+            first_new_id = cur.execute("SELECT COALESCE(MAX(model) + 1, 0) FROM models").fetchone()[0];
+            assignment[new] = first_new_id + np.arange(new.size);
+
+            matched = np.flatnonzero(assignment < first_new_id);
+
+            #Running sums, the new models start from zero
+            statistics = np.zeros((epoch.shape[0], len(stat_columns)));
+            if matched.size > 0:
+                candidate_ids, old_statistics = self.model_statistics(assignment[matched]);
+                statistics[matched,:] = old_statistics[np.searchsorted(candidate_ids, assignment[matched]),:];
+
+            n_obs = statistics[:,0];
+            updated = [n_obs + 1];
+            for col, value, err in [(1, epoch[:,1], epoch[:,2]), (5, epoch[:,3], epoch[:,4]), (9, epoch[:,5], epoch[:,6])]:
+                n_new, mean, M2, sum_w, sum_wx = update_running_sums(n_obs, *statistics[:,col:col+4].T, value, err);
+                updated += [mean, M2, sum_w, sum_wx];
+            updated = np.column_stack(updated);
+
+            model_rows = [(int(m), int(epoch_ID)) + tuple(s) for m, s in zip(assignment, updated.tolist())];
+            cur.executemany("INSERT OR REPLACE INTO models (model, last_epoch, %s) VALUES (?,?,%s)"
+                            %(', '.join(stat_columns), ','.join(['?'] * len(stat_columns))), model_rows);
+
+            #The search box follows the mean position of the model
+            min_RA, max_RA, min_Dec, max_Dec = self.search_boxes(updated[:,1], updated[:,5]);
+            cur.executemany("INSERT OR REPLACE INTO model_index VALUES (?,?,?,?,?)",
+                            zip(assignment.tolist(), min_RA.tolist(), max_RA.tolist(), min_Dec.tolist(), max_Dec.tolist()));
+
+            cur.executemany("INSERT INTO detections VALUES (?,?,?,?,?,?,?,?,?)",
+                            [(int(epoch_ID), int(row[0])) + tuple(row[1:7]) + (int(m),) for row, m in zip(epoch.tolist(), assignment)]);
+
+        log.info('Epoch %i ingested, %i new models' %(epoch_ID, new.size));
+
+    def model_light_curve(self, model):
+        """Return the detections of a galaxy model in the human readable format, see human_readable_sky_model
+
+        :param model: The model ID
+        """
+
+        rows = self.connection.execute("""SELECT ID, RA, RA_err, Dec, Dec_err, Flux, Flux_err, epoch
+                                          FROM detections WHERE model = ? ORDER BY epoch""", (int(model),)).fetchall();
+
+        return np.array(rows, dtype=float).reshape(-1,8);
+
+    def close(self):
+        """Close the database
+        """
+        self.connection.close();
+
+#=================================================
+#PIPELINE
+#=================================================
+def sqlite_tinder_for_galaxy_positions(database, folder=None, search_radius=0.05, max_cost=None):
+    """Crossmatch the epochs of a folder into the SQLite sky model
+
+    Epochs already in the database are skipped, so the function can be called again when new
+    epochs are added to the folder.
+
+    :param database: The database file
+    :param folder: The folder where the data is
+    :param search_radius: The half size of the model search boxes [deg], used for a new database
+    :param max_cost: Pairs with higher cost are not matched
+    """
+
+    if folder is None:
+        folder = './Small_simulated_data/';
+
+    store = sqlite_sky_model(database, search_radius=search_radius);
+
+    done = set([r[0] for r in store.connection.execute("SELECT DISTINCT epoch FROM detections")]);
+
+    epoch_data_list = sorted(glob.glob("%s*.csv" %folder));
+
+    for ep in range(0,len(epoch_data_list)):
+        if ep in done:
+            continue;
+
+        epoch = np.genfromtxt(epoch_data_list[ep],  dtype=float, delimiter=',');
+
+        store.match_epoch(ep, epoch, max_cost=max_cost);
+
+    return store;
+
+#=================================================
+#MAIN
+#=================================================
+if __name__ == '__main__':
+    """Test
+    """
+
+    store = sqlite_tinder_for_galaxy_positions('./sky_model.sqlite', folder='../Data/', search_radius=0.2);
+
+    print('Number of models: %i' %store.N_models);
+    print(store.model_light_curve(0));
+
+    store.close();
@@ -0,0 +1,332 @@
+"""
+------------------------------
+MIT License
+
+Copyright (c) 2018 Hachastron
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+------------------------------
+
+Tiled crossmatch with halo overlap
+
+The footprint is cut into equal area tiles (HEALPix-style: bands equal in
+sin(Dec), each band cut into equal RA ranges). Every tile is solved in a separate
+worker process with its halo, only the observations in the tile core are kept,
+and the claims of the tiles are stitched deterministically.
+
+"""
+
+#=================================================
+#IMPORTS
+#=================================================
+import numpy as np;
+from concurrent.futures import ProcessPoolExecutor;
+
+from matching_algorithm import *;
+
+#=================================================
+#LOGGING
+#=================================================
+import logging;
+
+log = logging.getLogger();
+log.setLevel(logging.INFO);
+
+#=================================================
+#CLASSES
+#=================================================
+class equal_area_tiling(object):
+    """Equal area tiling of a rectangular footprint on the sky
+    """
+
+    def __init__(self, RA_min, RA_max, Dec_min, Dec_max, N_RA=4, N_Dec=4):
+        """Class attributes
+
+        :param RA_min, RA_max: RA range of the footprint [deg]
+        :param Dec_min, Dec_max: Dec range of the footprint [deg]
+        :param N_RA: Number of tiles along RA
+        :param N_Dec: Number of tiles along Dec
+        """
+
+        self.N_RA = int(N_RA);
+        self.N_Dec = int(N_Dec);
+
+        self.RA_edges = np.linspace(RA_min, RA_max, self.N_RA + 1);
+        self.Dec_edges = np.degrees(np.arcsin(np.linspace(np.sin(np.radians(Dec_min)), np.sin(np.radians(Dec_max)), self.N_Dec + 1)));
+
+    @property
+    def N_tiles(self):
+        """return the number of tiles
+        """
+        return self.N_RA * self.N_Dec;
+
+    def tile_ID(self, RA, Dec):
+        """Return the tile index of the given positions, positions outside the footprint go to the edge tiles
+
+        :param RA: RA of the sources [deg]
+        :param Dec: Dec of the sources [deg]
+        """
+
+        RA_ind = np.clip(np.searchsorted(self.RA_edges, RA, side='right') - 1, 0, self.N_RA - 1);
+        Dec_ind = np.clip(np.searchsorted(self.Dec_edges, Dec, side='right') - 1, 0, self.N_Dec - 1);
+
+        return Dec_ind * self.N_RA + RA_ind;
+
+    def tile_bounds(self, tile):
+        """Return the (RA_min, RA_max, Dec_min, Dec_max) of a tile
+
+        :param tile: The tile index
+        """
+
+        Dec_ind, RA_ind = divmod(int(tile), self.N_RA);
+
+        return self.RA_edges[RA_ind], self.RA_edges[RA_ind + 1], self.Dec_edges[Dec_ind], self.Dec_edges[Dec_ind + 1];
+
+    def in_halo(self, tile, RA, Dec, halo):
+        """Return the mask of the sources in the tile extended by the halo margin
+
+        The edge tiles are open towards the outside of the footprint.
+
+        :param tile: The tile index
+        :param RA: RA of the sources [deg]
+        :param Dec: Dec of the sources [deg]
+        :param halo: The halo margin [deg]
+        """
+
+        RA_lo, RA_hi, Dec_lo, Dec_hi = self.tile_bounds(tile);
+        Dec_ind, RA_ind = divmod(int(tile), self.N_RA);
+
+        if RA_ind == 0:
+            RA_lo = -np.inf;
+        if RA_ind == self.N_RA - 1:
+            RA_hi = np.inf;
+        if Dec_ind == 0:
+            Dec_lo = -np.inf;
+        if Dec_ind == self.N_Dec - 1:
+            Dec_hi = np.inf;
+
+        RA_halo = halo / np.cos(np.radians(np.minimum(np.fabs(Dec) + halo, 89.9)));
+
+        return (RA >= RA_lo - RA_halo) & (RA <= RA_hi + RA_halo) & (Dec >= Dec_lo - halo) & (Dec <= Dec_hi + halo);
+
+#=================================================
+#SUPPORT FUNCTIONS
+#=================================================
+def create_tiling(RA, Dec, N_RA=4, N_Dec=4):
+    """Create an equal area tiling covering the given positions
+
+    :param RA: RA of the sources [deg]
+    :param Dec: Dec of the sources [deg]
+    :param N_RA: Number of tiles along RA
+    :param N_Dec: Number of tiles along Dec
+    """
+
+    return equal_area_tiling(np.amin(RA), np.amax(RA), np.amin(Dec), np.amax(Dec), N_RA=N_RA, N_Dec=N_Dec);
+
+def solve_tile(tile_task):
+    """Solve the matching in one tile, this runs in the worker processes
+
+    Returns the claims of the core observations as (observation_index, model_index, cost) arrays,
+    the indices are global.
+
+    :param tile_task: Tuple of (model_index, model_list, obs_index, obs_rows, core_mask, epoch_ID, gating_radius)
+    """
+
+    model_index, model_list, obs_index, obs_rows, core_mask, epoch_ID, gating_radius = tile_task;
+
+    if len(model_list) == 0 or obs_rows.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0);
+
+    tile_sm = sky_model(galax_model_list=model_list);
+
+    cm = compute_gated_cost_matrix(tile_sm, obs_rows, epoch_ID, gating_radius);
+
+    observed_ind, matched_model_ind = linear_sum_assignment(cm);
+
+    cost = cm[observed_ind, matched_model_ind];
+    claim = core_mask[observed_ind] & (cost < gated_cost);
+
+    return obs_index[observed_ind[claim]], model_index[matched_model_ind[claim]], cost[claim];
+
+def stitch_tile_claims(claims, N_obs, N_models):
+    """Merge the claims of the tiles into a single assignment
+
+    Every observation is claimed by at most one tile (its core tile), but a model close to a
+    tile boundary can be claimed from both sides. The claims are accepted in order of cost
+    (observation index breaks the ties) so the result does not depend on the tile order.
+
+    :param claims: List of (observation_index, model_index, cost) arrays
+    :param N_obs: Number of observations
+    :param N_models: Number of models
+    """
+
+    obs_ind = np.concatenate([c[0] for c in claims] + [np.zeros(0, dtype=np.int64)]);
+    model_ind = np.concatenate([c[1] for c in claims] + [np.zeros(0, dtype=np.int64)]);
+    cost = np.concatenate([c[2] for c in claims] + [np.zeros(0)]);
+
+    order = np.lexsort((obs_ind, cost));
+
+    assignment = np.full(N_obs, -1, dtype=np.int64);
+    model_taken = np.zeros(N_models, dtype=bool);
+
+    for k in order:
+        if not model_taken[model_ind[k]]:
+            assignment[obs_ind[k]] = model_ind[k];
+            model_taken[model_ind[k]] = True;
+
+    return assignment;
+
+def solve_leftovers(sm, left_rows, left_models, epoch_ID, gating_radius):
+    """Solve the observations left unassigned by the stitching on the sparse gated pairs
+
+    Only the pairs inside the gate are evaluated (no dense leftover matrix) and solved by the
+    auction, a pair is worth gated_cost as in solve_matching_for_galaxy_positions.
+
+    Returns the leftover row index and the model index (global) of the matched pairs.
+
+    :param sm: Sky model
+    :param left_rows: The leftover observations, epoch rows
+    :param left_models: The global index of the models left unassigned
+    :param epoch_ID: The ID pf the observed epoch
+    :param gating_radius: The gating radius [deg]
+    """
+
+    left_sm = sky_model(galax_model_list=[sm.galax_model_list[j] for j in left_models]);
+    obs_ind, model_ind, cost = compute_gated_cost_pairs(left_sm, left_rows, epoch_ID, gating_radius);
+
+    observed_ind, matched_model_ind, new_observed_ind = auction_assignment(obs_ind, model_ind, cost, left_rows.shape[0], left_models.size,
+                                                                           gated_cost);
+
+    return observed_ind, left_models[matched_model_ind];
+
+def tiled_solve_matching_for_galaxy_positions(sm, observed_epoch, epoch_ID, tiling, gating_radius, halo=None, executor=None):
+    """Solve the matching tile by tile in worker processes and update the sky model
+
+    The observations left unassigned by the stitching are solved together in the parent process,
+    the ones without a model inside the gate start new galaxy models.
+
+    :param sm: Sky model
+    :param observed_epoch: given epoch in a numpy array, already readed from .csv
+    :param epoch_ID: The ID pf the observed epoch
+    :param tiling: The equal_area_tiling of the footprint
+    :param gating_radius: The gating radius [deg]
+    :param halo: The halo margin of the tiles [deg], default is twice the gating radius
+    :param executor: concurrent.futures executor, None solves the tiles in this process
+    """
+
+    if halo is None:
+        halo = 2 * gating_radius;
+
+    model_RA, model_Dec = sky_model_positions(sm);
+    obs_RA = observed_epoch[:,1];
+    obs_Dec = observed_epoch[:,3];
+
+    obs_tile = tiling.tile_ID(obs_RA, obs_Dec);
+
+    tile_tasks = [];
+    for tile in range(0,tiling.N_tiles):
+        model_index = np.flatnonzero(tiling.in_halo(tile, model_RA, model_Dec, halo));
+        obs_index = np.flatnonzero(tiling.in_halo(tile, obs_RA, obs_Dec, halo));
+
+        tile_tasks.append((model_index, [sm.galax_model_list[j] for j in model_index],
+                           obs_index, observed_epoch[obs_index,:], obs_tile[obs_index] == tile,
+                           epoch_ID, gating_radius));
+
+    if executor is None:
+        claims = list(map(solve_tile, tile_tasks));
+    else:
+        claims = list(executor.map(solve_tile, tile_tasks));
+
+    assignment = stitch_tile_claims(claims, observed_epoch.shape[0], len(sm.galax_model_list));
+
+    #Solve the leftovers together
+    left_obs = np.flatnonzero(assignment < 0);
+    if left_obs.size > 0:
+        left_models = np.setdiff1d(np.arange(len(sm.galax_model_list)), assignment[assignment >= 0]);
+
+        observed_ind, matched_model_ind = solve_leftovers(sm, observed_epoch[left_obs,:], left_models, epoch_ID, gating_radius);
+        assignment[left_obs[observed_ind]] = matched_model_ind;
+
+        log.info('%i observations solved after stitching' %left_obs.size);
+
+    for i in np.flatnonzero(assignment >= 0):
+        add_observation(sm.galax_model_list[assignment[i]], observed_galaxy_position(epoch=epoch_ID, obs=observed_epoch[i,:]));
+
+    #Births: the observations without a model inside the gate start new galaxy models
+    for i in np.flatnonzero(assignment < 0):
+        galaxy_model = model_galaxy();
+        add_observation(galaxy_model, observed_galaxy_position(epoch=epoch_ID, obs=observed_epoch[i,:]));
+        add_galaxy_model(sm, galaxy_model);
+
+    return sm;
+
+def tiled_tinder_for_galaxy_positions(folder=None, initial_dataset=None, gating_radius=0.05, N_RA=4, N_Dec=4, halo=None, processes=None):
+    """Crosmatch the positions for all the epochs, solving each epoch tile by tile in worker processes
+
+    :param folder: The folder where the data is
+    :param initial_dataset: The dataset path (&name) which define the initial sky model
+    :param gating_radius: The gating radius [deg]
+    :param N_RA: Number of tiles along RA
+    :param N_Dec: Number of tiles along Dec
+    :param halo: The halo margin of the tiles [deg], default is twice the gating radius
+    :param processes: Number of worker processes, default is the number of cores, 1 runs without workers
+    """
+
+    if initial_dataset is None:
+        initial_dataset = './Small_simulated_data/test_epoch00.csv';
+
+    initial_epoch = np.genfromtxt(initial_dataset,  dtype=float, delimiter=',',  skip_header=0);
+    initial_epoch_ID =0;
+
+    sm = create_initial_sky_model(initial_epoch_ID, initial_epoch);
+
+    tiling = create_tiling(initial_epoch[:,1], initial_epoch[:,3], N_RA=N_RA, N_Dec=N_Dec);
+
+    if folder is None:
+        folder = './Small_simulated_data/';
+
+    epoch_data_list = sorted(glob.glob("%s*.csv" %folder));
+
+    executor = None;
+    if processes != 1:
+        executor = ProcessPoolExecutor(max_workers=processes);
+
+    try:
+        for ep in range(1,len(epoch_data_list)):
+            epoch = np.genfromtxt(epoch_data_list[ep],  dtype=float, delimiter=',');
+
+            sm = tiled_solve_matching_for_galaxy_positions(sm, epoch, ep, tiling, gating_radius, halo=halo, executor=executor);
+
+            log.info("Epoch %i solved" %ep);
+    finally:
+        if executor is not None:
+            executor.shutdown();
+
+    return sm;
+
+#=================================================
+#MAIN
+#=================================================
+if __name__ == '__main__':
+    """Test
+    """
+
+    sm = tiled_tinder_for_galaxy_positions(folder='../Data/', initial_dataset='../Data/epoch00.csv', gating_radius=0.2);
+
+    print(len(sm.galax_model_list[0].obs_list));#Number of element in each galaxy model of the sky model
@@ -0,0 +1,165 @@
+"""
+------------------------------
+MIT License
+
+Copyright (c) 2018 Hachastron
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+------------------------------
+
+Light curve variability statistics
+
+The statistics of all the galaxy models are computed at once from the columns
+of the compact sky model (see compact_sky_model and read_history) with
+np.bincount over the model index:
+
+- the weighted (1 / Flux_err^2) mean flux
+- chi2: the chi-square of the light curve against the constant weighted mean
+- eta: the reduced chi-square chi2 / (N - 1)
+- V: the modulation index, the standard deviation over the mean of the flux
+- max_deviation: the largest |Flux - weighted mean| / Flux_err of the light curve
+
+"""
+
+#=================================================
+#IMPORTS
+#=================================================
+import numpy as np;
+
+from compact_storage import *;
+
+#=================================================
+#LOGGING
+#=================================================
+import logging;
+
+log = logging.getLogger();
+log.setLevel(logging.INFO);
+
+#=================================================
+#CONSTANTS
+#=================================================
+variability_dtype = np.dtype([('model', np.int32), ('N', np.int32), ('RA', np.float64), ('Dec', np.float64),
+                              ('mean_flux', np.float64), ('weighted_mean_flux', np.float64),
+                              ('chi2', np.float64), ('eta', np.float64), ('V', np.float64), ('max_deviation', np.float64)]);
+
+#=================================================
+#SUPPORT FUNCTIONS
+#=================================================
+def variability_table(compact_sm):
+    """Return the variability statistics of every galaxy model in one record array (variability_dtype)
+
+    The statistics of the models with one observation are np.nan (except the means).
+
+    :param compact_sm: Sky model from compact_sky_model (or read_history)
+    """
+
+    model = compact_sm['model'].astype(np.int64);
+    flux = compact_sm['Flux'].astype(float);
+    flux_err = compact_sm['Flux_err'].astype(float);
+
+    N_models = np.amax(model) + 1 if model.size > 0 else 0;
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        N = np.bincount(model, minlength=N_models).astype(float);
+        w = 1. / (flux_err * flux_err);
+
+        mean_flux = np.bincount(model, weights=flux, minlength=N_models) / N;
+        weighted_mean_flux = np.bincount(model, weights=w * flux, minlength=N_models) / np.bincount(model, weights=w, minlength=N_models);
+
+        residual = flux - weighted_mean_flux[model];
+        chi2 = np.bincount(model, weights=w * residual * residual, minlength=N_models);
+
+        #Sample standard deviation of the flux from the sum of squares around the mean
+        d = flux - mean_flux[model];
+        std_flux = np.sqrt(np.bincount(model, weights=d * d, minlength=N_models) / (N - 1));
+
+        deviation = np.fabs(residual) / flux_err;
+
+        table = np.zeros(N_models, dtype=variability_dtype);
+        table['model'] = np.arange(N_models);
+        table['N'] = N;
+        table['RA'] = np.bincount(model, weights=compact_sm['RA'], minlength=N_models) / N;
+        table['Dec'] = np.bincount(model, weights=compact_sm['Dec'], minlength=N_models) / N;
+        table['mean_flux'] = mean_flux;
+        table['weighted_mean_flux'] = weighted_mean_flux;
+        table['chi2'] = np.where(N > 1, chi2, np.nan);
+        table['eta'] = np.where(N > 1, chi2 / (N - 1), np.nan);
+        table['V'] = np.where(N > 1, std_flux / mean_flux, np.nan);
+
+    #Max of each model, the rows of a compact sky model are sorted by model
+    order = np.argsort(model, kind='stable');
+    present = N > 0;
+    starts = np.searchsorted(model[order], np.flatnonzero(present));
+    max_deviation = np.full(N_models, np.nan);
+    if starts.size > 0:
+        max_deviation[present] = np.maximum.reduceat(deviation[order], starts);
+    table['max_deviation'] = np.where(N > 1, max_deviation, np.nan);
+
+    log.info('Variability statistics of %i models' %N_models);
+
+    return table;
+
+def variable_candidates(table, eta_threshold=None, V_threshold=None, min_N=2):
+    """Return the rows of the variability table above both thresholds
+
+    :param table: The variability table, see variability_table
+    :param eta_threshold: The reduced chi-square threshold, None does not select by it
+    :param V_threshold: The modulation index threshold, None does not select by it
+    :param min_N: The least number of observations of a candidate
+    """
+
+    selected = table['N'] >= min_N;
+
+    if eta_threshold is not None:
+        selected &= table['eta'] > eta_threshold;
+    if V_threshold is not None:
+        selected &= table['V'] > V_threshold;
+
+    return table[selected];
+
+def save_variability_table(table, path):
+    """Save the variability table into one .csv file with a header
+
+    :param table: The variability table, see variability_table
+    :param path: The output file
+    """
+
+    fmt = ['%i', '%i'] + ['%.10g'] * (len(variability_dtype.names) - 2);
+
+    np.savetxt(path, table, fmt=fmt, delimiter=',', header=','.join(variability_dtype.names));
+
+#=================================================
+#MAIN
+#=================================================
+if __name__ == '__main__':
+    """Test
+    """
+
+    epoch = np.genfromtxt('../Data/epoch00.csv',  dtype=float, delimiter=',',  skip_header=1);
+
+    #A sky model of two epochs: the same sources, one of them flares
+    compact_sm = np.concatenate((history_records(epoch, 0, np.arange(epoch.shape[0]), np.arange(epoch.shape[0])),
+                                 history_records(epoch, 1, np.arange(epoch.shape[0]), np.arange(epoch.shape[0]))));
+    compact_sm['Flux'][-1] *= 10.;
+    compact_sm = compact_sm[np.argsort(compact_sm['model'], kind='stable')];
+
+    table = variability_table(compact_sm);
+
+    print(variable_candidates(table, eta_threshold=10.));
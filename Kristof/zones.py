@@ -0,0 +1,325 @@
+"""
+------------------------------
+MIT License
+
+Copyright (c) 2018 Hachastron
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+------------------------------
+
+Declination-zone crossmatch engine
+
+The sky is cut into declination stripes (zones), the sources are sorted by RA
+within each zone, and the candidate pairs are found by a sweep with an RA window
+scaled by 1/cos(Dec). The pairs are yielded zone by zone, so only one zone worth
+of candidates lives in the memory at a time.
+
+"""
+
+#=================================================
+#IMPORTS
+#=================================================
+import numpy as np;
+
+#=================================================
+#LOGGING
+#=================================================
+import logging;
+
+log = logging.getLogger();
+log.setLevel(logging.INFO);
+
+#=================================================
+#SUPPORT FUNCTIONS
+#=================================================
+def zone_ID(Dec, zone_height):
+    """Return the zone index of the given declinations
+
+    :param Dec: Declinations [deg]
+    :param zone_height: The height of the declination stripes [deg]
+    """
+
+    return np.floor((np.asarray(Dec, dtype=float) + 90.) / zone_height).astype(np.int64);
+
+def zone_sort(RA, Dec, zone_height):
+    """Return the order which sorts the sources by zone then by RA, the sorted zone indices and the sorted RA
+
+    :param RA: RA of the sources [deg]
+    :param Dec: Dec of the sources [deg]
+    :param zone_height: The height of the declination stripes [deg]
+    """
+
+    zone = zone_ID(Dec, zone_height);
+    order = np.lexsort((RA, zone));
+
+    return order, zone[order], RA[order];
+
+def ragged_arange(lo, hi):
+    """Concatenated np.arange(lo[i],hi[i]) for all i without a python loop
+
+    :param lo: Start indices
+    :param hi: Stop indices
+    """
+
+    counts = hi - lo;
+    offset = np.repeat(np.cumsum(counts) - counts, counts);
+
+    return np.arange(np.sum(counts)) - offset + np.repeat(lo, counts);
+
+def sky_separation(RA_a, Dec_a, RA_b, Dec_b):
+    """Flat sky approximation of the angular separation, the RA difference is scaled by cos(Dec)
+
+    :param RA_a, Dec_a: Position of the first sources [deg]
+    :param RA_b, Dec_b: Position of the second sources [deg]
+    """
+
+    d_RA = np.mod(RA_a - RA_b + 180., 360.) - 180.;
+    d_RA *= np.cos(np.radians(0.5 * (Dec_a + Dec_b)));
+    d_Dec = Dec_a - Dec_b;
+
+    return np.sqrt(d_RA * d_RA + d_Dec * d_Dec);
+
+def pair_chi2(RA_a, Dec_a, RA_err_a, Dec_err_a, RA_b, Dec_b, RA_err_b, Dec_err_b):
+    """Chi-square separation of source pairs with their combined (error ellipse) uncertainties
+
+    The RA difference is compared with the RA errors as in the cost function, without the cos(Dec) scaling.
+
+    :param RA_a, Dec_a: Position of the first sources [deg]
+    :param RA_err_a, Dec_err_a: Position errors of the first sources [deg]
+    :param RA_b, Dec_b: Position of the second sources [deg]
+    :param RA_err_b, Dec_err_b: Position errors of the second sources [deg]
+    """
+
+    d_RA = np.mod(RA_a - RA_b + 180., 360.) - 180.;
+    d_Dec = Dec_a - Dec_b;
+
+    return d_RA * d_RA / (RA_err_a * RA_err_a + RA_err_b * RA_err_b) + d_Dec * d_Dec / (Dec_err_a * Dec_err_a + Dec_err_b * Dec_err_b);
+
+def chi2_search_radius(RA_err_a, Dec_err_a, RA_err_b, Dec_err_b, chi2_threshold):
+    """Return the search radius [deg] which holds every pair below the chi-square threshold
+
+    :param RA_err_a, Dec_err_a: Position errors of the first catalogue [deg]
+    :param RA_err_b, Dec_err_b: Position errors of the second catalogue [deg]
+    :param chi2_threshold: The chi-square threshold
+    """
+
+    variance = np.amax(RA_err_a)**2 + np.amax(RA_err_b)**2 + np.amax(Dec_err_a)**2 + np.amax(Dec_err_b)**2;
+
+    return np.sqrt(chi2_threshold * variance);
+
+def pair_flux_sigma(Flux_a, Flux_err_a, Flux_b, Flux_err_b):
+    """Flux difference of source pairs in the units of their combined flux error
+
+    |Flux_a - Flux_b| / sqrt(Flux_err_a^2 + Flux_err_b^2), the pairs above a threshold are
+    rejected by flux_gated_pairs. Zero combined errors give np.inf (or 0 for equal fluxes).
+
+    :param Flux_a, Flux_err_a: Flux and flux error of the first sources
+    :param Flux_b, Flux_err_b: Flux and flux error of the second sources
+    """
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma = np.fabs(Flux_a - Flux_b) / np.sqrt(Flux_err_a * Flux_err_a + Flux_err_b * Flux_err_b);
+
+    return np.where(Flux_a == Flux_b, 0., sigma);
+
+#=================================================
+#ZONE ENGINE
+#=================================================
+def zone_candidate_pairs(RA_a, Dec_a, RA_b, Dec_b, radius, zone_height=None):
+    """Yield the candidate pairs between catalogue a and b closer than radius
+
+    The pairs are yielded zone by zone of catalogue b as (a_index, b_index, separation)
+    arrays, the indices are the row indices in the input arrays.
+
+    :param RA_a, Dec_a: Position of the catalogue a sources [deg]
+    :param RA_b, Dec_b: Position of the catalogue b sources [deg]
+    :param radius: The search radius [deg], a single value or one value for each catalogue b source
+    :param zone_height: The height of the declination stripes [deg], default is the (median) radius
+    """
+
+    RA_a = np.asarray(RA_a, dtype=float);
+    Dec_a = np.asarray(Dec_a, dtype=float);
+    RA_b = np.asarray(RA_b, dtype=float);
+    Dec_b = np.asarray(Dec_b, dtype=float);
+    radius = np.broadcast_to(np.asarray(radius, dtype=float), RA_b.shape);
+
+    if not np.all(np.isfinite(radius) & (radius > 0)):
+        raise ValueError('The search radius must be finite and positive');
+
+    if zone_height is None:
+        zone_height = np.median(radius) if radius.size > 0 else 1.;
+
+    #Sort catalogue a by zone and RA
+    order_a, zone_a, RA_a_sorted = zone_sort(RA_a, Dec_a, zone_height);
+    zones_of_a, zone_start_a = np.unique(zone_a, return_index=True);
+    zone_stop_a = np.append(zone_start_a[1:], zone_a.size);
+
+    #Group catalogue b by zone
+    zone_b = zone_ID(Dec_b, zone_height);
+    order_b = np.argsort(zone_b, kind='stable');
+    zones_of_b, zone_start_b = np.unique(zone_b[order_b], return_index=True);
+    zone_stop_b = np.append(zone_start_b[1:], zone_b.size);
+
+    for z, b_start, b_stop in zip(zones_of_b, zone_start_b, zone_stop_b):
+        b_ind = order_b[b_start:b_stop];
+        b_radius = radius[b_ind];
+
+        zone_span = int(np.ceil(np.amax(b_radius) / zone_height));
+
+        #RA window scaled by the declination furthest from the equator within the radius
+        cos_Dec = np.cos(np.radians(np.minimum(np.fabs(Dec_b[b_ind]) + b_radius, 90.)));
+        window = np.where(cos_Dec > b_radius / 180., b_radius / np.maximum(cos_Dec, 1e-300), 360.);#Whole zone close to the poles
+
+        a_chunk = [];
+        b_chunk = [];
+
+        for za in range(z - zone_span, z + zone_span + 1):
+            k = np.searchsorted(zones_of_a, za);
+            if k == zones_of_a.size or zones_of_a[k] != za:
+                continue;
+
+            a_start, a_stop = zone_start_a[k], zone_stop_a[k];
+            RA_zone = RA_a_sorted[a_start:a_stop];
+
+            #The window can wrap around RA = 0 = 360
+            for shift in (0., 360., -360.):
+                if shift == 0.:
+                    query = np.arange(b_ind.size);
+                elif shift > 0.:
+                    query = np.flatnonzero((RA_b[b_ind] - window < 0.) & (window < 180.));
+                else:
+                    query = np.flatnonzero((RA_b[b_ind] + window >= 360.) & (window < 180.));
+
+                if query.size == 0:
+                    continue;
+
+                RA_query = RA_b[b_ind[query]] + shift;
+                lo = np.searchsorted(RA_zone, RA_query - window[query], side='left');
+                hi = np.searchsorted(RA_zone, RA_query + window[query], side='right');
+
+                a_chunk.append(order_a[a_start + ragged_arange(lo, hi)]);
+                b_chunk.append(np.repeat(b_ind[query], hi - lo));
+
+        if len(a_chunk) == 0:
+            continue;
+
+        a_chunk = np.concatenate(a_chunk);
+        b_chunk = np.concatenate(b_chunk);
+
+        separation = sky_separation(RA_a[a_chunk], Dec_a[a_chunk], RA_b[b_chunk], Dec_b[b_chunk]);
+        close = separation <= radius[b_chunk];
+
+        if np.any(close):
+            yield a_chunk[close], b_chunk[close], separation[close];
+
+def chi2_gated_pairs(pair_stream, RA_a, Dec_a, RA_err_a, Dec_err_a, RA_b, Dec_b, RA_err_b, Dec_err_b, chi2_threshold):
+    """Drop the candidate pairs above the chi-square threshold from a zone_candidate_pairs stream
+
+    :param pair_stream: Iterable of (a_index, b_index, separation) chunks
+    :param RA_a, Dec_a, RA_err_a, Dec_err_a: Positions and errors of catalogue a [deg]
+    :param RA_b, Dec_b, RA_err_b, Dec_err_b: Positions and errors of catalogue b [deg]
+    :param chi2_threshold: The chi-square threshold, see pair_chi2
+    """
+
+    for a_ind, b_ind, separation in pair_stream:
+        chi2 = pair_chi2(RA_a[a_ind], Dec_a[a_ind], RA_err_a[a_ind], Dec_err_a[a_ind],
+                         RA_b[b_ind], Dec_b[b_ind], RA_err_b[b_ind], Dec_err_b[b_ind]);
+        keep = chi2 <= chi2_threshold;
+
+        if np.any(keep):
+            yield a_ind[keep], b_ind[keep], separation[keep];
+
+def flux_gated_pairs(pair_stream, Flux_a, Flux_err_a, Flux_b, Flux_err_b, flux_sigma):
+    """Drop the candidate pairs with an implausible flux ratio from a zone_candidate_pairs stream
+
+    :param pair_stream: Iterable of (a_index, b_index, separation) chunks
+    :param Flux_a, Flux_err_a: Fluxes and flux errors of catalogue a
+    :param Flux_b, Flux_err_b: Fluxes and flux errors of catalogue b
+    :param flux_sigma: The largest flux difference in combined flux errors, see pair_flux_sigma
+    """
+
+    for a_ind, b_ind, separation in pair_stream:
+        keep = pair_flux_sigma(Flux_a[a_ind], Flux_err_a[a_ind], Flux_b[b_ind], Flux_err_b[b_ind]) <= flux_sigma;
+
+        if np.any(keep):
+            yield a_ind[keep], b_ind[keep], separation[keep];
+
+def collect_candidate_pairs(pair_stream):
+    """Concatenate a candidate pair stream into three arrays
+
+    :param pair_stream: Iterable of (a_index, b_index, separation) chunks
+    """
+
+    a_list = [np.zeros(0, dtype=np.int64)];
+    b_list = [np.zeros(0, dtype=np.int64)];
+    separation_list = [np.zeros(0)];
+
+    for a_ind, b_ind, separation in pair_stream:
+        a_list.append(a_ind);
+        b_list.append(b_ind);
+        separation_list.append(separation);
+
+    return np.concatenate(a_list), np.concatenate(b_list), np.concatenate(separation_list);
+
+def zone_nearest_neighbours(RA_a, Dec_a, RA_b, Dec_b, radius, zone_height=None):
+    """Return the first and second nearest neighbour in catalogue a of each source in catalogue b
+
+    Sources without a neighbour within the radius get index -1, missing distances are np.inf
+
+    :param RA_a, Dec_a: Position of the catalogue a sources [deg]
+    :param RA_b, Dec_b: Position of the catalogue b sources [deg]
+    :param radius: The search radius [deg], a single value or one value for each catalogue b source
+    :param zone_height: The height of the declination stripes [deg], default is the (median) radius
+    """
+
+    n_b = np.asarray(RA_b).size;
+
+    index = np.full(n_b, -1, dtype=np.int64);
+    distance1 = np.full(n_b, np.inf);
+    distance2 = np.full(n_b, np.inf);
+
+    #Each b source appears in exactly one chunk
+    for a_ind, b_ind, separation in zone_candidate_pairs(RA_a, Dec_a, RA_b, Dec_b, radius, zone_height):
+        order = np.lexsort((separation, b_ind));
+        a_ind, b_ind, separation = a_ind[order], b_ind[order], separation[order];
+
+        first = np.flatnonzero(np.append(True, b_ind[1:] != b_ind[:-1]));
+        index[b_ind[first]] = a_ind[first];
+        distance1[b_ind[first]] = separation[first];
+
+        second = first + 1;
+        second = second[second < b_ind.size];
+        second = second[b_ind[second] == b_ind[second - 1]];
+        distance2[b_ind[second]] = separation[second];
+
+    return index, distance1, distance2;
+
+#=================================================
+#MAIN
+#=================================================
+if __name__ == '__main__':
+    """Test
+    """
+    epoch_0 = np.genfromtxt('../Data/epoch00.csv',  dtype=float, delimiter=',',  skip_header=1);
+    epoch_1 = np.genfromtxt('../Data/epoch01.csv',  dtype=float, delimiter=',',  skip_header=1);
+
+    index, distance1, distance2 = zone_nearest_neighbours(epoch_0[:,1], epoch_0[:,3], epoch_1[:,1], epoch_1[:,3], radius=0.1);
+
+    print('Sources with a neighbour: %i' %np.sum(index >= 0));
+    print('Median nearest neighbour distance: %f deg' %np.median(distance1[index >= 0]));